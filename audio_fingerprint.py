@@ -0,0 +1,66 @@
+'calculates the fingerprints of the audio of wave files, exact and robust to changes of their format and silences'
+
+import wave
+import audioop
+import hashlib
+
+# rate of the energy envelope, in windows per second, and number of windows read from the file at once
+ENVELOPE_RATE = 10
+READ_WINDOWS = 100
+# the signature has a bit per pair of consecutive segments of the envelope, as the difference hash of images
+SIGNATURE_BITS = 64
+# the windows whose RMS is below the full scale divided by SILENCE_RATIO (-60 dB) are silent
+SILENCE_RATIO = 1000
+# the samples are converted to 16 bits before measuring their energy
+ENVELOPE_WIDTH = 2
+
+def _samples_16(frames, width):
+    'returns the signed samples of the frames as 16 bits ones'
+    if width == 1:
+        # the samples of 8 bits of the wave files are unsigned
+        return audioop.lin2lin(audioop.bias(frames, 1, -128), 1, ENVELOPE_WIDTH)
+    elif width == 3:
+        # the samples are little-endian, so that removing their lowest byte leaves their highest 16 bits
+        samples = bytearray(frames)
+        del samples[0::3]
+        return str(samples)
+    elif width == 4:
+        return audioop.lin2lin(frames, 4, ENVELOPE_WIDTH)
+    return frames
+
+def _signature(envelope):
+    'returns the signature of the energy envelope without its leading and trailing silence, None if all silent'
+    threshold = (1 << (8 * ENVELOPE_WIDTH - 1)) / SILENCE_RATIO
+    sound = [index for (index, rms) in enumerate(envelope) if rms >= threshold]
+    if len(sound) == 0:
+        return None
+    envelope = envelope[sound[0]:sound[-1] + 1]
+    # the envelope is split in equal segments, repeating its windows if shorter
+    segments = []
+    for segment in range(SIGNATURE_BITS + 1):
+        start = segment * len(envelope) / (SIGNATURE_BITS + 1)
+        end = max((segment + 1) * len(envelope) / (SIGNATURE_BITS + 1), start + 1)
+        segments.append(sum(envelope[start:end]) / (end - start))
+    value = 0
+    for segment in range(SIGNATURE_BITS):
+        value = (value << 1) | int(segments[segment + 1] > segments[segment])
+    return '%0*x' % (SIGNATURE_BITS / 4, value)
+
+def fingerprint(wav_file):
+    'returns the SHA512 checksum of the whole audio stream of the wave file and the signature of its envelope'
+    # the envelope is the RMS of windows of 1/ENVELOPE_RATE seconds, whatever the sample rate, over all the
+    # channels, so that it is the energy of the audio downmixed and decimated
+    wav = wave.open(wav_file, 'rb')
+    (channels, width, rate) = (wav.getnchannels(), wav.getsampwidth(), wav.getframerate())
+    window_frames = max(rate / ENVELOPE_RATE, 1)
+    window_bytes = window_frames * channels * ENVELOPE_WIDTH
+    cksm = hashlib.sha512()
+    envelope = []
+    frames = wav.readframes(window_frames * READ_WINDOWS)
+    while len(frames) > 0:
+        cksm.update(frames)
+        samples = _samples_16(frames, width)
+        for start in range(0, len(samples), window_bytes):
+            envelope.append(audioop.rms(samples[start:start + window_bytes], ENVELOPE_WIDTH))
+        frames = wav.readframes(window_frames * READ_WINDOWS)
+    return (cksm.hexdigest(), _signature(envelope))
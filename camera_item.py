@@ -5,6 +5,7 @@ import os
 import subprocess
 import hashlib
 import Image
+import records
 
 # create exiftool request string
 EXIF_TOOL = "/usr/bin/exiftool"
@@ -28,13 +29,17 @@ for tag in TAGS_TO_GET:
     EXIFTOOL_REQUEST = EXIFTOOL_REQUEST + ' -' + tag
 
 # digital camera items
-class CameraItem:
+class CameraItem(object):
     'class that handles all kind of content (photo, video, audio) generated by a digital camera'
+    # the tags other than the file name are kept in the record of tags, shared with the DB backend
+    __slots__ = ['name', 'tags', 'FileName', 'tags_file', 'content_file', 'aux_files', \
+                '_content_checksum', '_thumbnail_checksum']
 
     # private methods
     def __init__(self, name):
         'initialize the properties of the item'
         self.name = name
+        self.tags = records.TagsRecord()
         for tag in TAGS_TO_GET:
             setattr(self, tag, "")
         self.tags_file = ""
@@ -235,3 +240,10 @@ class CameraItem:
     def move(self, new_dir):
         'moves the item to the directory "new_dir"'
         raise RuntimeError, "method move not implemented yet in the class CameraItem"
+
+def _tag_property(tag):
+    'returns the property of the item that gives access to the tag in its record of tags'
+    return property(lambda item: getattr(item.tags, tag), lambda item, value: item.tags.set(tag, value))
+
+for tag in records.TAG_NAMES:
+    setattr(CameraItem, tag, _tag_property(tag))
@@ -0,0 +1,50 @@
+'calculates the checksums of the multimedia files in-process'
+
+import io
+import hashlib
+import logging
+import scan_profile
+try:
+    from hashlib import blake2b
+except ImportError:
+    try:
+        from pyblake2 import blake2b
+    except ImportError:
+        blake2b = None
+
+KB = 1024
+# algorithm of the checksums of whole files, BLAKE2b if available because it is faster than SHA512
+if blake2b != None:
+    FULL_CHECKSUM_ALGORITHM = 'blake2b'
+else:
+    FULL_CHECKSUM_ALGORITHM = 'sha512'
+
+logger_file = logging.getLogger('AuPhOrg')
+
+# engine that calculates the checksums of whole files
+class ChecksumEngine:
+    'calculates checksums of whole files, reading them into a preallocated buffer'
+
+    def __init__(self, chunk_kbs):
+        'initializes the engine with a buffer of the size of the chunks in which the files are read'
+        self._buffer = bytearray(chunk_kbs * KB)
+        self._view = memoryview(self._buffer)
+
+    def full_checksum(self, path):
+        'returns the checksum of the whole file, read in chunks of the size of the buffer and prefixed by its algorithm'
+        # the prefix avoids comparing checksums of different algorithms
+        if blake2b != None:
+            cksm = blake2b()
+        else:
+            cksm = hashlib.sha512()
+        fd = io.open(path, 'rb', buffering=0)
+        try:
+            while True:
+                n_chunk = fd.readinto(self._view)
+                if not n_chunk:
+                    break
+                cksm.update(self._view[:n_chunk])
+                scan_profile.count_bytes(n_chunk)
+        finally:
+            fd.close()
+        return '%s:%s' % (FULL_CHECKSUM_ALGORITHM, cksm.hexdigest())
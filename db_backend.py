@@ -1,11 +1,30 @@
 'handles the database where the multimedia items are stored'
 
 import os
+import sys
+import time
 import sqlite3
 import re
 import logging
+import contextlib
+import itertools
+import calendar
+import datetime
+import records
+import exif_parser
+import scan_profile
 
 DB_PATH_TEST = os.path.join('/tmp/test_auphorg.db')
+# default limits of the transactions of a batch
+BATCH_RECORDS = 500
+BATCH_SECONDS = 5
+# number of times the transactions of a batch try to commit, each one waiting for the busy timeout, while other
+# connections keep the DB locked
+BATCH_COMMIT_TRIES = 5
+# maximum number of values in a single "IN (...)" clause
+QUERY_CHUNK = 500
+# number of prepared statements kept by every connection for reusing them
+CACHED_STATEMENTS = 256
 
 #DB schema
 SCHEMA_TAGS = 'CREATE TABLE tags (' + \
@@ -19,15 +38,29 @@ SCHEMA_TAGS = 'CREATE TABLE tags (' + \
                                     'TagsList TEXT, ' + \
                                     'HierarchicalSubject TEXT, ' + \
                                     'Subject TEXT, ' + \
-                                    'Keywords TEXT);'
+                                    'Keywords TEXT, ' + \
+                                    'capture_time REAL, ' + \
+                                    'capture_offset INTEGER);'
+TAGS_COLUMNS = records.TAG_NAMES
 SCHEMA_FILES = 'CREATE TABLE files (' + \
                                     'file_id INTEGER PRIMARY KEY ASC, ' + \
                                     'path TEXT UNIQUE, ' + \
-                                    'timestamp TEXT, ' + \
+                                    'timestamp REAL, ' + \
                                     'file_size INTEGER, ' + \
                                     'file_checksum TEXT, ' + \
                                     'content_checksum TEXT, ' + \
-                                    'tags REFERENCES tags(tags_id));'
+                                    'tags REFERENCES tags(tags_id), ' + \
+                                    'full_checksum TEXT, ' + \
+                                    'perceptual_hash TEXT, ' + \
+                                    'content_checksum_version INTEGER, ' + \
+                                    'audio_signature TEXT);'
+# columns added to the tables after their creation, added to the older DBs when connecting to them
+SCHEMA_ADDED_COLUMNS = [('files', 'full_checksum', 'TEXT'), ('files', 'perceptual_hash', 'TEXT'), \
+                        ('files', 'content_checksum_version', 'INTEGER'), ('tags', 'capture_time', 'REAL'), \
+                        ('tags', 'capture_offset', 'INTEGER'), ('files', 'audio_signature', 'TEXT')]
+# tags with the capture time, by preference, in the format "YYYY:MM:DD HH:MM:SS[.ss][+HH:MM|Z]" of exiftool
+CAPTURE_TIME_TAGS = ['DateTimeOriginal', 'CreateDate']
+CAPTURE_TIME_FORMAT = re.compile(r'(\d{4}):(\d{2}):(\d{2}) (\d{2}):(\d{2}):(\d{2})(\.\d+)?(Z|[+-]\d{2}:\d{2})?$')
 SCHEMA_ITEMS = 'CREATE TABLE simple_items (' + \
                                     'item_id INTEGER PRIMARY KEY ASC, ' + \
                                     'name TEXT UNIQUE, ' + \
@@ -38,6 +71,58 @@ SCHEMA_OTHER_FILES = 'CREATE TABLE other_files(' + \
                                     'item REFERENCES simple_items(item_id));'
 SCHEMA_FILE_INDEX = 'CREATE INDEX file_path ON files(path);'
 SCHEMA_ITEM_INDEX = 'CREATE INDEX item_name ON simple_items(name);'
+# tables added after the creation of the schema, created in the older DBs when connecting to them
+SCHEMA_KEYWORDS = 'CREATE TABLE keywords (' + \
+                                    'keyword_id INTEGER PRIMARY KEY ASC, ' + \
+                                    'kind TEXT, ' + \
+                                    'keyword TEXT, ' + \
+                                    'UNIQUE (kind, keyword));'
+# the keyword has the type of its ID, so that the joins with the keywords use the index
+SCHEMA_FILES_KEYWORDS = 'CREATE TABLE files_keywords (' + \
+                                    'keyword INTEGER REFERENCES keywords(keyword_id), ' + \
+                                    'file REFERENCES files(file_id), ' + \
+                                    'UNIQUE (keyword, file));'
+SCHEMA_ADDED_TABLES = [('keywords', SCHEMA_KEYWORDS), ('files_keywords', SCHEMA_FILES_KEYWORDS)]
+# full-text index of the tags, kept in sync with them by triggers, only if SQLite has the FTS5 module
+SEARCH_TAGS = ['Model', 'Software', 'TagsList', 'HierarchicalSubject', 'Subject', 'Keywords']
+SCHEMA_TAGS_SEARCH = 'CREATE VIRTUAL TABLE tags_search USING fts5(' + \
+                                    ', '.join(SEARCH_TAGS) + ', ' + \
+                                    "content='tags', content_rowid='tags_id');"
+SCHEMA_TAGS_SEARCH_TRIGGERS = ['CREATE TRIGGER tags_search_insert AFTER INSERT ON tags BEGIN ' + \
+                                    'INSERT INTO tags_search (rowid, %s) VALUES (new.tags_id, %s); END;' % \
+                                    (', '.join(SEARCH_TAGS), ', '.join(['new.' + tag for tag in SEARCH_TAGS])), \
+                               'CREATE TRIGGER tags_search_delete AFTER DELETE ON tags BEGIN ' + \
+                                    "INSERT INTO tags_search (tags_search, rowid, %s) VALUES ('delete', old.tags_id, %s); END;" % \
+                                    (', '.join(SEARCH_TAGS), ', '.join(['old.' + tag for tag in SEARCH_TAGS])), \
+                               'CREATE TRIGGER tags_search_update AFTER UPDATE ON tags BEGIN ' + \
+                                    "INSERT INTO tags_search (tags_search, rowid, %s) VALUES ('delete', old.tags_id, %s); " % \
+                                    (', '.join(SEARCH_TAGS), ', '.join(['old.' + tag for tag in SEARCH_TAGS])) + \
+                                    'INSERT INTO tags_search (rowid, %s) VALUES (new.tags_id, %s); END;' % \
+                                    (', '.join(SEARCH_TAGS), ', '.join(['new.' + tag for tag in SEARCH_TAGS]))]
+# maximum number of items returned by a search
+SEARCH_LIMIT = 100
+# indexes added after the creation of the schema, created in the older DBs when connecting to them
+SCHEMA_ADDED_INDEXES = ['CREATE INDEX IF NOT EXISTS file_size_checksum ON files(file_size, file_checksum);', \
+                        'CREATE INDEX IF NOT EXISTS file_checksum ON files(file_checksum);', \
+                        'CREATE INDEX IF NOT EXISTS file_content_checksum ON files(content_checksum);', \
+                        'CREATE INDEX IF NOT EXISTS file_keywords ON files_keywords(file);', \
+                        'CREATE INDEX IF NOT EXISTS file_tags ON files(tags);', \
+                        'CREATE INDEX IF NOT EXISTS tags_capture_time ON tags(capture_time);', \
+                        'CREATE INDEX IF NOT EXISTS other_files_item ON other_files(item);', \
+                        'CREATE INDEX IF NOT EXISTS file_audio_signature ON files(audio_signature);']
+# tags whose values are indexed as keywords of the files, and as hierarchical subjects
+KEYWORD_TAGS = ['Subject', 'Keywords']
+SUBJECT_TAGS = ['HierarchicalSubject']
+# separator of the values of the tags with several values, and of the levels of the hierarchical subjects
+TAGS_SEPARATOR = ', '
+SUBJECT_SEPARATOR = '|'
+# checksums of the files that can be used to find duplicates
+DUP_CHECKSUMS = ['file_checksum', 'content_checksum', 'audio_signature']
+# fields of the files given to "store_item", inserted with a single prepared statement together with their tags ID
+ITEM_FILE_FIELDS = ['path', 'timestamp', 'file_size', 'file_checksum', 'content_checksum', 'perceptual_hash', \
+                'content_checksum_version', 'audio_signature']
+SQL_INSERT_FILE = 'INSERT INTO files (%s, tags) VALUES (%s);' % \
+                (', '.join(ITEM_FILE_FIELDS), ', '.join(['?'] * (len(ITEM_FILE_FIELDS) + 1)))
 SCHEMA_ITEMS_VIEW = 'CREATE VIEW items AS ' + \
                                     'SELECT i.name AS name, ' + \
                                     'cf.path AS content_file, ' + \
@@ -49,7 +134,12 @@ SCHEMA_EXTRA_FILES_VIEW = 'CREATE VIEW items_extra_files AS ' + \
                                     'SELECT i.name AS name, ' + \
                                     'group_concat(ef.path,"|") AS extra_files ' + \
                                     'FROM simple_items i, files ef, other_files of ' + \
-                                    'WHERE i.item_id = of.item AND of.file = ef.file_id;'
+                                    'WHERE i.item_id = of.item AND of.file = ef.file_id ' + \
+                                    'GROUP BY i.item_id;'
+# columns whose type changed after the creation of the schema, their tables being rebuilt in the older DBs
+SCHEMA_CHANGED_COLUMNS = [('files', 'timestamp', 'REAL')]
+# views whose definition changed after the creation of the schema, created again in the older DBs
+SCHEMA_CHANGED_VIEWS = [('items_extra_files', SCHEMA_EXTRA_FILES_VIEW)]
 SCHEMA_FULL_ITEMS_VIEW = 'CREATE VIEW full_items AS ' + \
                                     'SELECT i.name AS name, ' + \
                                     'cf.path AS content_file, ' + \
@@ -63,7 +153,7 @@ SCHEMA_FULL_ITEMS_VIEW = 'CREATE VIEW full_items AS ' + \
 logger_file = logging.getLogger('AuPhOrg')
 
 # exceptions
-class ApoDbError:
+class ApoDbError(Exception):
     def __init__(self):
         pass
 
@@ -136,6 +226,17 @@ class ApoDbNoMetadata(ApoDbError):
         logger_file.error(err_msg)
         return err_msg
 
+class ApoDbBadQuery(ApoDbError):
+    def __init__(self, query, reason):
+        super(ApoDbBadQuery, self).__init__()
+        self.query = query
+        self.reason = reason
+
+    def __str__(self):
+        err_msg = 'the search query "%s" is not valid: %s' % (self.query, self.reason)
+        logger_file.error(err_msg)
+        return err_msg
+
 class ApoDbTagsExists(ApoDbError):
     def __init__(self, tags_file, item_name):
         super(ApoDbTagsExists, self).__init__()
@@ -148,6 +249,58 @@ class ApoDbTagsExists(ApoDbError):
         logger_file.error(err_msg)
         return err_msg
 
+# parses the capture time of the tags
+def capture_time(tags):
+    'returns the capture time of the tags as (epoch seconds, offset in minutes), (None, None) if not available'
+    # without time zone offset, the seconds are the ones of the local time as if it were UTC, so that the times
+    # of the same time zone keep their order
+    for tag in CAPTURE_TIME_TAGS:
+        if tags.get(tag) == None:
+            continue
+        time_match = CAPTURE_TIME_FORMAT.match(tags[tag].strip())
+        if time_match == None:
+            continue
+        (year, month, day, hour, minute, second, fraction, offset) = time_match.groups()
+        # the invalid dates, like the "0000:00:00 00:00:00" of some cameras, are discarded
+        try:
+            local_time = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+        except ValueError:
+            continue
+        epoch = calendar.timegm(local_time.timetuple())
+        if fraction != None:
+            epoch += float(fraction)
+        if offset == None:
+            return (epoch, None)
+        if offset == 'Z':
+            return (epoch, 0)
+        offset_minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        if offset[0] == '-':
+            offset_minutes = -offset_minutes
+        return (epoch - offset_minutes * 60, offset_minutes)
+    return (None, None)
+
+# decorators of the public methods that change the DB
+def db_record(method):
+    'makes the changes done by the method a single record, undone as a whole if it fails'
+    def record_method(self, *args, **kwargs):
+        with scan_profile.stage('db.' + method.__name__):
+            with self.record():
+                return method(self, *args, **kwargs)
+    record_method.__name__ = method.__name__
+    record_method.__doc__ = method.__doc__
+    return record_method
+
+def db_records(method):
+    'makes the changes done by the bulk method a single record per element of its first argument'
+    def records_method(self, elements, *args, **kwargs):
+        elements = list(elements)
+        with scan_profile.stage('db.' + method.__name__):
+            with self.record(len(elements)):
+                return method(self, elements, *args, **kwargs)
+    records_method.__name__ = method.__name__
+    records_method.__doc__ = method.__doc__
+    return records_method
+
 # class that handles the interaction with the DB
 class DbConnector:
     'controls the interaction with the program DB'
@@ -166,8 +319,13 @@ class DbConnector:
             db_path = DB_PATH_TEST
         logger_file.debug('connecting to DB %s' % db_path)
         self._db_path = db_path
-        self._photos_db = sqlite3.connect(self._db_path, 30)
+        # the transactions are handled explicitly by "record" and "batch"
+        # the queries are parametrized, so that their prepared statements are reused
+        self._photos_db = sqlite3.connect(self._db_path, 30, isolation_level=None, \
+            cached_statements=CACHED_STATEMENTS)
         self._db_curs = self._photos_db.cursor()
+        self._record_depth = 0
+        self._batch = False
         logger_file.debug('connection to DB established')
         # if database doesn't have the schema yet, create it
         self._db_curs.execute("SELECT name FROM sqlite_master WHERE type='table';")
@@ -175,6 +333,7 @@ class DbConnector:
         if (not (u'files',) in tables) or (not (u'simple_items',) in tables) or (not (u'tags',) in tables):
             logger_file.debug('adding the schema to the DB')
             logger_file.debug('DB tables: %s' % tables)
+            self._db_curs.execute('BEGIN;')
             self._db_curs.execute(SCHEMA_TAGS)
             self._db_curs.execute(SCHEMA_FILES)
             self._db_curs.execute(SCHEMA_ITEMS)
@@ -184,8 +343,9 @@ class DbConnector:
             self._db_curs.execute(SCHEMA_ITEMS_VIEW)
 #            self._db_curs.execute(SCHEMA_FULL_ITEMS_VIEW)
             self._db_curs.execute(SCHEMA_EXTRA_FILES_VIEW)
-            self._photos_db.commit()
+            self._db_curs.execute('COMMIT;')
             logger_file.debug('schema added to the DB')
+        self._update_schema()
 
     def __del__(self):
         'closes the connection to the DB before destroying the object'
@@ -193,6 +353,133 @@ class DbConnector:
         self._photos_db.close()
         logger_file.debug('connection with DB closed')
 
+    def _update_schema(self):
+        'adds to the DB the tables, columns and indexes added to the schema after its creation'
+        self._db_curs.execute("SELECT name FROM sqlite_master WHERE type='table';")
+        tables = [table for (table,) in self._db_curs.fetchall()]
+        missing_tables = [table for (table, _) in SCHEMA_ADDED_TABLES if not table in tables]
+        missing_columns = []
+        for (table, column, column_type) in SCHEMA_ADDED_COLUMNS:
+            self._db_curs.execute('PRAGMA table_info(%s);' % table)
+            if not column in [table_column[1] for table_column in self._db_curs.fetchall()]:
+                missing_columns.append((table, column, column_type))
+        changed_columns = []
+        for (table, column, column_type) in SCHEMA_CHANGED_COLUMNS:
+            self._db_curs.execute('PRAGMA table_info(%s);' % table)
+            if (column, column_type) not in [table_column[1:3] for table_column in self._db_curs.fetchall()]:
+                changed_columns.append((table, column, column_type))
+        self._db_curs.execute("SELECT name FROM sqlite_master WHERE type='index';")
+        indexes = [index for (index,) in self._db_curs.fetchall()]
+        missing_indexes = [index_query for index_query in SCHEMA_ADDED_INDEXES \
+            if not index_query.split(' ')[5] in indexes]
+        changed_views = []
+        for (view, view_schema) in SCHEMA_CHANGED_VIEWS:
+            self._db_curs.execute("SELECT sql FROM sqlite_master WHERE type='view' AND name = ?;", [view])
+            if self._db_curs.fetchone() != (view_schema[:-1],):
+                changed_views.append((view, view_schema))
+        missing_search = (not 'tags_search' in tables) and self._tags_search_available()
+        # the DB is only locked for writing if it must be migrated, so that connecting while others read it works
+        if (len(missing_tables) == 0) and (len(missing_columns) == 0) and (len(changed_columns) == 0) and \
+                (len(missing_indexes) == 0) and (len(changed_views) == 0) and (not missing_search):
+            return
+        self._db_curs.execute('BEGIN IMMEDIATE;')
+        try:
+            for (table, table_schema) in SCHEMA_ADDED_TABLES:
+                if table in missing_tables:
+                    logger_file.info('adding table %s to the DB' % table)
+                    self._db_curs.execute(table_schema)
+            for (table, column, column_type) in missing_columns:
+                logger_file.info('adding column %s to the table %s of the DB' % (column, table))
+                self._db_curs.execute('ALTER TABLE %s ADD COLUMN %s %s;' % (table, column, column_type))
+            if ('files', 'timestamp', 'REAL') in changed_columns:
+                self._retype_file_timestamps()
+            for index_query in missing_indexes:
+                self._db_curs.execute(index_query)
+            for (view, view_schema) in changed_views:
+                logger_file.info('updating view %s of the DB' % view)
+                self._db_curs.execute('DROP VIEW IF EXISTS %s;' % view)
+                self._db_curs.execute(view_schema)
+            # the files added before the keywords table existed get their keywords from their tags
+            if 'files_keywords' in missing_tables:
+                self._index_stored_keywords()
+            if missing_search:
+                self._add_tags_search()
+            if ('tags', 'capture_time', 'REAL') in missing_columns:
+                self._parse_stored_capture_times()
+        except:
+            self._db_curs.execute('ROLLBACK;')
+            raise
+        self._db_curs.execute('COMMIT;')
+
+    def _retype_file_timestamps(self):
+        'rebuilds the table of the files with their timestamps as numbers, instead of as text'
+        # SQLite cannot change the type of a column, so the files are copied to a new table, dropping the views
+        # that use it until it replaces the old one
+        logger_file.info('storing the timestamps of the files of the DB as numbers')
+        self._db_curs.execute('PRAGMA table_info(files);')
+        columns = [table_column[1] for table_column in self._db_curs.fetchall()]
+        self._db_curs.execute('DROP VIEW IF EXISTS items;')
+        self._db_curs.execute('DROP VIEW IF EXISTS items_extra_files;')
+        self._db_curs.execute(SCHEMA_FILES.replace('CREATE TABLE files (', 'CREATE TABLE files_retyped ('))
+        self._db_curs.execute('INSERT INTO files_retyped (%s) SELECT %s FROM files;' % (', '.join(columns), \
+            ', '.join([{'timestamp': 'CAST(timestamp AS REAL)'}.get(column, column) for column in columns])))
+        self._db_curs.execute('DROP TABLE files;')
+        self._db_curs.execute('ALTER TABLE files_retyped RENAME TO files;')
+        self._db_curs.execute(SCHEMA_FILE_INDEX)
+        self._db_curs.execute(SCHEMA_ITEMS_VIEW)
+        self._db_curs.execute(SCHEMA_EXTRA_FILES_VIEW)
+
+    def _tags_search_available(self):
+        'returns True if SQLite has the FTS5 module of the full-text index of the tags'
+        # the module is tried in the temporary DB of the connection, which doesn't lock the DB
+        try:
+            self._db_curs.execute('CREATE VIRTUAL TABLE temp.tags_search_probe USING fts5(tags);')
+        except sqlite3.OperationalError, err:
+            logger_file.warning('the tags cannot be searched, SQLite has no FTS5 module: %s' % str(err))
+            return False
+        self._db_curs.execute('DROP TABLE temp.tags_search_probe;')
+        return True
+
+    def _add_tags_search(self):
+        'adds the full-text index of the tags, filling it with the tags already in the DB'
+        self._db_curs.execute(SCHEMA_TAGS_SEARCH)
+        logger_file.info('adding the full-text index of the tags to the DB')
+        for trigger_query in SCHEMA_TAGS_SEARCH_TRIGGERS:
+            self._db_curs.execute(trigger_query)
+        self._db_curs.execute("INSERT INTO tags_search (tags_search) VALUES ('rebuild');")
+
+    def _parse_stored_capture_times(self):
+        'sets the capture time of the tags already in the DB'
+        self._db_curs.execute('SELECT tags_id, %s FROM tags;' % ', '.join(CAPTURE_TIME_TAGS))
+        rows = []
+        for row in self._db_curs.fetchall():
+            rows.append(capture_time(dict(zip(CAPTURE_TIME_TAGS, row[1:]))) + (row[0],))
+        self._db_curs.executemany('UPDATE tags SET capture_time = ?, capture_offset = ? WHERE tags_id = ?;', rows)
+
+    def _index_stored_keywords(self):
+        'adds the keywords of the tags of the files already in the DB'
+        self._db_curs.execute('SELECT f.file_id, %s FROM files f JOIN tags t ON f.tags = t.tags_id;' % \
+            ', '.join(['t.' + tag for tag in KEYWORD_TAGS + SUBJECT_TAGS]))
+        for row in self._db_curs.fetchall():
+            self._add_keywords(row[0], dict(zip(KEYWORD_TAGS + SUBJECT_TAGS, row[1:])))
+
+    def _add_keywords(self, file_id, tags):
+        'adds the keywords and hierarchical subjects of the given tags to the file'
+        keywords = set()
+        for (kind, kind_tags) in (('keyword', KEYWORD_TAGS), ('subject', SUBJECT_TAGS)):
+            for tag in kind_tags:
+                if tags.get(tag) == None:
+                    continue
+                for keyword in tags[tag].split(TAGS_SEPARATOR):
+                    if keyword.strip() != '':
+                        keywords.add((kind, keyword.strip()))
+        if len(keywords) == 0:
+            return
+        self._db_curs.executemany('INSERT OR IGNORE INTO keywords (kind, keyword) VALUES (?, ?);', keywords)
+        self._db_curs.executemany('INSERT OR IGNORE INTO files_keywords (keyword, file) ' + \
+            'SELECT keyword_id, ? FROM keywords WHERE kind = ? AND keyword = ?;', \
+            [(file_id, kind, keyword) for (kind, keyword) in keywords])
+
     def _insert_query(self, table, values):
         'generates an SQL query for inserting "values" into "table"'
         logger_file.debug('adding an entry to table %s with values %s' % (table, str(values)))
@@ -240,43 +527,99 @@ class DbConnector:
             (sql_query, query_values) = self._update_query(table, values, element_filters)
         try:
             self._db_curs.execute(sql_query, query_values)
-            self._photos_db.commit()
         except sqlite3.IntegrityError, err:
-            dup_field = re.match(r'column (.*) is not unique', str(err))
-            if (dup_field == None):
+            err_field = self._dup_field(err)
+            if (err_field == None):
                 raise
             else:
-                err_field = dup_field.group(1)
                 item_type = table[:-1]
                 raise ApoDbDupUniq(item_type, err_field, values[err_field])
         logger_file.debug('done editing entry')
         return self._db_curs.lastrowid
 
-    def _get_rich_file_tags(self, path):
-        'gets the tags of a rich file'
-        logger_file.debug('getting tags of rich file %s', path)
-        self._db_curs.execute('SELECT t.* FROM tags t, files f WHERE t.tags_id = f.tags AND path = ?;', [path])
-        tags_list = self._db_curs.fetchone()
-        if tags_list == None:
-            raise ApoDbMissingTags(path)
-        tags = {}
-        tags['Model'] = tags_list[1]
-        tags['Software'] = tags_list[2]
-        tags['DateTimeOriginal'] = tags_list[3]
-        tags['CreateDate'] = tags_list[4]
-        tags['ImageWidth'] = tags_list[5]
-        tags['ImageHeight'] = tags_list[6]
-        tags['TagsList'] = tags_list[7]
-        tags['HierarchicalSubject'] = tags_list[8]
-        tags['Subject'] = tags_list[9]
-        tags['Keywords'] = tags_list[10]
-        logger_file.debug('tags of rich file obtained')
-        return tags
+    def _edit_elements(self, table, fields, rows):
+        'inserts the "rows" with the values of "fields" into "table" at once, explicitly reporting duplications'
+        logger_file.debug('adding %d entries to table %s' % (len(rows), table))
+        sql_query = 'INSERT INTO %s (%s) VALUES (%s);' % \
+            (table, ', '.join(fields), ', '.join(['?'] * len(fields)))
+        self._db_curs.execute('SAVEPOINT edit_elements;')
+        try:
+            self._db_curs.executemany(sql_query, rows)
+        except sqlite3.IntegrityError, err:
+            err_field = self._dup_field(err)
+            if (err_field == None):
+                raise
+            # insert the rows one by one to find out the duplicated value
+            self._db_curs.execute('ROLLBACK TO edit_elements;')
+            for row in rows:
+                try:
+                    self._db_curs.execute(sql_query, row)
+                except sqlite3.IntegrityError:
+                    raise ApoDbDupUniq(table[:-1], err_field, row[fields.index(err_field)])
+            raise
+        finally:
+            self._db_curs.execute('RELEASE edit_elements;')
+        logger_file.debug('done adding entries')
+
+    def _dup_field(self, err):
+        'returns the field whose uniqueness was violated according to the error, None if not a duplication'
+        dup_field = re.match(r'column (.*) is not unique', str(err))
+        if dup_field == None:
+            dup_field = re.match(r'UNIQUE constraint failed: \w+\.(\w+)', str(err))
+        if dup_field == None:
+            return None
+        return dup_field.group(1)
+
+    def _file_ids(self, paths):
+        'returns a dictionary with the IDs of the given files'
+        file_ids = {}
+        for index in range(0, len(paths), QUERY_CHUNK):
+            chunk = paths[index:index + QUERY_CHUNK]
+            self._db_curs.execute('SELECT path, file_id FROM files WHERE path IN (%s);' % \
+                ', '.join(['?'] * len(chunk)), chunk)
+            file_ids.update(self._db_curs.fetchall())
+        return file_ids
+
+    def _items_files(self, names):
+        'returns a dictionary with the ID, the content file ID and the tags file ID of the given items'
+        items_files = {}
+        for index in range(0, len(names), QUERY_CHUNK):
+            chunk = names[index:index + QUERY_CHUNK]
+            self._db_curs.execute('SELECT name, item_id, content_file, tags_file FROM simple_items ' + \
+                'WHERE name IN (%s);' % ', '.join(['?'] * len(chunk)), chunk)
+            for (name, item_id, content_file, tags_file) in self._db_curs.fetchall():
+                items_files[name] = (item_id, content_file, tags_file)
+        return items_files
+
+    def _commit_batch(self):
+        'commits the current transaction of the batch, trying again while the DB is locked by other connections'
+        # a transaction whose commit fails because the DB is busy is still active, so it can be committed later
+        for commit_try in range(1, BATCH_COMMIT_TRIES + 1):
+            try:
+                self._db_curs.execute('COMMIT;')
+                return
+            except sqlite3.OperationalError, err:
+                if commit_try == BATCH_COMMIT_TRIES:
+                    raise
+                logger_file.warning('batch not committed (%s), trying again' % str(err))
+
+    def _new_transaction(self):
+        'commits the current transaction of the batch and starts a new one'
+        self._commit_batch()
+        self._db_curs.execute('BEGIN IMMEDIATE;')
+        self._batch_records = 0
+        self._batch_start = time.time()
+
+    def _tags_values(self, tags):
+        'returns the values of the tags row of the given tags, including their parsed capture time'
+        values = dict(tags)
+        (values['capture_time'], values['capture_offset']) = capture_time(tags)
+        return values
 
     def _add_tags(self, tags):
         'adds some metadata to the DB'
         logger_file.debug('adding item tags')
-        rowid = self._edit_element('tags', tags)
+        rowid = self._edit_element('tags', self._tags_values(tags))
         logger_file.debug('item tags successfully added')
         return rowid
 
@@ -284,7 +627,207 @@ class DbConnector:
     # Public methods
     #
 
-    def add_poor_file(self, path, timestamp, file_size, file_checksum, content_checksum):
+    @contextlib.contextmanager
+    def record(self, n_records = 1):
+        'makes the changes done inside the "with" block a record, undone as a whole if it fails'
+        # outside batches the outermost record is a transaction, reserving the DB from its start to avoid
+        # deadlocks with other writers
+        transaction = (self._record_depth == 0) and (not self._batch)
+        if transaction:
+            self._db_curs.execute('BEGIN IMMEDIATE;')
+        else:
+            self._db_curs.execute('SAVEPOINT record;')
+        self._record_depth += 1
+        try:
+            yield
+        except:
+            (exception_type, exception_value, exception_traceback) = sys.exc_info()
+            self._record_depth -= 1
+            if transaction:
+                self._db_curs.execute('ROLLBACK;')
+            else:
+                self._db_curs.execute('ROLLBACK TO record;')
+                self._db_curs.execute('RELEASE record;')
+            raise exception_type, exception_value, exception_traceback
+        self._record_depth -= 1
+        if transaction:
+            self._db_curs.execute('COMMIT;')
+        else:
+            self._db_curs.execute('RELEASE record;')
+        # only the outermost records are counted in the batch
+        if self._batch and (self._record_depth == 0):
+            self._batch_records += n_records
+            if (self._batch_records >= self._batch_max_records) or \
+                    (time.time() - self._batch_start >= self._batch_max_seconds):
+                logger_file.debug('committing batch of %d records' % self._batch_records)
+                self._new_transaction()
+
+    @contextlib.contextmanager
+    def batch(self, max_records = BATCH_RECORDS, max_seconds = BATCH_SECONDS):
+        'groups the records of the "with" block in transactions of "max_records" records or "max_seconds" seconds'
+        # the uncommitted records are undone if an exception leaves the block
+        if self._batch:
+            # nested batches are part of the outer one
+            yield self
+            return
+        logger_file.debug('starting batch')
+        self._batch = True
+        self._batch_max_records = max_records
+        self._batch_max_seconds = max_seconds
+        self._batch_records = 0
+        self._batch_start = time.time()
+        self._db_curs.execute('BEGIN IMMEDIATE;')
+        try:
+            yield self
+        except:
+            (exception_type, exception_value, exception_traceback) = sys.exc_info()
+            self._batch = False
+            self._db_curs.execute('ROLLBACK;')
+            logger_file.debug('batch rolled back')
+            raise exception_type, exception_value, exception_traceback
+        self._batch = False
+        self._commit_batch()
+        logger_file.debug('batch committed')
+
+    def commit(self):
+        'commits the pending records of the batch'
+        if self._batch and (self._record_depth == 0) and (self._batch_records > 0):
+            logger_file.debug('committing batch of %d records' % self._batch_records)
+            self._new_transaction()
+
+    def get_files_state(self, root):
+        'returns a dictionary with the timestamp, size and checksum version of the files of the DB under "root"'
+        logger_file.debug('getting the state of the files under %s' % root)
+        prefix = os.path.join(root, '')
+        if not isinstance(prefix, unicode):
+            prefix = unicode(prefix, 'utf-8')
+        # all the paths starting with the prefix, using the index of the paths
+        self._db_curs.execute('SELECT path, timestamp, file_size, content_checksum_version FROM files ' + \
+            'WHERE path >= ? AND path < ?;', [prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)])
+        files_state = {}
+        for (path, timestamp, file_size, checksum_version) in self._db_curs:
+            files_state[path] = (timestamp, file_size, checksum_version)
+        logger_file.debug('state of %d files obtained' % len(files_state))
+        return files_state
+
+    def get_files(self, root):
+        'yields the records of the files of the DB under "root", sorted by path'
+        prefix = os.path.join(root, '')
+        if not isinstance(prefix, unicode):
+            prefix = unicode(prefix, 'utf-8')
+        cur = self._photos_db.cursor()
+        cur.execute('SELECT path, timestamp, file_size, file_checksum, content_checksum FROM files ' + \
+            'WHERE path >= ? AND path < ? ORDER BY path;', [prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)])
+        for row in cur:
+            yield records.FileRecord(*row)
+
+    def get_dup_candidates(self):
+        'yields the lists of (path, full_checksum) of the files with the same size and checksum of their start'
+        # the sizes with a single file discard most of the files, using the index of the sizes and checksums
+        logger_file.debug('getting the candidates to duplicated files')
+        cur = self._photos_db.cursor()
+        cur.execute('SELECT f.file_size, f.file_checksum, f.path, f.full_checksum FROM files f JOIN ' + \
+            '(SELECT file_size, file_checksum FROM files WHERE file_size IN ' + \
+                '(SELECT file_size FROM files GROUP BY file_size HAVING COUNT(*) > 1) ' + \
+            'GROUP BY file_size, file_checksum HAVING COUNT(*) > 1) d ' + \
+            'ON f.file_size = d.file_size AND f.file_checksum = d.file_checksum ' + \
+            'ORDER BY f.file_size, f.file_checksum;')
+        for (_, candidates) in itertools.groupby(cur, lambda row: row[0:2]):
+            yield [(path, full_checksum) for (_, _, path, full_checksum) in candidates]
+
+    def get_duplicates(self, checksum = 'content_checksum'):
+        'yields the checksums shared by several files of the DB, as (checksum, paths), using the given checksum'
+        if not checksum in DUP_CHECKSUMS:
+            raise ValueError, 'the duplicates cannot be found using %s' % checksum
+        logger_file.debug('getting the files with the same %s' % checksum)
+        # the files are read sorted from the index of the checksum, so that they are grouped as they come
+        cur = self._photos_db.cursor()
+        cur.execute(('SELECT %s, path FROM files WHERE %s IN ' + \
+            '(SELECT %s FROM files WHERE %s IS NOT NULL AND %s != \'\' GROUP BY %s HAVING COUNT(*) > 1) ' + \
+            'ORDER BY %s;') % ((checksum,) * 7))
+        for (dup_checksum, duplicates) in itertools.groupby(cur, lambda row: row[0]):
+            yield (dup_checksum, [path for (_, path) in duplicates])
+
+    def get_items_by_keyword(self, keyword):
+        'returns the sorted names of the items whose tags file has the given keyword'
+        # the tags are stored decoded as the output of exiftool, and so is the keyword
+        keyword = exif_parser.legacy_value(keyword)
+        self._db_curs.execute('SELECT DISTINCT i.name FROM keywords k ' + \
+            'JOIN files_keywords fk ON fk.keyword = k.keyword_id ' + \
+            'JOIN simple_items i ON i.tags_file = fk.file ' + \
+            'WHERE k.kind = ? AND k.keyword = ? ORDER BY i.name;', ['keyword', keyword])
+        return [name for (name,) in self._db_curs.fetchall()]
+
+    def get_items_by_subject(self, subject):
+        'returns the sorted names of the items whose tags file has the given hierarchical subject or one under it'
+        # the subjects under the given one are the range of the ones starting with it and the separator
+        subject = exif_parser.legacy_value(subject)
+        prefix = subject + SUBJECT_SEPARATOR
+        self._db_curs.execute('SELECT DISTINCT i.name FROM keywords k ' + \
+            'JOIN files_keywords fk ON fk.keyword = k.keyword_id ' + \
+            'JOIN simple_items i ON i.tags_file = fk.file ' + \
+            'WHERE k.kind = ? AND (k.keyword = ? OR (k.keyword >= ? AND k.keyword < ?)) ORDER BY i.name;', \
+            ['subject', subject, prefix, prefix[:-1] + unichr(ord(prefix[-1]) + 1)])
+        return [name for (name,) in self._db_curs.fetchall()]
+
+    def search(self, query, limit = SEARCH_LIMIT, fts_syntax = False):
+        'returns the names of the items whose tags match the full-text query, the most relevant first'
+        # the words of the query must all be in the tags, unless "fts_syntax" and then it has the FTS5 syntax
+        if not fts_syntax:
+            # every word is an FTS5 string, so that its punctuation is not taken as operators
+            query = ' '.join(['"%s"' % word.replace('"', '""') for word in query.split()])
+            if query == '':
+                return []
+        # the tags are indexed decoded as the output of exiftool, and so is the query, whose operators are ASCII
+        query = exif_parser.legacy_value(query)
+        # the "+" removes the type of the IDs, so that the indexes of the untyped references are used
+        try:
+            self._db_curs.execute('SELECT i.name FROM tags_search s ' + \
+                'JOIN files f ON f.tags = +s.rowid ' + \
+                'JOIN simple_items i ON i.tags_file = +f.file_id ' + \
+                'WHERE tags_search MATCH ? ORDER BY bm25(tags_search) LIMIT ?;', [query, limit])
+        except sqlite3.OperationalError, err:
+            raise ApoDbBadQuery(query, str(err))
+        return [name for (name,) in self._db_curs.fetchall()]
+
+    def get_items_by_capture_time(self, start, end):
+        'returns the (name, capture time, offset) of the items captured from "start" to before "end", by time'
+        # the times are epoch seconds, the ones without time zone offset are of the local time as if it were UTC
+        # the "+" removes the type of the IDs, so that the indexes of the untyped references are used
+        self._db_curs.execute('SELECT i.name, t.capture_time, t.capture_offset FROM tags t ' + \
+            'JOIN files f ON f.tags = +t.tags_id ' + \
+            'JOIN simple_items i ON i.tags_file = +f.file_id ' + \
+            'WHERE t.capture_time >= ? AND t.capture_time < ? ORDER BY t.capture_time;', [start, end])
+        return self._db_curs.fetchall()
+
+    def get_perceptual_hashes(self):
+        'yields the (path, perceptual_hash) of the files of the DB with a perceptual hash'
+        cur = self._photos_db.cursor()
+        cur.execute('SELECT path, perceptual_hash FROM files WHERE perceptual_hash IS NOT NULL;')
+        for file_hash in cur:
+            yield file_hash
+
+    def get_perceptual_hash(self, path):
+        'returns the perceptual hash of the file in the DB, None if it is not in the DB or has no hash'
+        self._db_curs.execute('SELECT perceptual_hash FROM files WHERE path = ?;', [path])
+        result = self._db_curs.fetchone()
+        if result == None:
+            return None
+        return result[0]
+
+    def side_path(self, suffix):
+        'returns the path of the file with the given suffix stored next to the DB'
+        return self._db_path + suffix
+
+    def get_file_state(self, path):
+        'returns the timestamp, size and checksum version of the file in the DB, None if it is not in the DB'
+        self._db_curs.execute('SELECT timestamp, file_size, content_checksum_version FROM files WHERE path = ?;', \
+            [path])
+        return self._db_curs.fetchone()
+
+    @db_record
+    def add_poor_file(self, path, timestamp, file_size, file_checksum, content_checksum, perceptual_hash = None, \
+            content_checksum_version = None, audio_signature = None):
         'adds a file without metadata to the DB'
         logger_file.debug('adding poor file %s', path)
         self._edit_element('files', {\
@@ -292,20 +835,28 @@ class DbConnector:
             'timestamp': timestamp, \
             'file_size': file_size, \
             'file_checksum': file_checksum, \
-            'content_checksum': content_checksum})
+            'content_checksum': content_checksum, \
+            'perceptual_hash': perceptual_hash, \
+            'content_checksum_version': content_checksum_version, \
+            'audio_signature': audio_signature})
         logger_file.debug('poor file added')
 
-    def add_rich_file(self, path, timestamp, file_size, file_checksum, image_checksum, tags):
+    @db_record
+    def add_rich_file(self, path, timestamp, file_size, file_checksum, image_checksum, tags, perceptual_hash = None, \
+            content_checksum_version = None):
         'adds a file with metadata to the DB'
         logger_file.debug('adding rich file %s', path)
         tags_index = self._add_tags(tags)
-        self._edit_element('files', { \
+        file_id = self._edit_element('files', { \
             'path': path, \
             'timestamp': timestamp, \
             'file_size': file_size, \
             'file_checksum': file_checksum, \
             'content_checksum': image_checksum, \
-            'tags': tags_index})
+            'tags': tags_index, \
+            'perceptual_hash': perceptual_hash, \
+            'content_checksum_version': content_checksum_version})
+        self._add_keywords(file_id, tags)
         logger_file.debug('rich file added')
 
     def file_exists(self, path):
@@ -321,6 +872,35 @@ class DbConnector:
             logger_file.debug("file %s already exists in the DB" % path)
             return True
 
+    @db_record
+    def update_file(self, path, timestamp, file_size, file_checksum, content_checksum, tags = None, \
+            perceptual_hash = None, content_checksum_version = None, audio_signature = None):
+        'updates a file of the DB that changed since it was added, together with its tags if given'
+        logger_file.debug('updating file %s', path)
+        # the checksum of the whole file is calculated again when required
+        values = {'timestamp': timestamp, \
+            'file_size': file_size, \
+            'file_checksum': file_checksum, \
+            'content_checksum': content_checksum, \
+            'full_checksum': None, \
+            'perceptual_hash': perceptual_hash, \
+            'content_checksum_version': content_checksum_version, \
+            'audio_signature': audio_signature}
+        if tags != None:
+            self._db_curs.execute('SELECT tags FROM files WHERE path = ?;', [path])
+            result = self._db_curs.fetchone()
+            if (result == None) or (result[0] == None):
+                values['tags'] = self._add_tags(tags)
+            else:
+                self._edit_element('tags', self._tags_values(tags), {'tags_id': result[0]})
+        self._edit_element('files', values, {'path': path})
+        if tags != None:
+            file_id = self._file_ids([path])[path]
+            self._db_curs.execute('DELETE FROM files_keywords WHERE file = ?;', [file_id])
+            self._add_keywords(file_id, tags)
+        logger_file.debug('file updated')
+
+    @db_record
     def add_item(self, name, force):
         'adds a multimedia item to the DB'
         logger_file.debug('adding item %s' % name)
@@ -343,6 +923,7 @@ class DbConnector:
         self._lock.release()
         logger_file.debug('lock released')
 
+    @db_record
     def add_item_content(self, name, content_file):
         'adds a content file to a multimedia item into the DB'
         logger_file.debug('adding to item %s the file %s as its content file' % (name, content_file))
@@ -352,7 +933,7 @@ class DbConnector:
             raise ApoDbContentExists(content_file, name)
         # add the content file to the item
         cur = self._db_curs
-        cur.execute('SELECT file_id FROM files WHERE path = "%s";' % content_file)
+        cur.execute('SELECT file_id FROM files WHERE path = ?;', [content_file])
         try:
             content_file_id = cur.fetchone()[0]
         except TypeError:
@@ -360,6 +941,7 @@ class DbConnector:
         self._edit_element('simple_items', {'content_file': content_file_id}, {'name': name})
         logger_file.debug('item added')
 
+    @db_record
     def add_item_tags(self, name, tags_file):
         'adds a tags file to a multimedia item into the DB'
         logger_file.debug('adding to item %s the file %s as its metadata file' % (name, tags_file))
@@ -369,7 +951,7 @@ class DbConnector:
             raise ApoDbTagsExists(tags_file, name)
         # add the tags file to the item
         cur = self._db_curs
-        cur.execute('SELECT file_id FROM files WHERE path = "%s";' % tags_file)
+        cur.execute('SELECT file_id FROM files WHERE path = ?;', [tags_file])
         try:
             tags_file_id = cur.fetchone()[0]
         except TypeError:
@@ -377,17 +959,18 @@ class DbConnector:
         self._edit_element('simple_items', {'tags_file': tags_file_id}, {'name': name})
         logger_file.debug('item added')
 
+    @db_record
     def add_extra_file(self, file_path, item_name):
         'adds a relationship with an extra file to the DB'
         logger_file.debug('extending item %s by adding the extra file %s' % (item_name, file_path))
         cur = self._db_curs
-        cur.execute('SELECT file_id FROM files WHERE path = "%s";' % file_path)
+        cur.execute('SELECT file_id FROM files WHERE path = ?;', [file_path])
         try:
             file_id = cur.fetchone()[0]
         except TypeError:
             raise IndexError, "trying to a associate the unknown file %s to the ' + \
                 'item %s in an 'other file' relationship!" % (file_path, item_name)
-        cur.execute('SELECT item_id FROM simple_items WHERE name = "%s";' % item_name)
+        cur.execute('SELECT item_id FROM simple_items WHERE name = ?;', [item_name])
         try:
             item_id = cur.fetchone()[0]
         except TypeError:
@@ -398,24 +981,236 @@ class DbConnector:
             'item': item_id})
         logger_file.debug('item extended with extra file')
 
+    def _insert_file(self, item_file):
+        'adds the file given as a dictionary with its fields and tags, returning its ID'
+        values = [item_file.get(field) for field in ITEM_FILE_FIELDS]
+        if item_file['tags'] != None:
+            values.append(self._add_tags(item_file['tags']))
+        else:
+            values.append(None)
+        try:
+            self._db_curs.execute(SQL_INSERT_FILE, values)
+        except sqlite3.IntegrityError, err:
+            err_field = self._dup_field(err)
+            if err_field == None:
+                raise
+            raise ApoDbDupUniq('file', err_field, item_file[err_field])
+        file_id = self._db_curs.lastrowid
+        if item_file['tags'] != None:
+            self._add_keywords(file_id, item_file['tags'])
+        return file_id
+
+    @db_record
+    def store_item(self, name, content_file = None, tags_file = None, extra_files = None, update = False):
+        'adds or extends an item with its files, returning the paths of the files stored'
+        # the files are dictionaries with the fields of the files table and their tags, the ones already in the DB
+        # are only updated if "update", and the new ones that find their role taken become extra files
+        logger_file.debug('storing item %s' % name)
+        if extra_files == None:
+            extra_files = []
+        item_files = [item_file for item_file in [content_file, tags_file] + extra_files if item_file != None]
+        cur = self._db_curs
+        cur.execute('INSERT OR IGNORE INTO simple_items (name) VALUES (?);', [name])
+        cur.execute('SELECT item_id, content_file, tags_file FROM simple_items WHERE name = ?;', [name])
+        (item_id, item_content, item_tags) = cur.fetchone()
+        file_ids = self._file_ids([item_file['path'] for item_file in item_files])
+        stored = []
+        new_ids = {}
+        for item_file in item_files:
+            path = item_file['path']
+            if not path in file_ids:
+                new_ids[path] = self._insert_file(item_file)
+                stored.append(path)
+            elif update:
+                self.update_file(path, item_file['timestamp'], item_file['file_size'], item_file['file_checksum'], \
+                    item_file['content_checksum'], item_file['tags'], item_file.get('perceptual_hash'), \
+                    item_file.get('content_checksum_version'), item_file.get('audio_signature'))
+                stored.append(path)
+            else:
+                logger_file.warning('file already exists, not adding it: %s' % path)
+        extra_ids = [new_ids[item_file['path']] for item_file in extra_files if item_file['path'] in new_ids]
+        if (content_file != None) and (content_file['path'] in new_ids):
+            if (item_content == None) or (item_content == item_tags):
+                item_content = new_ids[content_file['path']]
+            else:
+                logger_file.warning('item %s already has a content file, adding %s as extra file' % \
+                    (name, content_file['path']))
+                extra_ids.append(new_ids[content_file['path']])
+        if (tags_file != None) and (tags_file['path'] in new_ids):
+            if item_tags == None:
+                item_tags = new_ids[tags_file['path']]
+            else:
+                logger_file.warning('item %s already has a tags file, adding %s as extra file' % \
+                    (name, tags_file['path']))
+                extra_ids.append(new_ids[tags_file['path']])
+        cur.execute('UPDATE simple_items SET content_file = ?, tags_file = ? WHERE item_id = ?;', \
+            [item_content, item_tags, item_id])
+        if len(extra_ids) > 0:
+            cur.executemany('INSERT INTO other_files (file, item) VALUES (?, ?);', \
+                [(file_id, item_id) for file_id in extra_ids])
+        logger_file.debug('item stored with %d files' % len(stored))
+        return stored
+
     def get_item(self, item_name):
         'returns the specified item'
         logger_file.debug('getting item %s' % item_name)
-        self._db_curs.execute('SELECT * FROM items WHERE name = ?;', [item_name])
-        result = self._db_curs.fetchone()
-        if result == None:
-            logger_file.debug("item %s doesn't exist yet" % item_name)
-            return None
-        (item_name, content_file, tags_file) = result
-        if (tags_file != None):
-            tags = self._get_rich_file_tags(tags_file)
-        else:
+        for item in self.get_items([item_name]):
+            logger_file.debug('item obtained')
             tags = None
-        if (content_file == None) and (tags_file != None):
-            content_file = tags_file
-        self._db_curs.execute('SELECT * FROM items_extra_files WHERE name = ?;', [item_name])
-        extra_files = self._db_curs.fetchone()
-        if extra_files != None:
-            extra_files = extra_files[1].split('|')
-        logger_file.debug('item obtained')
-        return (tags, content_file, tags_file, extra_files)
+            if item.tags != None:
+                tags = item.tags.as_dict()
+            return (tags, item.content_file, item.tags_file, item.extra_files)
+        logger_file.debug("item %s doesn't exist yet" % item_name)
+        return None
+
+    def _items_rows(self, items_query, query_values):
+        'yields the records of the items selected by the query on "simple_items i"'
+        cur = self._photos_db.cursor()
+        cur.execute('SELECT i.item_id, i.name, cf.path, tf.path, t.tags_id, %s FROM simple_items i ' % \
+            ', '.join(['t.' + tag for tag in TAGS_COLUMNS]) + \
+            'LEFT JOIN files cf ON cf.file_id = i.content_file ' + \
+            'LEFT JOIN files tf ON tf.file_id = i.tags_file ' + \
+            'LEFT JOIN tags t ON t.tags_id = tf.tags ' + items_query, query_values)
+        while True:
+            rows = cur.fetchmany(QUERY_CHUNK)
+            if len(rows) == 0:
+                break
+            # the extra files of all the items of the chunk are obtained at once
+            item_ids = [row[0] for row in rows]
+            extra_files = {}
+            self._db_curs.execute('SELECT of.item, ef.path FROM other_files of ' + \
+                'JOIN files ef ON ef.file_id = of.file WHERE of.item IN (%s);' % \
+                ', '.join(['?'] * len(item_ids)), item_ids)
+            for (item_id, path) in self._db_curs.fetchall():
+                extra_files.setdefault(item_id, []).append(path)
+            for row in rows:
+                (item_id, name, content_file, tags_file, tags_id) = row[0:5]
+                tags = None
+                if tags_file != None:
+                    if tags_id == None:
+                        raise ApoDbMissingTags(tags_file)
+                    tags = records.TagsRecord(dict(zip(TAGS_COLUMNS, row[5:])))
+                    if content_file == None:
+                        content_file = tags_file
+                yield records.ItemRecord(name, tags, content_file, tags_file, extra_files.get(item_id))
+
+    def get_items(self, items = None):
+        'yields the records of the items with the given names, without building them all in memory'
+        # if "items" is a string, the items whose name starts with it, sorted by name, and if None all of them
+        if items == None:
+            items = u''
+        if isinstance(items, basestring):
+            if items == u'':
+                for item in self._items_rows('ORDER BY i.name;', []):
+                    yield item
+                return
+            prefix_end = items[:-1] + unichr(ord(items[-1]) + 1)
+            for item in self._items_rows('WHERE i.name >= ? AND i.name < ? ORDER BY i.name;', [items, prefix_end]):
+                yield item
+            return
+        # the names are queried in chunks, so that they can come from an iterator
+        items = iter(items)
+        while True:
+            names = list(itertools.islice(items, QUERY_CHUNK))
+            if len(names) == 0:
+                break
+            for item in self._items_rows('WHERE i.name IN (%s);' % ', '.join(['?'] * len(names)), names):
+                yield item
+
+    #
+    # Bulk methods, each element of the first argument is a record of the batch
+    #
+
+    @db_records
+    def add_poor_files(self, files):
+        'adds the given files without metadata, as (path, timestamp, file_size, file_checksum, content_checksum)'
+        logger_file.debug('adding %d poor files' % len(files))
+        self._edit_elements('files', ['path', 'timestamp', 'file_size', 'file_checksum', 'content_checksum'], \
+            files)
+        logger_file.debug('poor files added')
+
+    @db_records
+    def add_rich_files(self, files):
+        'adds the given files with metadata, as (path, timestamp, file_size, file_checksum, image_checksum, tags)'
+        logger_file.debug('adding %d rich files' % len(files))
+        files_rows = []
+        for (path, timestamp, file_size, file_checksum, image_checksum, tags) in files:
+            tags_index = self._add_tags(tags)
+            files_rows.append((path, timestamp, file_size, file_checksum, image_checksum, tags_index))
+        self._edit_elements('files', \
+            ['path', 'timestamp', 'file_size', 'file_checksum', 'content_checksum', 'tags'], files_rows)
+        file_ids = self._file_ids([path for (path, _, _, _, _, _) in files])
+        for (path, _, _, _, _, tags) in files:
+            self._add_keywords(file_ids[path], tags)
+        logger_file.debug('rich files added')
+
+    @db_records
+    def add_items(self, names):
+        'adds the given multimedia items, the already existing ones are ignored'
+        logger_file.debug('adding %d items' % len(names))
+        self._db_curs.executemany('INSERT OR IGNORE INTO simple_items (name) VALUES (?);', \
+            [(name,) for name in names])
+        logger_file.debug('items added')
+
+    @db_records
+    def add_items_content(self, items_contents):
+        'adds the content files to the multimedia items, as (name, content_file)'
+        logger_file.debug('adding the content files of %d items' % len(items_contents))
+        file_ids = self._file_ids([content_file for (_, content_file) in items_contents])
+        items_files = self._items_files([name for (name, _) in items_contents])
+        rows = []
+        for (name, content_file) in items_contents:
+            if not content_file in file_ids:
+                raise ApoDbMissingFile(content_file, name)
+            (_, cf, tf) = items_files.get(name, (None, None, None))
+            if (cf != None) and (cf != tf):
+                raise ApoDbContentExists(content_file, name)
+            # the files added before in the same call count as well
+            items_files[name] = (None, file_ids[content_file], tf)
+            rows.append((file_ids[content_file], name))
+        self._db_curs.executemany('UPDATE simple_items SET content_file = ? WHERE name = ?;', rows)
+        logger_file.debug('content files added')
+
+    @db_records
+    def add_items_tags(self, items_tags):
+        'adds the tags files to the multimedia items, as (name, tags_file)'
+        logger_file.debug('adding the tags files of %d items' % len(items_tags))
+        file_ids = self._file_ids([tags_file for (_, tags_file) in items_tags])
+        items_files = self._items_files([name for (name, _) in items_tags])
+        rows = []
+        for (name, tags_file) in items_tags:
+            (_, cf, tf) = items_files.get(name, (None, None, None))
+            if tf != None:
+                raise ApoDbTagsExists(tags_file, name)
+            if not tags_file in file_ids:
+                raise ApoDbMissingFile(tags_file, name)
+            items_files[name] = (None, cf, file_ids[tags_file])
+            rows.append((file_ids[tags_file], name))
+        self._db_curs.executemany('UPDATE simple_items SET tags_file = ? WHERE name = ?;', rows)
+        logger_file.debug('tags files added')
+
+    @db_records
+    def set_full_checksums(self, files_checksums):
+        'sets the checksums of the whole files, as (path, full_checksum)'
+        logger_file.debug('setting the full checksums of %d files' % len(files_checksums))
+        self._db_curs.executemany('UPDATE files SET full_checksum = ? WHERE path = ?;', \
+            [(full_checksum, path) for (path, full_checksum) in files_checksums])
+        logger_file.debug('full checksums set')
+
+    @db_records
+    def add_extra_files(self, extra_files):
+        'adds relationships with extra files, as (file_path, item_name)'
+        logger_file.debug('adding %d extra files' % len(extra_files))
+        file_ids = self._file_ids([file_path for (file_path, _) in extra_files])
+        items_files = self._items_files([item_name for (_, item_name) in extra_files])
+        rows = []
+        for (file_path, item_name) in extra_files:
+            if not file_path in file_ids:
+                raise IndexError, "trying to a associate the unknown file %s to the " \
+                    "item %s in an 'other file' relationship!" % (file_path, item_name)
+            if not item_name in items_files:
+                raise IndexError, "trying to a associate the file %s to the unknown " \
+                    "item %s in an 'other file' relationship!" % (file_path, item_name)
+            rows.append((file_ids[file_path], items_files[item_name][0]))
+        self._edit_elements('other_files', ['file', 'item'], rows)
+        logger_file.debug('extra files added')
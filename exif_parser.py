@@ -0,0 +1,339 @@
+'reads in-process the tags of JPEG files from their EXIF, XMP and IPTC segments and the previews of RAW files'
+
+import re
+import struct
+from xml.etree import cElementTree
+
+# tags that can be read in-process, any other one requires exiftool
+NATIVE_TAGS = ['Model', 'Software', 'DateTimeOriginal', 'CreateDate', 'ImageWidth', 'ImageHeight', \
+            'TagsList', 'HierarchicalSubject', 'Subject', 'Keywords']
+# separator of the values of the tags with several values, as joined by exiftool
+LIST_SEPARATOR = ', '
+# markers of the JPEG segments, the frames with the size of the image are all the SOFn but DHT, JPG and DAC
+JPEG_SOI = '\xff\xd8'
+JPEG_SOS = 0xda
+JPEG_EOI = 0xd9
+JPEG_SOF = [marker for marker in range(0xc0, 0xd0) if not marker in (0xc4, 0xc8, 0xcc)]
+JPEG_APP1 = 0xe1
+JPEG_APP13 = 0xed
+EXIF_HEADER = 'Exif\x00\x00'
+XMP_HEADER = 'http://ns.adobe.com/xap/1.0/\x00'
+XMP_EXTENSION_HEADER = 'http://ns.adobe.com/xmp/extension/\x00'
+PHOTOSHOP_HEADER = 'Photoshop 3.0\x00'
+# sizes of the values of the TIFF types, by their ID
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8, 13: 4}
+TIFF_ASCII = 2
+TIFF_SHORT = 3
+TIFF_LONG = 4
+TIFF_IFD = 13
+# tags of the IFD0 and the EXIF IFD, by their ID
+EXIF_TAGS = {0x010f: 'Model', 0x0131: 'Software', 0x0100: 'ImageWidth', 0x0101: 'ImageHeight', \
+            0x9003: 'DateTimeOriginal', 0x9004: 'CreateDate'}
+EXIF_IFD_POINTER = 0x8769
+# tags of the RAW files with their JPEG previews: the whole JPEG file in the IFD0 of the Panasonic ones, and its
+# offset and length in any IFD or sub-IFD of the rest
+RAW_JPEG_TAG = 0x002e
+JPEG_OFFSET_TAG = 0x0201
+JPEG_LENGTH_TAG = 0x0202
+SUB_IFDS_TAG = 0x014a
+# XMP properties with the names of the tags given to them by exiftool
+RDF_NS = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+XMP_TAGS = {'{http://ns.adobe.com/tiff/1.0/}Model': 'Model', \
+            '{http://ns.adobe.com/tiff/1.0/}Software': 'Software', \
+            '{http://ns.adobe.com/tiff/1.0/}ImageWidth': 'ImageWidth', \
+            '{http://ns.adobe.com/tiff/1.0/}ImageLength': 'ImageHeight', \
+            '{http://ns.adobe.com/exif/1.0/}DateTimeOriginal': 'DateTimeOriginal', \
+            '{http://ns.adobe.com/xap/1.0/}CreateDate': 'CreateDate', \
+            '{http://www.digikam.org/ns/1.0/}TagsList': 'TagsList', \
+            '{http://ns.adobe.com/lightroom/1.0/}hierarchicalSubject': 'HierarchicalSubject', \
+            '{http://purl.org/dc/elements/1.1/}subject': 'Subject', \
+            '{http://ns.adobe.com/pdf/1.3/}Keywords': 'Keywords'}
+XMP_DATE_TAGS = ['DateTimeOriginal', 'CreateDate']
+XMP_DATE_FORMAT = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2})(:\d{2})?(\S*)$')
+# IPTC resource of the Photoshop segment, with the datasets of the keywords and of the character set
+IRB_IPTC = 0x0404
+IPTC_KEYWORDS = (2, 25)
+IPTC_CHARSET = (1, 90)
+IPTC_UTF8 = '\x1b%G'
+
+# exceptions
+class ApoExifError(Exception):
+    'error the tags of the file cannot be read in-process as exiftool would do'
+    def __init__(self, reason):
+        Exception.__init__(self)
+        self.reason = reason
+
+    def __str__(self):
+        return 'tags cannot be read in-process: %s' % self.reason
+
+def legacy_value(value):
+    'returns the value as decoded from the output of exiftool, which is UTF-8 read as ISO-8859-15'
+    return unicode(value.encode('utf-8'), 'iso-8859-15')
+
+def read_ifd(tiff, offset, byte_order):
+    'returns the entries of the TIFF IFD at the offset, as a dictionary of (type, count, value bytes) by tag ID'
+    if offset + 2 > len(tiff):
+        raise ApoExifError('IFD out of the TIFF data')
+    (n_entries,) = struct.unpack_from(byte_order + 'H', tiff, offset)
+    if offset + 2 + n_entries * 12 > len(tiff):
+        raise ApoExifError('IFD out of the TIFF data')
+    entries = {}
+    for index in range(n_entries):
+        entry = offset + 2 + index * 12
+        (tag, value_type, count) = struct.unpack_from(byte_order + 'HHI', tiff, entry)
+        if not value_type in TIFF_TYPE_SIZES:
+            continue
+        size = TIFF_TYPE_SIZES[value_type] * count
+        # the values of up to 4 bytes are in the entry, the rest where it points to
+        value_offset = entry + 8
+        if size > 4:
+            (value_offset,) = struct.unpack_from(byte_order + 'I', tiff, entry + 8)
+        if value_offset + size > len(tiff):
+            raise ApoExifError('value of the tag 0x%04x out of the TIFF data' % tag)
+        entries[tag] = (value_type, count, tiff[value_offset:value_offset + size])
+    return entries
+
+def ifd_value(entry, byte_order):
+    'returns the value of an IFD entry, as a string for the ASCII ones and as a list of integers for the rest'
+    (value_type, count, value) = entry
+    if value_type == TIFF_ASCII:
+        # exiftool ends the strings at their first null character
+        return value.split('\x00')[0]
+    if value_type == TIFF_SHORT:
+        return list(struct.unpack(byte_order + 'H' * count, value))
+    if value_type in (TIFF_LONG, TIFF_IFD):
+        return list(struct.unpack(byte_order + 'I' * count, value))
+    raise ApoExifError('IFD entry of unexpected type %d' % value_type)
+
+def ifd_integers(entry, byte_order):
+    'returns the values of an IFD entry of integers, raising ApoExifError if it has another type'
+    if entry[0] == TIFF_ASCII:
+        raise ApoExifError('IFD entry of unexpected type %d' % entry[0])
+    return ifd_value(entry, byte_order)
+
+def ifd_integer(entry, byte_order):
+    'returns the first value of an IFD entry of integers, raising ApoExifError if it has none'
+    values = ifd_integers(entry, byte_order)
+    if len(values) == 0:
+        raise ApoExifError('IFD entry without values')
+    return values[0]
+
+def tiff_header(tiff):
+    'returns the byte order of the TIFF data and the offset of its IFD0'
+    if tiff[0:2] == 'II':
+        byte_order = '<'
+    elif tiff[0:2] == 'MM':
+        byte_order = '>'
+    else:
+        raise ApoExifError('unknown byte order of the TIFF data')
+    if len(tiff) < 8:
+        raise ApoExifError('truncated TIFF header')
+    (_, ifd_offset) = struct.unpack_from(byte_order + 'HI', tiff, 2)
+    return (byte_order, ifd_offset)
+
+def raw_preview(tiff):
+    'returns the largest JPEG preview embedded in the TIFF data of a RAW file, without reading its sensor data'
+    # the Panasonic RAW files have a TIFF header with another magic number, which is ignored
+    (byte_order, ifd_offset) = tiff_header(tiff)
+    previews = []
+    (ifd_offsets, visited) = ([ifd_offset], set())
+    while len(ifd_offsets) > 0:
+        offset = ifd_offsets.pop(0)
+        if (offset == 0) or (offset in visited):
+            continue
+        visited.add(offset)
+        entries = read_ifd(tiff, offset, byte_order)
+        if RAW_JPEG_TAG in entries:
+            previews.append(entries[RAW_JPEG_TAG][2])
+        if (JPEG_OFFSET_TAG in entries) and (JPEG_LENGTH_TAG in entries):
+            start = ifd_integer(entries[JPEG_OFFSET_TAG], byte_order)
+            length = ifd_integer(entries[JPEG_LENGTH_TAG], byte_order)
+            if start + length > len(tiff):
+                raise ApoExifError('JPEG preview out of the TIFF data')
+            previews.append(tiff[start:start + length])
+        if SUB_IFDS_TAG in entries:
+            ifd_offsets.extend(ifd_integers(entries[SUB_IFDS_TAG], byte_order))
+        # the offset of the next IFD follows the entries
+        (n_entries,) = struct.unpack_from(byte_order + 'H', tiff, offset)
+        next_offset = offset + 2 + n_entries * 12
+        if next_offset + 4 <= len(tiff):
+            ifd_offsets.extend(struct.unpack_from(byte_order + 'I', tiff, next_offset))
+    previews = [preview for preview in previews if preview.startswith(JPEG_SOI)]
+    if len(previews) == 0:
+        raise ApoExifError('no JPEG preview in the RAW file')
+    return max(previews, key=len)
+
+def _exif_tags(tiff):
+    'returns the tags of the EXIF segment, from its IFD0 and its EXIF IFD'
+    (byte_order, ifd_offset) = tiff_header(tiff)
+    entries = read_ifd(tiff, ifd_offset, byte_order)
+    if EXIF_IFD_POINTER in entries:
+        exif_offset = ifd_integer(entries[EXIF_IFD_POINTER], byte_order)
+        exif_entries = read_ifd(tiff, exif_offset, byte_order)
+        for tag_id in EXIF_TAGS.keys():
+            if (tag_id in exif_entries) and (tag_id in entries):
+                raise ApoExifError('tag 0x%04x both in the IFD0 and in the EXIF IFD' % tag_id)
+        entries.update(exif_entries)
+    tags = {}
+    for (tag_id, tag) in EXIF_TAGS.items():
+        if not tag_id in entries:
+            continue
+        value = ifd_value(entries[tag_id], byte_order)
+        if isinstance(value, list):
+            # exiftool outputs the EXIF strings as they are stored, so they are decoded as its output
+            tags[tag] = unicode(' '.join([str(number) for number in value]))
+        else:
+            tags[tag] = unicode(value, 'iso-8859-15')
+    return tags
+
+def _xmp_date(value):
+    'returns the XMP date in the format of exiftool'
+    date = XMP_DATE_FORMAT.match(value)
+    if date != None:
+        return '%s:%s:%s %s:%s%s%s' % tuple([part or '' for part in date.groups()])
+    if re.match(r'\d{4}(-\d{2}){0,2}$', value):
+        return value.replace('-', ':')
+    raise ApoExifError('unexpected format of the XMP date %s' % value)
+
+def _xmp_value(element):
+    'returns the value of an XMP property, joining the items of its list if any'
+    if len(element) == 0:
+        return element.text or u''
+    if (len(element) > 1) or not (element[0].tag in (RDF_NS + 'Bag', RDF_NS + 'Seq')):
+        raise ApoExifError('XMP property %s with unexpected structure' % element.tag)
+    items = [item.text or u'' for item in element[0] if item.tag == RDF_NS + 'li']
+    if len(items) == 0:
+        return None
+    return LIST_SEPARATOR.join(items)
+
+def _xmp_tags(packet):
+    'returns the tags of the XMP packet'
+    try:
+        root = cElementTree.fromstring(packet)
+    except SyntaxError, err:
+        raise ApoExifError('XMP packet cannot be parsed: %s' % str(err))
+    tags = {}
+    for description in root.iter(RDF_NS + 'Description'):
+        properties = [(name, value) for (name, value) in description.attrib.items() if name in XMP_TAGS]
+        properties += [(element.tag, _xmp_value(element)) for element in description if element.tag in XMP_TAGS]
+        for (name, value) in properties:
+            tag = XMP_TAGS[name]
+            if value == None:
+                continue
+            if tag in tags:
+                raise ApoExifError('XMP property %s given several times' % name)
+            if tag in XMP_DATE_TAGS:
+                value = _xmp_date(value)
+            tags[tag] = legacy_value(unicode(value))
+    return tags
+
+def _iptc_tags(irb):
+    'returns the tags of the IPTC resource of the Photoshop segment'
+    # the resources are "8BIM", their ID, their padded Pascal name, their size and their padded data
+    datasets = None
+    offset = 0
+    while offset + 7 <= len(irb):
+        if irb[offset:offset + 4] != '8BIM':
+            break
+        (resource_id, name_length) = struct.unpack_from('>HB', irb, offset + 4)
+        offset += 6 + name_length + 1 + (name_length + 1) % 2
+        if offset + 4 > len(irb):
+            raise ApoExifError('truncated Photoshop resource')
+        (size,) = struct.unpack_from('>I', irb, offset)
+        offset += 4
+        if resource_id == IRB_IPTC:
+            if datasets != None:
+                raise ApoExifError('several IPTC resources')
+            datasets = irb[offset:offset + size]
+        offset += size + size % 2
+    if datasets == None:
+        return {}
+    # the datasets are a tag marker, their record, their number, their size and their data
+    keywords = []
+    charset = None
+    offset = 0
+    while offset + 5 <= len(datasets):
+        (marker, record, number, size) = struct.unpack_from('>BBBH', datasets, offset)
+        if (marker != 0x1c) or (size & 0x8000):
+            raise ApoExifError('unexpected IPTC dataset')
+        value = datasets[offset + 5:offset + 5 + size]
+        offset += 5 + size
+        if (record, number) == IPTC_KEYWORDS:
+            keywords.append(value)
+        elif (record, number) == IPTC_CHARSET:
+            charset = value
+    if len(keywords) == 0:
+        return {}
+    # exiftool reads the IPTC strings as Latin text unless they are declared as UTF-8
+    encoding = 'cp1252'
+    if charset == IPTC_UTF8:
+        encoding = 'utf-8'
+    try:
+        keywords = [unicode(keyword, encoding) for keyword in keywords]
+    except UnicodeDecodeError:
+        raise ApoExifError('IPTC keywords cannot be decoded as %s' % encoding)
+    return {'Keywords': legacy_value(LIST_SEPARATOR.join(keywords))}
+
+def _jpeg_segments(fd):
+    'yields the marker and the payload of the segments of the JPEG header that have tags, and of its frame'
+    if fd.read(2) != JPEG_SOI:
+        raise ApoExifError('not a JPEG file')
+    while True:
+        marker = fd.read(2)
+        # markers may be preceded by fill bytes
+        while marker[0:1] == '\xff' and marker[1:2] == '\xff':
+            marker = marker[1:] + fd.read(1)
+        if (len(marker) < 2) or (marker[0] != '\xff'):
+            raise ApoExifError('JPEG segment expected')
+        marker = ord(marker[1])
+        if marker in (JPEG_SOS, JPEG_EOI):
+            return
+        length = fd.read(2)
+        if len(length) < 2:
+            raise ApoExifError('truncated JPEG header')
+        size = struct.unpack('>H', length)[0] - 2
+        if (marker in (JPEG_APP1, JPEG_APP13)) or (marker in JPEG_SOF):
+            payload = fd.read(size)
+            if len(payload) < size:
+                raise ApoExifError('truncated JPEG segment')
+            yield (marker, payload)
+        else:
+            fd.seek(size, 1)
+
+def read_tags(fd):
+    'returns a dictionary with the tags of the JPEG file, decoded as read from the output of exiftool'
+    # the tags found in several places of the file must agree, since their priority is left to exiftool
+    sources = {}
+    for (marker, payload) in _jpeg_segments(fd):
+        if marker in JPEG_SOF:
+            if 'frame' in sources:
+                continue
+            (height, width) = struct.unpack_from('>HH', payload, 1)
+            sources['frame'] = {'ImageWidth': unicode(width), 'ImageHeight': unicode(height)}
+            continue
+        if marker == JPEG_APP1:
+            if payload.startswith(EXIF_HEADER):
+                (source, tags) = ('exif', _exif_tags(payload[len(EXIF_HEADER):]))
+            elif payload.startswith(XMP_HEADER):
+                (source, tags) = ('xmp', _xmp_tags(payload[len(XMP_HEADER):]))
+            elif payload.startswith(XMP_EXTENSION_HEADER):
+                raise ApoExifError('extended XMP')
+            else:
+                continue
+        elif payload.startswith(PHOTOSHOP_HEADER):
+            (source, tags) = ('iptc', _iptc_tags(payload[len(PHOTOSHOP_HEADER):]))
+        else:
+            continue
+        if source in sources:
+            raise ApoExifError('several %s segments' % source)
+        sources[source] = tags
+    if not 'frame' in sources:
+        raise ApoExifError('JPEG frame missing')
+    tags = {}
+    for source_tags in sources.values():
+        for (tag, value) in source_tags.items():
+            value = value.strip()
+            if tags.get(tag, value) != value:
+                raise ApoExifError('different values of the tag %s' % tag)
+            tags[tag] = value
+    return tags
@@ -0,0 +1,55 @@
+#!/usr/bin/python
+'emulates the "-stay_open" protocol of exiftool, so that the metadata extraction can be tested without it'
+
+import os
+import sys
+import json
+
+CRASH_MARKER = 'crash'
+
+def answer(args):
+	'writes the answer to a request, the value of every requested tag is its name followed by the PID'
+	tags = []
+	paths = []
+	json_output = False
+	args = iter(args)
+	for arg in args:
+		if arg == '-s':
+			continue
+		elif arg == '-j':
+			json_output = True
+		elif arg == '-sep':
+			args.next()
+		elif arg.startswith('-'):
+			tags.append(arg[1:])
+		else:
+			paths.append(arg)
+	files_tags = []
+	for path in paths:
+		if CRASH_MARKER in path:
+			sys.exit(1)
+		file_tags = {'SourceFile': path}
+		for tag in tags:
+			file_tags[tag] = '%s %d' % (tag, os.getpid())
+			if not json_output:
+				sys.stdout.write('%-32s: %s\n' % (tag, file_tags[tag]))
+		files_tags.append(file_tags)
+	if json_output and (len(files_tags) > 0):
+		sys.stdout.write(json.dumps(files_tags, indent=1) + '\n')
+	sys.stdout.write('{ready}\n')
+	sys.stdout.flush()
+
+if __name__ == '__main__':
+	args = []
+	while True:
+		line = sys.stdin.readline()
+		if line == '':
+			break
+		line = line.rstrip('\n')
+		if line == '-execute':
+			answer(args)
+			args = []
+		elif args == ['-stay_open'] and line == 'False':
+			break
+		else:
+			args.append(line)
@@ -1,9 +1,17 @@
 import Image
-import wave
 import hashlib
 import os.path 
+import stat
+import mmap
+import io
 import db_backend
-import subprocess
+import metadata_extractor
+import exif_parser
+import checksum_engine
+import perceptual_hash
+import scan_profile
+import video_fingerprint
+import audio_fingerprint
 import logging
 
 TAGS_TO_GET = [
@@ -18,23 +26,35 @@ TAGS_TO_GET = [
                 'Subject',
                 'Keywords'
                 ]
-EXIF_TOOL = "/usr/bin/exiftool"
-EXIFTOOL_REQUEST = EXIF_TOOL + ' -s'
-for tag in TAGS_TO_GET:
-    EXIFTOOL_REQUEST = EXIFTOOL_REQUEST + ' -' + tag
-DD_TOOL = "/bin/dd"
+JPEG_EXTS = ('.jpg', '.jpeg', '.thm', '.jpe', '.jpg_original')
+VIDEO_EXTS = ('.avi', '.mov', '.wmv')
+RAW_EXTS = ('.raw', '.rw2')
+TIFF_EXTS = ('.tif',)
+AUDIO_EXTS = ('.wav',)
+IGNORE_EXTS = ('.db', '.strm')
+# type of file of every supported extension, None for the ignored ones
+FILE_TYPES = {}
+for (file_type_name, file_type_exts) in (('JPEG', JPEG_EXTS), ('video', VIDEO_EXTS), ('RAW', RAW_EXTS), \
+        ('TIFF', TIFF_EXTS), ('audio', AUDIO_EXTS), (None, IGNORE_EXTS)):
+    for ext in file_type_exts:
+        FILE_TYPES[ext] = file_type_name
 READ_FILE_KBS = 64
-CHECKSUM_TOOL = "/usr/bin/sha512sum"
+# size of the chunks in which the whole files are read to calculate their checksum
+READ_FULL_FILE_KBS = 1024
 READ_IMAGE_SIZE = (100, 100)
-VIDEO_DECODER="/usr/bin/ffmpeg"
-SKIP_VIDEO_KBS = 128
-READ_VIDEO_KBS = 64
-READ_WAV_FRAMES = 5000
+# versions of the algorithms of the content checksums of every type of file, the files without version have the
+# legacy one
+LEGACY_CHECKSUM_VERSION = 1
+CONTENT_CHECKSUM_VERSIONS = {'JPEG': 2, 'video': 2, 'RAW': 2, 'TIFF': 1, 'audio': 2}
+# types of files in the order in which they give the content of their item, the rest of its files being extra files
+CONTENT_PRIORITY = ['video', 'RAW', 'TIFF', 'audio', 'JPEG']
+# the DBs created before the timestamps were stored as numbers kept them as text, with 15 significant digits
+LEGACY_TIMESTAMP_FORMAT = '%.15g'
 
 logger_file = logging.getLogger('AuPhOrg')
 logger_output = logging.getLogger('StdOutput')
 
-class ApoFileError:
+class ApoFileError(Exception):
     'superclass for errors in the files_handler module'
     def __init__(self):
         pass
@@ -45,25 +65,152 @@ class ApoFileError:
 class ApoFileUnknown(ApoFileError):
     'error unknown file format'
     def __init__(self, filename):
-        #TODO: check error reporting that 2 parameters required, but only 1 passed
-        super(ApoFileUnknown, self).__init__(filename)
+        super(ApoFileUnknown, self).__init__()
         self.filename = filename
         self.fileext = os.path.splitext(filename)[1][1:]
 
     def __str__(self):
         err_msg = 'file %s cannot be handled, because its extension (%s) is not supported' % \
             (self.filename, self.fileext)
-        logger_file.error = err_msg
-        logger_output.error = err_msg
+        logger_file.error(err_msg)
+        logger_output.error(err_msg)
         return err_msg
 
+def file_type(path):
+    'returns the type of the file according to its extension, None if the file is ignored'
+    extension = os.path.splitext(path)[1].lower()
+    if not extension in FILE_TYPES:
+        raise ApoFileUnknown(path)
+    return FILE_TYPES[extension]
+
+def file_changed(file_stat, timestamp, file_size):
+    'returns True if the stat of the file differs from the timestamp and size stored in the DB'
+    if (timestamp == None) or (file_size == None):
+        return True
+    # the timestamps are compared exactly, also as they were rounded by the older DBs
+    return (file_stat.st_size != file_size) or ((file_stat.st_mtime != timestamp) and \
+        (float(LEGACY_TIMESTAMP_FORMAT % file_stat.st_mtime) != timestamp))
+
+def checksum_outdated(path, checksum_version):
+    'returns True if the content checksum of the file stored in the DB was calculated with an older algorithm'
+    if checksum_version == None:
+        checksum_version = LEGACY_CHECKSUM_VERSION
+    item_type = FILE_TYPES.get(os.path.splitext(path)[1].lower())
+    return checksum_version < CONTENT_CHECKSUM_VERSIONS.get(item_type, LEGACY_CHECKSUM_VERSION)
+
+def file_outdated(path, file_stat, timestamp, file_size, checksum_version):
+    'returns True if the file changed since it was stored in the DB or its content checksum is outdated'
+    # the outdated checksums are migrated lazily, when the files are scanned again
+    return file_changed(file_stat, timestamp, file_size) or checksum_outdated(path, checksum_version)
+
+# contents of a file shared by all the stages of its analysis
+class FileContents:
+    'file opened and stat once, with its contents mapped in memory so that they are only read from disk once'
+
+    def __init__(self, path):
+        'opens the file, which must be a regular one'
+        self.path = path
+        fd = open(path, 'rb')
+        try:
+            self.stat = os.fstat(fd.fileno())
+            if not stat.S_ISREG(self.stat.st_mode):
+                raise RuntimeError, "path isn't a file!"
+            # the mapping is kept after closing the file, and the pages are only read when accessed
+            self._data = None
+            if self.stat.st_size > 0:
+                self._data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+
+    def close(self):
+        'releases the contents of the file'
+        if self._data != None:
+            self._data.close()
+            self._data = None
+
+    def window(self, skip_kbs, count_kbs):
+        'returns "count_kbs" KBs of the file after skipping "skip_kbs" KBs, like "dd bs=1K"'
+        if self._data == None:
+            return ''
+        window = self._data[skip_kbs * checksum_engine.KB:(skip_kbs + count_kbs) * checksum_engine.KB]
+        scan_profile.count_bytes(len(window))
+        return window
+
+    def read(self, offset, size):
+        'returns "size" bytes of the file from the given offset, less if it ends before'
+        if self._data == None:
+            return ''
+        data = self._data[offset:offset + size]
+        scan_profile.count_bytes(len(data))
+        return data
+
+    def mapping(self):
+        'returns the contents mapped in memory, so that only the parts sliced from them are read'
+        if self._data == None:
+            return ''
+        return self._data
+
+    def reader(self):
+        'returns a file object reading the contents from their start, shared by all the readers'
+        if self._data == None:
+            return io.BytesIO('')
+        self._data.seek(0)
+        return ContentsReader(self._data)
+
+# file object over the contents of a file mapped in memory
+class ContentsReader:
+    'reads the contents mapped in memory as a file, counting the bytes read in the profile of the scan'
+
+    def __init__(self, data):
+        'initializes the reader over the mapped contents, from their current position'
+        self._data = data
+
+    def read(self, size = -1):
+        'returns up to "size" bytes from the current position, all the remaining ones if negative'
+        if size < 0:
+            data = self._data.read(self._data.size() - self._data.tell())
+        else:
+            data = self._data.read(size)
+        scan_profile.count_bytes(len(data))
+        return data
+
+    def readline(self, size = -1):
+        'returns the bytes up to the end of the line from the current position'
+        data = self._data.readline()
+        if size >= 0 and len(data) > size:
+            self._data.seek(size - len(data), os.SEEK_CUR)
+            data = data[:size]
+        scan_profile.count_bytes(len(data))
+        return data
+
+    def seek(self, offset, whence = os.SEEK_SET):
+        'moves the current position, which cannot go beyond the end of the contents'
+        self._data.seek(offset, whence)
+
+    def tell(self):
+        'returns the current position'
+        return self._data.tell()
+
+    def close(self):
+        'does nothing, the contents are released with the FileContents'
+        pass
+
 class FilesHandler:
     'handles the specified multimedia files'
-    ignore_exts = ('.db', '.strm')
+    ignore_exts = IGNORE_EXTS
 
-    def __init__(self, lock, database_path = ""):
-        'initializes the object'
+    def __init__(self, lock, database_path = "", extractor = None, connect_db = True):
+        'initializes the object, without DB connection if the files are only analyzed'
         self._lock = lock
+        # the extractor of the process is used by default, so that exiftool is reused across files
+        if extractor == None:
+            extractor = metadata_extractor.process_extractor(TAGS_TO_GET)
+        self._extractor = extractor
+        self._checksums = checksum_engine.ChecksumEngine(READ_FULL_FILE_KBS)
+        if not connect_db:
+            logger_file.debug('files only analyzed, no DB backend required')
+            self._db = None
+            return
         if database_path == '':
             logger_file.debug('no DB specified in the command line')
         else:
@@ -75,131 +222,312 @@ class FilesHandler:
         'close the database object'
         self._db = None
 
-    def _file_checksum(self, path):
-        'calculates the SHA1 checksum of the file'
-        logger_file.debug('calculating the checksum of the file %s' % path)
-        cmd = '%s bs=1K count=%d if="%s" 2> /dev/null | %s -b' % (DD_TOOL, READ_FILE_KBS, path, CHECKSUM_TOOL)
-        output = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
-        lines = output.read().splitlines()
+    @scan_profile.timed('file_checksum')
+    def _file_checksum(self, contents):
+        'calculates the SHA512 checksum of the start of the file'
+        logger_file.debug('calculating the checksum of the file %s' % contents.path)
+        cksm = hashlib.sha512()
+        cksm.update(contents.window(0, READ_FILE_KBS))
         logger_file.debug('checksum of file calculated')
-        return lines[0].split(' ')[0]
+        return cksm.hexdigest()
 
-    def _file_info(self, path):
+    @scan_profile.timed('full_checksum')
+    def _full_checksum(self, path):
+        'calculates the checksum of the whole file'
+        logger_file.debug('calculating the checksum of the whole file %s' % path)
+        checksum = self._checksums.full_checksum(path)
+        logger_file.debug('checksum of whole file calculated')
+        return checksum
+
+    def _file_info(self, contents):
         'gets the information of the file that will be saved in the DB'
         # calculate the checksum
-        checksum = self._file_checksum(path)
-        # get the timestamp of the last modification
-        time = os.path.getmtime(path)
-        # get the size
-        size = os.path.getsize(path)
-        # return the values
-        return (checksum, time, size)
-
-    def _image_checksum(self, path):
-        'calculates the SHA512 checksum of the contained image'
+        checksum = self._file_checksum(contents)
+        # the timestamp of the last modification and the size come from the stat of the opened file
+        return (checksum, contents.stat.st_mtime, contents.stat.st_size)
+
+    @scan_profile.timed('image_decode')
+    def _image_fingerprint(self, contents, version = CONTENT_CHECKSUM_VERSIONS['JPEG'], reader = None):
+        'calculates the SHA512 checksum and the perceptual hash of the contained image, from its thumbnail'
+        # the image is read from the whole file, unless given another reader of it
+        path = contents.path
         logger_file.debug('calculating the checksum of the image contained in file %s' % path)
         try:
-            img = Image.open(path)
+            if reader == None:
+                reader = contents.reader()
+            img = Image.open(reader)
             cksm = hashlib.sha512()
+            if version >= 2:
+                # the JPEG decoder scales the image down by up to 8 while decoding it, as close as possible to the
+                # size of the thumbnail (it does nothing for other formats)
+                img.draft(img.mode, READ_IMAGE_SIZE)
             img.thumbnail(READ_IMAGE_SIZE)
-            cksm.update(img.tostring())
+            # Pillow renamed tostring() to tobytes(), which returns the same bytes
+            cksm.update(getattr(img, 'tobytes', img.tostring)())
+            image_hash = perceptual_hash.dhash(img)
             logger_file.debug('checksum of image calculated')
-            return cksm.hexdigest()
+            return (cksm.hexdigest(), image_hash)
         except Exception, err:
             logger_file.error('Error getting image from file %s: %s' % (path, str(err)))
             logger_output.error('Error getting image from file %s: %s' % (path, str(err)))
+            return (None, None)
+
+    def _path_fingerprint(self, path, version = CONTENT_CHECKSUM_VERSIONS['JPEG']):
+        'calculates the SHA512 checksum and the perceptual hash of the image contained in the file of the path'
+        contents = FileContents(path)
+        try:
+            return self._image_fingerprint(contents, version)
+        finally:
+            contents.close()
+
+    def _image_checksum(self, path, version = CONTENT_CHECKSUM_VERSIONS['JPEG']):
+        'calculates the SHA512 checksum of the contained image'
+        return self._path_fingerprint(path, version)[0]
 
-    def _video_checksum(self, path):
-        'calculates the checksum of a video, using ffmpeg and sha512sum'
+    @scan_profile.timed('video_checksum')
+    def _video_checksum(self, contents):
+        'calculates the checksum of a video, from the payload of its first frames found parsing its container'
+        path = contents.path
         logger_file.debug('calculating the checksum of the video contained in file %s' % path)
-        cmd = '%s bs=1K skip=%d count=%d if="%s" 2> /dev/null | %s -i pipe:0 -f avi - 2> /dev/null | %s -b' % \
-            (DD_TOOL, SKIP_VIDEO_KBS, READ_VIDEO_KBS, path, VIDEO_DECODER, CHECKSUM_TOOL)
-        output = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
-        result = output.read().splitlines()[0]
-        logger_file.debug('checksum of video calculated')
-        return result.split(' ')[0]
-
-    def _wav_checksum(self, path):
-        'calculates the checksum of a wave file'
+        try:
+            checksum = video_fingerprint.fingerprint(contents.read, contents.stat.st_size)
+            logger_file.debug('checksum of video calculated')
+            return checksum
+        except video_fingerprint.ApoVideoError, err:
+            logger_file.error('Error getting video from file %s: %s' % (path, str(err)))
+            logger_output.error('Error getting video from file %s: %s' % (path, str(err)))
+            return None
+
+    @scan_profile.timed('audio_checksum')
+    def _wav_fingerprint(self, contents):
+        'calculates the checksum of the whole audio stream of a wave file and the signature of its envelope'
+        path = contents.path
         logger_file.debug('calculating the checksum of the audio contained in file %s' % path)
         try:
-            wav = wave.open(path, 'rb')
-            cksm = hashlib.sha512()
-            cksm.update(wav.readframes(READ_WAV_FRAMES))
+            (checksum, signature) = audio_fingerprint.fingerprint(contents.reader())
             logger_file.debug('checksum of audio calculated')
-            return cksm.hexdigest()
+            return (checksum, signature)
         except Exception, err:
             logger_file.error('Error getting audio from wave file %s: %s' % (path, str(err)))
             logger_output.error('Error getting audio from wave file %s: %s' % (path, str(err)))
+            return (None, None)
 
-    def _add_jpeg(self, item_name, path):
-        'adds a JPEG file to the DB'
-        logger_file.debug('adding the JPEG file %s to the item %s' % (path, item_name))
-        # get the tags of the file
-        exif_tags = {}
-        cmd = EXIFTOOL_REQUEST + ' "' + path + '"'
-        output = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
-        lines = output.read().splitlines()
-        for line in lines:
-            (tag_name, _, tag_value) = line.partition(':')
-            exif_tags[unicode(tag_name.strip(), 'iso-8859-15')] = unicode(tag_value.strip(), 'iso-8859-15')
-        # calculate the checksum of the image
-        content_checksum = self._image_checksum(path)
+    @scan_profile.timed('jpeg')
+    def _jpeg_record(self, item_name, contents, exif_tags = None):
+        'gets the information of a JPEG file that will be saved in the DB'
+        path = contents.path
+        logger_file.debug('analyzing the JPEG file %s of the item %s' % (path, item_name))
+        # get the tags of the file, if they weren't already obtained
+        if exif_tags == None:
+            with scan_profile.stage('metadata'):
+                exif_tags = self._extractor.get_tags(path, contents.reader)
+        # calculate the checksum and the perceptual hash of the image
+        (content_checksum, image_hash) = self._image_fingerprint(contents)
         # get the required file information
-        (file_checksum, file_time, file_size) = self._file_info(path)
-        # add the file to the DB and to the item
-        self._db.add_rich_file(path, file_time, file_size, file_checksum, content_checksum, exif_tags)
-        self._db.add_item_tags(item_name, path)
-        logger_file.debug('JPEG file added to item')
-
-    def _add_poor_file(self, item_type, item_name, path, cntt_cksm_fnt):
-        'adds a poor file to the DB'
-        logger_file.debug('adding the %s file %s to the item %s' % (item_type, path, item_name))
+        (file_checksum, file_time, file_size) = self._file_info(contents)
+        logger_file.debug('JPEG file analyzed')
+        return {'item_type': 'JPEG', \
+            'item_name': item_name, \
+            'path': path, \
+            'timestamp': file_time, \
+            'file_size': file_size, \
+            'file_checksum': file_checksum, \
+            'content_checksum': content_checksum, \
+            'content_checksum_version': CONTENT_CHECKSUM_VERSIONS['JPEG'], \
+            'perceptual_hash': image_hash, \
+            'tags': exif_tags}
+
+    def _poor_file_record(self, item_type, item_name, contents, cntt_cksm_fnt):
+        'gets the information of a poor file that will be saved in the DB'
+        path = contents.path
+        logger_file.debug('analyzing the %s file %s of the item %s' % (item_type, path, item_name))
         # get the required file information
-        (file_checksum, file_time, file_size) = self._file_info(path)
+        (file_checksum, file_time, file_size) = self._file_info(contents)
         # calculate the checksum of the file content, if possible
         if cntt_cksm_fnt == None:
             content_checksum = file_checksum
         else:
-            content_checksum = cntt_cksm_fnt(path)
-        # add the file to the DB
-        self._db.add_poor_file(path, file_time, file_size, file_checksum, content_checksum)
-        self._db.add_item_content(item_name, path)
-        logger_file.debug('file added to item: %s' % item_type)
+            content_checksum = cntt_cksm_fnt(contents)
+        logger_file.debug('file analyzed: %s' % item_type)
+        return {'item_type': item_type, \
+            'item_name': item_name, \
+            'path': path, \
+            'timestamp': file_time, \
+            'file_size': file_size, \
+            'file_checksum': file_checksum, \
+            'content_checksum': content_checksum, \
+            'content_checksum_version': CONTENT_CHECKSUM_VERSIONS[item_type], \
+            'perceptual_hash': None, \
+            'audio_signature': None, \
+            'tags': None}
+
+    def _tiff_record(self, item_name, contents):
+        'gets the information of a TIFF file that will be saved in the DB'
+        record = self._poor_file_record('TIFF', item_name, contents, None)
+        (record['content_checksum'], record['perceptual_hash']) = \
+            self._image_fingerprint(contents, CONTENT_CHECKSUM_VERSIONS['TIFF'])
+        return record
+
+    @scan_profile.timed('raw_preview')
+    def _raw_preview(self, contents):
+        'returns the JPEG preview embedded in a RAW file, None if it has none'
+        path = contents.path
+        logger_file.debug('getting the JPEG preview embedded in file %s' % path)
+        try:
+            preview = exif_parser.raw_preview(contents.mapping())
+            scan_profile.count_bytes(len(preview))
+            logger_file.debug('JPEG preview got')
+            return preview
+        except exif_parser.ApoExifError, err:
+            logger_file.warning('RAW file %s without JPEG preview, using its file checksum: %s' % (path, str(err)))
+            return None
+
+    def _raw_record(self, item_name, contents):
+        'gets the information of a RAW file that will be saved in the DB, from its embedded JPEG preview'
+        # the preview is fingerprinted as the JPEG files, so that the RAW and JPEG files of a photo match
+        record = self._poor_file_record('RAW', item_name, contents, None)
+        preview = self._raw_preview(contents)
+        if preview != None:
+            (record['content_checksum'], record['perceptual_hash']) = \
+                self._image_fingerprint(contents, CONTENT_CHECKSUM_VERSIONS['RAW'], io.BytesIO(preview))
+        return record
+
+    def _audio_record(self, item_name, contents):
+        'gets the information of a wave file that will be saved in the DB'
+        record = self._poor_file_record('audio', item_name, contents, None)
+        (record['content_checksum'], record['audio_signature']) = self._wav_fingerprint(contents)
+        return record
+
+    def _item_files(self, records):
+        'returns the content file, the tags file and the extra files of an item from the records of its files'
+        # the tags come from the first file with tags, the content from the first other file by type priority
+        (content_file, tags_file, extra_files) = (None, None, [])
+        for record in sorted(records, key=lambda record: CONTENT_PRIORITY.index(record['item_type'])):
+            if (record['tags'] != None) and (tags_file == None):
+                tags_file = record
+            elif (record['tags'] == None) and (content_file == None):
+                content_file = record
+            else:
+                extra_files.append(record)
+        return (content_file, tags_file, extra_files)
+
+    def batch(self, max_records = db_backend.BATCH_RECORDS, max_seconds = db_backend.BATCH_SECONDS):
+        'returns a context that groups the files added inside it in transactions'
+        return self._db.batch(max_records, max_seconds)
+
+    def commit(self):
+        'commits the files of the current batch'
+        self._db.commit()
 
     def is_older(self, path):
-        pass
+        'returns True if the file in the DB is older than the one in the given path or its checksum is outdated'
+        file_state = self._db.get_file_state(path)
+        if file_state == None:
+            return False
+        return file_outdated(path, os.stat(path), *file_state)
+
+    def record(self, n_files = 1):
+        'returns a context whose files are added to the DB as a single record'
+        return self._db.record(n_files)
+
+    @scan_profile.timed('metadata_batch')
+    def get_tags_batch(self, paths, files_contents = None):
+        'gets the tags of the given JPEG files with a single metadata request'
+        # the files with their FileContents in "files_contents", by path, are read from them
+        if files_contents == None:
+            files_contents = {}
+        readers = dict([(path, contents.reader) for (path, contents) in files_contents.items()])
+        return self._extractor.get_tags_batch(paths, readers)
+
+    @scan_profile.timed('analyze')
+    def analyze_file(self, path, tags=None, contents=None):
+        'returns the information of the file of the given path to be saved in the DB, None if it is ignored'
+        # if given, "contents" is the FileContents of the file, which is then not opened again nor closed
+        logger_file.debug('analyzing the file %s' % path)
+        # get the type of file from its extension
+        item_name = os.path.splitext(path)[0]
+        item_type = file_type(path)
+        if item_type == None:
+            logger_file.debug('Ignore file')
+            return None
+        # the file is opened once, checking that it is a regular file, for all the stages of its analysis
+        opened_contents = None
+        if contents == None:
+            contents = opened_contents = FileContents(path)
+        try:
+            if (item_type == 'JPEG'):
+                return self._jpeg_record(item_name, contents, tags)
+            elif (item_type == 'video'):
+                return self._poor_file_record(item_type, item_name, contents, self._video_checksum)
+            elif (item_type == 'RAW'):
+                return self._raw_record(item_name, contents)
+            elif (item_type == 'TIFF'):
+                return self._tiff_record(item_name, contents)
+            elif (item_type == 'audio'):
+                return self._audio_record(item_name, contents)
+        finally:
+            if opened_contents != None:
+                opened_contents.close()
+
+    def verified_duplicates(self):
+        'yields the lists of paths of the files of the DB with the same content, hashing whole files only if needed'
+        # only the files with the same size and checksum of their start can be duplicates, and their full
+        # checksums are stored so that they are calculated only once
+        for candidates in self._db.get_dup_candidates():
+            files_checksums = []
+            duplicates = {}
+            for (path, full_checksum) in candidates:
+                if full_checksum == None:
+                    try:
+                        full_checksum = self._full_checksum(path)
+                    except (IOError, OSError), err:
+                        logger_file.warning('file %s cannot be read, ignoring it: %s' % (path, str(err)))
+                        continue
+                    files_checksums.append((path, full_checksum))
+                duplicates.setdefault(full_checksum, []).append(path)
+            if len(files_checksums) > 0:
+                self._db.set_full_checksums(files_checksums)
+            for paths in duplicates.values():
+                if len(paths) > 1:
+                    yield paths
 
-    def add_file(self, path, force=False):
-        'adds the file of the given path to the DB'
+    def near_duplicates(self, path, max_distance = perceptual_hash.NEAR_DUP_DISTANCE):
+        'returns the sorted (distance, path) of the files of the DB whose image looks like the one of the file'
+        image_hash = self._db.get_perceptual_hash(path)
+        if image_hash == None:
+            (_, image_hash) = self._path_fingerprint(path)
+            if image_hash == None:
+                return []
+        tree = perceptual_hash.load_tree(self._db.side_path(perceptual_hash.TREE_SUFFIX), \
+            self._db.side_path(''), self._db.get_perceptual_hashes())
+        return [(distance, found_path) for (distance, found_path) in tree.find(image_hash, max_distance) \
+            if found_path != path]
+
+    def store_item(self, item_name, records, update=False):
+        'adds the analyzed files of an item to the DB in a single step, returning the paths of the files stored'
+        # if "update", the files already in the DB are updated
+        logger_file.debug('adding %d files to the item %s' % (len(records), item_name))
+        (content_file, tags_file, extra_files) = self._item_files(records)
+        return self._db.store_item(item_name, content_file, tags_file, extra_files, update)
+
+    def store_file(self, record, update=False):
+        'adds an analyzed file to the DB (updating it if already there and "update"), False if not added'
+        return len(self.store_item(record['item_name'], [record], update)) > 0
+
+    def add_file(self, path, force=False, tags=None, update=False, contents=None):
+        'adds the file of the given path to the DB, using the given tags for JPEG files if available'
+        # if "update", a file already in the DB is updated if it changed since it was added, and if given
+        # "contents" is its FileContents
         logger_file.debug('adding the file %s' % path)
-        # test that path is file
-        if not os.path.isfile(path):
-            raise RuntimeError, "path isn't a file!"
-        # get file extension to find out type of file
-        (item_name, extension) = os.path.splitext(path)
-        extension = extension.lower()
-        # create a new item for the file (it does nothing if it already exists)
-        self._db.add_item(item_name, force=False)
-        # add the file to the corresponding item, if it wasn't yet
-        if (force == False) and (self._db.file_exists(path)):
-            logger_file.warning('file already exists, not adding it: %s' % path)
-            return False
-        else:
-            if (extension in ('.jpg', '.jpeg', '.thm', '.jpe', '.jpg_original')):
-                self._add_jpeg(item_name, path)
-            elif (extension in ('.avi', '.mov', '.wmv')):
-                self._add_poor_file('video', item_name, path, self._video_checksum)
-            elif (extension in ('.raw', '.rw2')):
-                self._add_poor_file('RAW', item_name, path, None)
-            elif (extension in ('.tif')):
-                self._add_poor_file('TIFF', item_name, path, self._image_checksum)
-            elif (extension in ('.wav')):
-                self._add_poor_file('audio', item_name, path, self._wav_checksum)
-            elif (extension in self.ignore_exts):
-                logger_file.debug('Ignore file')
-            else:
-                #TODO: check error reporting that 2 parameters required, but only 1 passed
-                raise ApoFileUnknown(path)
-            logger_file.debug('file added')
+        # the files already in the DB aren't analyzed again, unless they changed
+        if force == False:
+            file_state = self._db.get_file_state(path)
+            if (file_state != None) and not (update and file_outdated(path, os.stat(path), *file_state)):
+                logger_file.warning('file already exists, not adding it: %s' % path)
+                return False
+        record = self.analyze_file(path, tags, contents)
+        if record == None:
             return True
+        file_added = self.store_file(record, update)
+        logger_file.debug('file added')
+        return file_added
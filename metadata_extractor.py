@@ -0,0 +1,248 @@
+'extracts the metadata of the multimedia files in-process, or through a long-lived exiftool process'
+
+import os
+import subprocess
+import logging
+import json
+import exif_parser
+import scan_profile
+
+EXIF_TOOL = "/usr/bin/exiftool"
+# number of requests after which the exiftool process is restarted (keeps its memory bounded)
+MAX_REQUESTS = 1000
+READY_MARKER = '{ready}'
+
+logger_file = logging.getLogger('AuPhOrg')
+
+# exceptions
+class ApoMetadataError(Exception):
+    'superclass for errors in the metadata_extractor module'
+    def __init__(self):
+        Exception.__init__(self)
+
+    def __str__(self):
+        return 'generic expection of the file ' + __file__
+
+class ApoExifToolDied(ApoMetadataError):
+    'error the exiftool process stopped while handling a request'
+    def __init__(self, path):
+        ApoMetadataError.__init__(self)
+        self.path = path
+
+    def __str__(self):
+        err_msg = 'exiftool died while getting the tags of the file %s' % self.path
+        logger_file.error(err_msg)
+        return err_msg
+
+# extractor of the metadata of files
+class ExifToolExtractor:
+    'gets the metadata of files from an exiftool process driven with its "-stay_open" protocol'
+
+    def __init__(self, tags, exiftool_cmd = None, max_requests = MAX_REQUESTS):
+        'initializes the extractor, the exiftool process is only started with the first request'
+        self._tags = tags
+        if exiftool_cmd == None:
+            exiftool_cmd = [EXIF_TOOL]
+        self._exiftool_cmd = exiftool_cmd
+        self._max_requests = max_requests
+        self._process = None
+        self._owner_pid = None
+        self._n_requests = 0
+
+    def __del__(self):
+        'stops the exiftool process before destroying the object'
+        self.close()
+
+    def _start(self):
+        'starts a new exiftool process waiting for requests in its standard input'
+        logger_file.debug('starting exiftool process')
+        devnull = open(os.devnull, 'w')
+        self._process = subprocess.Popen(self._exiftool_cmd + ['-stay_open', 'True', '-@', '-'], \
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull)
+        devnull.close()
+        self._owner_pid = os.getpid()
+        self._n_requests = 0
+        logger_file.debug('exiftool process %d started' % self._process.pid)
+
+    def _execute(self, path, args):
+        'sends the arguments of a request to exiftool and returns the output lines'
+        if (self._process != None) and (self._n_requests >= self._max_requests):
+            logger_file.debug('exiftool process served %d requests, restarting it' % self._n_requests)
+            self.close()
+        if (self._process == None) or (self._process.poll() != None):
+            self._start()
+        self._n_requests += 1
+        request = ''
+        for arg in args:
+            if isinstance(arg, unicode):
+                arg = arg.encode('utf-8')
+            request += arg + '\n'
+        self._process.stdin.write(request + '-execute\n')
+        self._process.stdin.flush()
+        lines = []
+        while True:
+            line = self._process.stdout.readline()
+            if line == '':
+                raise ApoExifToolDied(path)
+            line = line.rstrip('\r\n')
+            if line == READY_MARKER:
+                return lines
+            lines.append(line)
+
+    def _request(self, path, args):
+        'sends a request to exiftool, restarting it once if it crashed'
+        try:
+            return self._execute(path, args)
+        except (IOError, OSError, ApoExifToolDied):
+            logger_file.warning('exiftool process crashed handling file %s, restarting it' % path)
+            self.close()
+            return self._execute(path, args)
+
+    def close(self):
+        'stops the exiftool process, if running'
+        if self._process == None:
+            return
+        if self._owner_pid != os.getpid():
+            # the process was inherited through a fork, it belongs to the parent
+            self._process = None
+            return
+        logger_file.debug('stopping exiftool process %d' % self._process.pid)
+        try:
+            self._process.stdin.write('-stay_open\nFalse\n')
+            self._process.stdin.close()
+            self._process.wait()
+        except (IOError, OSError):
+            if self._process.poll() == None:
+                self._process.kill()
+                self._process.wait()
+        self._process = None
+
+    def get_tags(self, path, reader = None):
+        'returns a dictionary with the tags of the given file, which exiftool reads by itself'
+        logger_file.debug('getting the tags of the file %s' % path)
+        args = ['-s']
+        for tag in self._tags:
+            args.append('-' + tag)
+        args.append(path)
+        exif_tags = {}
+        for line in self._request(path, args):
+            (tag_name, _, tag_value) = line.partition(':')
+            exif_tags[unicode(tag_name.strip(), 'iso-8859-15')] = unicode(tag_value.strip(), 'iso-8859-15')
+        logger_file.debug('tags of the file obtained')
+        return exif_tags
+
+    def get_tags_batch(self, paths, readers = None):
+        'returns a dictionary with the tags of each of the given files, getting them with a single request'
+        # exiftool reads the files by itself, so the "readers" of their contents aren't used
+        logger_file.debug('getting the tags of a batch of %d files' % len(paths))
+        args = ['-j', '-sep', ', ']
+        for tag in self._tags:
+            args.append('-' + tag)
+        args.extend(paths)
+        # exiftool reports the path of every file as given in the request
+        requested_paths = {}
+        for path in paths:
+            if isinstance(path, unicode):
+                requested_paths[path] = path
+            else:
+                requested_paths[unicode(path, 'utf-8')] = path
+        try:
+            output = '\n'.join(self._request(paths[0], args))
+        except ApoExifToolDied:
+            # a file of the batch kills exiftool, get the tags of the rest file by file
+            logger_file.warning('exiftool cannot handle the batch, getting the tags file by file')
+            return self._get_tags_each(paths)
+        files_tags = {}
+        if output.strip() == '':
+            return files_tags
+        for file_tags in json.loads(output):
+            path = requested_paths.get(file_tags.pop('SourceFile'))
+            if path == None:
+                continue
+            exif_tags = {}
+            for (tag_name, tag_value) in file_tags.items():
+                # keep the decoding of the text output, so that the values are comparable
+                if not isinstance(tag_value, unicode):
+                    tag_value = unicode(tag_value)
+                exif_tags[tag_name] = unicode(tag_value.encode('utf-8'), 'iso-8859-15')
+            files_tags[path] = exif_tags
+        logger_file.debug('tags of the batch obtained')
+        return files_tags
+
+    def _get_tags_each(self, paths):
+        'returns a dictionary with the tags of each of the given files, skipping the files that kill exiftool'
+        files_tags = {}
+        for path in paths:
+            try:
+                files_tags[path] = self.get_tags(path)
+            except ApoExifToolDied:
+                pass
+        return files_tags
+
+# extractor of the metadata of JPEG files that avoids starting exiftool
+class NativeExtractor:
+    'reads the tags of JPEG files in-process, using exiftool for the files or tags it cannot read as exiftool does'
+
+    def __init__(self, tags, fallback = None):
+        'initializes the extractor, with the given extractor for the files that cannot be read in-process'
+        self._tags = tags
+        if fallback == None:
+            fallback = ExifToolExtractor(tags)
+        self._fallback = fallback
+        self._native = set(tags).issubset(exif_parser.NATIVE_TAGS)
+
+    def close(self):
+        'stops the exiftool process of the fallback extractor, if running'
+        self._fallback.close()
+
+    def _native_tags(self, path, reader = None):
+        'returns a dictionary with the requested tags of the file read in-process, None if it cannot be read'
+        # if given, "reader" returns a file object with the contents of the file, which is then not opened again
+        if not self._native:
+            return None
+        try:
+            if reader != None:
+                exif_tags = exif_parser.read_tags(reader())
+            else:
+                with open(path, 'rb') as fd:
+                    exif_tags = exif_parser.read_tags(fd)
+        except (IOError, OSError, ValueError, exif_parser.ApoExifError), err:
+            logger_file.debug('tags of the file %s read with exiftool: %s' % (path, str(err)))
+            return None
+        return dict([(tag, value) for (tag, value) in exif_tags.items() if tag in self._tags])
+
+    def get_tags(self, path, reader = None):
+        'returns a dictionary with the tags of the given file, read from "reader" if given'
+        exif_tags = self._native_tags(path, reader)
+        if exif_tags == None:
+            with scan_profile.stage('exiftool'):
+                exif_tags = self._fallback.get_tags(path)
+        return exif_tags
+
+    def get_tags_batch(self, paths, readers = None):
+        'returns a dictionary with the tags of each of the given files, getting the unreadable ones with exiftool'
+        # "readers" has by path the functions returning a file object with the contents of the files that have one
+        if readers == None:
+            readers = {}
+        files_tags = {}
+        fallback_paths = []
+        for path in paths:
+            exif_tags = self._native_tags(path, readers.get(path))
+            if exif_tags == None:
+                fallback_paths.append(path)
+            else:
+                files_tags[path] = exif_tags
+        if len(fallback_paths) > 0:
+            with scan_profile.stage('exiftool'):
+                files_tags.update(self._fallback.get_tags_batch(fallback_paths))
+        return files_tags
+
+# extractors shared by all the files handled by a process
+_process_extractors = {}
+
+def process_extractor(tags):
+    'returns the extractor of the current process, so that its exiftool process is reused across files'
+    key = (os.getpid(), tuple(tags))
+    if not key in _process_extractors:
+        _process_extractors[key] = NativeExtractor(tags)
+    return _process_extractors[key]
@@ -0,0 +1,111 @@
+'calculates perceptual hashes of images and finds the ones that look alike through a BK-tree'
+
+import os
+import cPickle
+import logging
+import Image
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# side of the grid of differences between pixels, the hashes have DHASH_SIZE x DHASH_SIZE bits
+DHASH_SIZE = 8
+# maximum number of different bits between the hashes of images that look alike
+NEAR_DUP_DISTANCE = 6
+# suffix of the file next to the DB where the tree of its hashes is kept
+TREE_SUFFIX = '.bktree'
+
+logger_file = logging.getLogger('AuPhOrg')
+
+def dhash(img):
+    'returns the difference hash of the image as an hexadecimal string, comparing horizontally adjacent pixels'
+    small = img.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.ANTIALIAS)
+    if numpy != None:
+        pixels = numpy.asarray(small, dtype=numpy.int16)
+        bits = numpy.packbits((pixels[:, 1:] > pixels[:, :-1]).flatten())
+        return ''.join(['%02x' % byte for byte in bits])
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(DHASH_SIZE):
+        for col in range(DHASH_SIZE):
+            pixel = row * (DHASH_SIZE + 1) + col
+            value = (value << 1) | int(pixels[pixel + 1] > pixels[pixel])
+    return '%0*x' % (DHASH_SIZE * DHASH_SIZE / 4, value)
+
+def hamming(hash_1, hash_2):
+    'returns the number of different bits between two hashes given as integers'
+    return bin(hash_1 ^ hash_2).count('1')
+
+# tree of hashes that finds the ones close to a given one without comparing it to all of them
+class BKTree:
+    'BK-tree of perceptual hashes, whose children are indexed by their distance to the parent'
+
+    def __init__(self):
+        'initializes an empty tree'
+        # every node is a list [hash, paths, children], so that the tree is compact when pickled
+        self._root = None
+        self._n_hashes = 0
+
+    def __len__(self):
+        return self._n_hashes
+
+    def add(self, image_hash, path):
+        'adds the hexadecimal hash of the image of the given file'
+        image_hash = int(image_hash, 16)
+        self._n_hashes += 1
+        if self._root == None:
+            self._root = [image_hash, [path], {}]
+            return
+        node = self._root
+        while True:
+            distance = hamming(image_hash, node[0])
+            if distance == 0:
+                node[1].append(path)
+                return
+            if not distance in node[2]:
+                node[2][distance] = [image_hash, [path], {}]
+                return
+            node = node[2][distance]
+
+    def find(self, image_hash, max_distance = NEAR_DUP_DISTANCE):
+        'returns the sorted (distance, path) of the files whose hash is at most "max_distance" bits away'
+        image_hash = int(image_hash, 16)
+        found = []
+        if self._root == None:
+            return found
+        nodes = [self._root]
+        while len(nodes) > 0:
+            (node_hash, paths, children) = nodes.pop()
+            distance = hamming(image_hash, node_hash)
+            if distance <= max_distance:
+                found.extend([(distance, path) for path in paths])
+            # by the triangle inequality, only these children can have hashes close enough
+            for child_distance in range(distance - max_distance, distance + max_distance + 1):
+                if child_distance in children:
+                    nodes.append(children[child_distance])
+        found.sort()
+        return found
+
+def load_tree(tree_path, db_path, hashes):
+    'returns the tree stored in "tree_path", rebuilding it from the (path, hash) in "hashes" if the DB changed'
+    # the tree is valid while the DB isn't modified after it was built
+    db_stat = os.stat(db_path)
+    db_state = (db_stat.st_mtime, db_stat.st_size)
+    if os.path.exists(tree_path):
+        try:
+            with open(tree_path, 'rb') as tree_file:
+                (tree_db_state, tree) = cPickle.load(tree_file)
+            if tree_db_state == db_state:
+                logger_file.debug('tree of perceptual hashes loaded from %s' % tree_path)
+                return tree
+        except Exception, err:
+            logger_file.warning('tree of perceptual hashes %s cannot be loaded: %s' % (tree_path, str(err)))
+    logger_file.info('building the tree of perceptual hashes of the DB %s' % db_path)
+    tree = BKTree()
+    for (path, image_hash) in hashes:
+        tree.add(image_hash, path)
+    with open(tree_path, 'wb') as tree_file:
+        cPickle.dump((db_state, tree), tree_file, cPickle.HIGHEST_PROTOCOL)
+    logger_file.debug('tree of %d perceptual hashes stored in %s' % (len(tree), tree_path))
+    return tree
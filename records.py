@@ -0,0 +1,70 @@
+'compact records of the items, files and tags of the collection, shared by the DB backend and the items'
+
+# tags of the files kept in the records, in the order of the columns of the DB
+TAG_NAMES = ['Model', 'Software', 'DateTimeOriginal', 'CreateDate', 'ImageWidth', 'ImageHeight', \
+            'TagsList', 'HierarchicalSubject', 'Subject', 'Keywords']
+# tags whose values are shared by many files, so that a single copy of every value is kept
+INTERNED_TAGS = ['Model', 'Software', 'ImageWidth', 'ImageHeight']
+
+# pool of the interned values, "intern" only accepts byte strings
+_interned_values = {}
+
+def intern_value(value):
+    'returns the copy of the value shared by all the records'
+    if value == None:
+        return None
+    return _interned_values.setdefault(value, value)
+
+# tags of a file
+class TagsRecord(object):
+    'tags of a file, without a dictionary per instance'
+    __slots__ = TAG_NAMES
+
+    def __init__(self, tags = None):
+        'initializes the record with the values of the dictionary of tags, None for the missing ones'
+        if tags == None:
+            tags = {}
+        for tag in TAG_NAMES:
+            self.set(tag, tags.get(tag))
+
+    def __eq__(self, other):
+        return isinstance(other, TagsRecord) and (self.as_dict() == other.as_dict())
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def set(self, tag, value):
+        'sets the value of the tag, interning it if shared by many files'
+        if tag in INTERNED_TAGS:
+            value = intern_value(value)
+        setattr(self, tag, value)
+
+    def as_dict(self):
+        'returns the tags as a dictionary'
+        return dict([(tag, getattr(self, tag)) for tag in TAG_NAMES])
+
+# file of the collection
+class FileRecord(object):
+    'file of the collection, without a dictionary per instance'
+    __slots__ = ['path', 'timestamp', 'file_size', 'file_checksum', 'content_checksum']
+
+    def __init__(self, path, timestamp = None, file_size = None, file_checksum = None, content_checksum = None):
+        'initializes the record of the file'
+        self.path = path
+        self.timestamp = timestamp
+        self.file_size = file_size
+        self.file_checksum = file_checksum
+        self.content_checksum = content_checksum
+
+# multimedia item of the collection
+class ItemRecord(object):
+    'multimedia item of the collection with the paths of its files, without a dictionary per instance'
+    __slots__ = ['name', 'tags', 'content_file', 'tags_file', 'extra_files']
+
+    def __init__(self, name, tags = None, content_file = None, tags_file = None, extra_files = None):
+        'initializes the record of the item, "tags" is a TagsRecord and "extra_files" a list of paths'
+        self.name = name
+        self.tags = tags
+        self.content_file = content_file
+        self.tags_file = tags_file
+        self.extra_files = extra_files
@@ -0,0 +1,149 @@
+'measures the time spent by every process in the stages of the scan, and reports it once merged'
+
+import time
+import math
+import json
+import contextlib
+
+# the histograms have BUCKETS_PER_DOUBLING buckets every time the latency doubles, starting at MIN_LATENCY_S
+MIN_LATENCY_S = 1e-6
+BUCKETS_PER_DOUBLING = 4
+# percentiles reported for every stage
+PERCENTILES = [50, 95, 99]
+
+# statistics of a stage
+class StageStats:
+    'histogram of the latencies of a stage, with its number of calls, total time and bytes read'
+
+    def __init__(self):
+        'initializes empty statistics'
+        # the buckets are a dictionary, so that the statistics are small when pickled
+        self.buckets = {}
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+        self.bytes_read = 0
+
+    def add(self, elapsed_s):
+        'adds a call of the stage that took "elapsed_s" seconds'
+        bucket = 0
+        if elapsed_s > MIN_LATENCY_S:
+            bucket = int(math.log(elapsed_s / MIN_LATENCY_S, 2) * BUCKETS_PER_DOUBLING)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total_s += elapsed_s
+        self.max_s = max(self.max_s, elapsed_s)
+
+    def merge(self, other):
+        'adds the calls of other statistics of the same stage'
+        for (bucket, count) in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total_s += other.total_s
+        self.max_s = max(self.max_s, other.max_s)
+        self.bytes_read += other.bytes_read
+
+    def percentile(self, percent):
+        'returns the upper bound of the latency of the given percent of the calls, in seconds'
+        if self.count == 0:
+            return 0.0
+        rank = int(math.ceil(self.count * percent / 100.0))
+        n_calls = 0
+        for bucket in sorted(self.buckets.keys()):
+            n_calls += self.buckets[bucket]
+            if n_calls >= rank:
+                break
+        return min(MIN_LATENCY_S * 2 ** ((bucket + 1.0) / BUCKETS_PER_DOUBLING), self.max_s)
+
+# profile of a process
+class ScanProfile:
+    'statistics of the stages of the scan run by a process, or merged from several of them'
+
+    def __init__(self):
+        'initializes an empty profile'
+        self.stages = {}
+
+    def add(self, stage, elapsed_s):
+        'adds a call of the stage that took "elapsed_s" seconds'
+        if not stage in self.stages:
+            self.stages[stage] = StageStats()
+        self.stages[stage].add(elapsed_s)
+
+    def add_bytes(self, stage, n_bytes):
+        'adds bytes read by the stage'
+        if not stage in self.stages:
+            self.stages[stage] = StageStats()
+        self.stages[stage].bytes_read += n_bytes
+
+    def merge(self, other):
+        'adds the statistics of the profile of another process'
+        for (stage, stats) in other.stages.items():
+            if not stage in self.stages:
+                self.stages[stage] = StageStats()
+            self.stages[stage].merge(stats)
+
+    def report(self):
+        'returns the lines of a table with the statistics of every stage, the slowest ones first'
+        lines = ['%-24s %8s %10s %9s %9s %9s %10s' % \
+            ('stage', 'calls', 'total s', 'p50 ms', 'p95 ms', 'p99 ms', 'MB read')]
+        stages = sorted(self.stages.items(), key=lambda (_, stats): stats.total_s, reverse=True)
+        for (stage, stats) in stages:
+            lines.append('%-24s %8d %10.3f %9.3f %9.3f %9.3f %10.3f' % \
+                ((stage, stats.count, stats.total_s) + \
+                tuple([stats.percentile(percent) * 1000 for percent in PERCENTILES]) + \
+                (stats.bytes_read / (1024.0 * 1024),)))
+        return lines
+
+    def as_dict(self):
+        'returns the statistics of every stage as a dictionary, with the latencies in seconds'
+        stages = {}
+        for (stage, stats) in self.stages.items():
+            stages[stage] = {'calls': stats.count, \
+                'total_s': stats.total_s, \
+                'max_s': stats.max_s, \
+                'bytes_read': stats.bytes_read}
+            for percent in PERCENTILES:
+                stages[stage]['p%d_s' % percent] = stats.percentile(percent)
+        return stages
+
+    def write_json(self, path):
+        'writes the statistics of every stage to the given JSON file'
+        with open(path, 'w') as json_file:
+            json.dump(self.as_dict(), json_file, indent=2, sort_keys=True)
+
+# profile of the current process, and the stages being measured in it (the innermost one last)
+profile = ScanProfile()
+_active_stages = []
+
+def reset():
+    'returns the profile of the process, starting a new one'
+    global profile
+    (process_profile, profile) = (profile, ScanProfile())
+    return process_profile
+
+@contextlib.contextmanager
+def stage(name):
+    'adds the time spent in the "with" block to the given stage of the profile of the process'
+    _active_stages.append(name)
+    start = time.time()
+    try:
+        yield
+    finally:
+        profile.add(name, time.time() - start)
+        _active_stages.pop()
+
+def timed(name):
+    'decorator that adds the time spent in the function to the given stage of the profile of the process'
+    def decorator(function):
+        def timed_function(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        timed_function.__name__ = function.__name__
+        timed_function.__doc__ = function.__doc__
+        return timed_function
+    return decorator
+
+def count_bytes(n_bytes):
+    'adds bytes read to the innermost stage being measured, if any'
+    if len(_active_stages) > 0:
+        profile.add_bytes(_active_stages[-1], n_bytes)
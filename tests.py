@@ -2,15 +2,32 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+import sys
 import sqlite3
 import os
 import shutil
 import logging
 import optparse
 import subprocess
+import threading
+import struct
+import math
+import wave
+import hashlib
+import multiprocessing
+import Image
 
 import db_backend
+import records
+import camera_item
 import files_handler
+import metadata_extractor
+import exif_parser
+import video_fingerprint
+import audio_fingerprint
+import checksum_engine
+import perceptual_hash
+import scan_profile
 import tree_scanner
 
 class TestDbBackend(unittest.TestCase):
@@ -94,11 +111,15 @@ class TestDbBackend(unittest.TestCase):
 		# check that the expected tables are available
 		cur.execute("SELECT name FROM sqlite_master WHERE type='table';")
 		tables = cur.fetchall()
-		self.assertTrue(len(tables) == 4)
+		# the full-text index of the tags has several tables
+		self.assertTrue(len([table for (table,) in tables if not table.startswith('tags_search')]) == 6)
 		self.assertTrue((u'simple_items',) in tables)
 		self.assertTrue((u'tags',) in tables)
 		self.assertTrue((u'files',) in tables)
 		self.assertTrue((u'other_files',) in tables)
+		self.assertTrue((u'keywords',) in tables)
+		self.assertTrue((u'files_keywords',) in tables)
+		self.assertTrue((u'tags_search',) in tables)
 		# close DB connection
 		db.close()
 
@@ -266,6 +287,281 @@ class TestDbBackend(unittest.TestCase):
 		self.assertTrue(tags_file == test_item['tags_file'])
 		self.assertTrue(extra_files == [self.test_fpoor_2['path'], self.test_fpoor_3['path']])
 
+class DbTestCase(unittest.TestCase):
+	# tests of a DB of the given path, created empty for every test
+	_db_path = None
+
+	def _poor_file(self, index):
+		return (u'/this/is/a/path_%d' % index, u'12/32/3423 14:74:12', 1234, \
+			u'f1l3ch3cksum%d' % index, u'c0nt3ntch3cksum%d' % index)
+
+	def _count(self, table):
+		# count the rows committed to the DB with an independent connection
+		db = sqlite3.connect(self._db_path)
+		count = db.execute('SELECT COUNT(*) FROM %s;' % table).fetchone()[0]
+		db.close()
+		return count
+
+	def setUp(self):
+		if os.path.exists(self._db_path):
+			os.remove(self._db_path)
+		self._db = db_backend.DbConnector(multiprocessing.Lock(), self._db_path)
+
+	def tearDown(self):
+		self._db = None
+		os.remove(self._db_path)
+
+class TestDbBatch(DbTestCase):
+	_db_path = '/tmp/test_auphorg_batch.db'
+
+	def test_batch_commits(self):
+		'tests that the records of a batch are committed every "max_records" records'
+		with self._db.batch(2, 3600):
+			for index in range(3):
+				self._db.add_poor_file(*self._poor_file(index))
+			self.assertEqual(self._count('files'), 2)
+		self.assertEqual(self._count('files'), 3)
+
+	def test_batch_duplicate(self):
+		'tests that a duplicated file only undoes its own record in a batch'
+		tags = TestDbBackend.test_tags
+		with self._db.batch():
+			self._db.add_rich_file(*(self._poor_file(1) + (tags,)))
+			self.assertRaises(db_backend.ApoDbDupUniq, self._db.add_rich_file, *(self._poor_file(1) + (tags,)))
+			self._db.add_poor_file(*self._poor_file(2))
+		self.assertEqual(self._count('files'), 2)
+		self.assertEqual(self._count('tags'), 1)
+
+	def test_batch_rolled_back(self):
+		'tests that the uncommitted records are undone if an exception leaves the batch'
+		def failing_batch():
+			with self._db.batch():
+				self._db.add_poor_file(*self._poor_file(1))
+				raise RuntimeError
+		self.assertRaises(RuntimeError, failing_batch)
+		self.assertEqual(self._count('files'), 0)
+
+	def test_batch_commit_locked(self):
+		'tests that the commits of a batch are tried again while another connection is reading the DB'
+		reader = sqlite3.connect(self._db_path, isolation_level=None, check_same_thread=False)
+		reader.execute('BEGIN;')
+		reader.execute('SELECT COUNT(*) FROM files;').fetchone()
+		# every try of the commit waits 0.1 seconds for the reader, which ends its transaction after 0.25
+		self._db._db_curs.execute('PRAGMA busy_timeout = 100;')
+		timer = threading.Timer(0.25, reader.execute, ['COMMIT;'])
+		with self._db.batch():
+			self._db.add_poor_file(*self._poor_file(1))
+			timer.start()
+			self._db.commit()
+		timer.join()
+		reader.close()
+		self.assertEqual(self._count('files'), 1)
+
+	def test_checksum_version(self):
+		'tests that the files without checksum version have the legacy one, outdated for JPEG files and videos'
+		self._db.add_poor_file(*self._poor_file(1))
+		self._db.add_poor_file(*(self._poor_file(2) + (None, files_handler.CONTENT_CHECKSUM_VERSIONS['JPEG'])))
+		db = sqlite3.connect(self._db_path)
+		versions = dict(db.execute('SELECT path, content_checksum_version FROM files;').fetchall())
+		db.close()
+		self.assertTrue(files_handler.checksum_outdated(u'/this/is/a/path_1.jpg', versions[u'/this/is/a/path_1']))
+		self.assertTrue(files_handler.checksum_outdated(u'/this/is/a/path_1.avi', versions[u'/this/is/a/path_1']))
+		self.assertFalse(files_handler.checksum_outdated(u'/this/is/a/path_1.tif', versions[u'/this/is/a/path_1']))
+		self.assertFalse(files_handler.checksum_outdated(u'/this/is/a/path_2.jpg', versions[u'/this/is/a/path_2']))
+
+	def test_timestamps_retyped(self):
+		'tests that the timestamps stored as text by the older DBs become numbers, still matching their files'
+		self._db = None
+		mtime = 1476802345.1234567
+		db = sqlite3.connect(self._db_path)
+		db.execute('DROP VIEW items;')
+		db.execute('DROP VIEW items_extra_files;')
+		db.execute('DROP TABLE files;')
+		db.execute(db_backend.SCHEMA_FILES.replace('timestamp REAL', 'timestamp TEXT'))
+		db.execute(db_backend.SCHEMA_ITEMS_VIEW)
+		db.execute(db_backend.SCHEMA_EXTRA_FILES_VIEW)
+		db.execute('INSERT INTO files (path, timestamp, file_size) VALUES (?, ?, ?);', [u'/this/is/a/path_1', mtime, 1234])
+		db.execute('INSERT INTO simple_items (name, content_file) VALUES (?, ?);', [u'/this/is/a/path', 1])
+		db.commit()
+		self.assertEqual(db.execute('SELECT typeof(timestamp) FROM files;').fetchone(), (u'text',))
+		db.close()
+		self._db = db_backend.DbConnector(multiprocessing.Lock(), self._db_path)
+		(timestamp, file_size, _) = self._db.get_file_state(u'/this/is/a/path_1')
+		self.assertEqual(timestamp, float('%.15g' % mtime))
+		db = sqlite3.connect(self._db_path)
+		self.assertEqual(db.execute('SELECT content_file FROM items;').fetchall(), [(u'/this/is/a/path_1',)])
+		db.close()
+		file_stat = os.stat_result((0, 0, 0, 0, 0, 0, file_size, 0, mtime, 0))
+		self.assertFalse(files_handler.file_changed(file_stat, timestamp, file_size))
+		file_stat = os.stat_result((0, 0, 0, 0, 0, 0, file_size, 0, mtime + 1e-5, 0))
+		self.assertTrue(files_handler.file_changed(file_stat, timestamp, file_size))
+		# the new timestamps are stored exactly
+		self._db.update_file(u'/this/is/a/path_1', mtime, file_size, u'f1l3ch3cksum1', u'c0nt3ntch3cksum1')
+		self.assertEqual(self._db.get_file_state(u'/this/is/a/path_1')[0], mtime)
+
+	def test_schema_up_to_date(self):
+		'tests that connecting to a DB with the current schema works while another connection is writing to it'
+		writer = sqlite3.connect(self._db_path, isolation_level=None)
+		writer.execute('BEGIN IMMEDIATE;')
+		try:
+			db = db_backend.DbConnector(multiprocessing.Lock(), self._db_path)
+			self.assertEqual(db.get_files_state(u'/this'), {})
+		finally:
+			writer.execute('ROLLBACK;')
+			writer.close()
+
+	def test_bulk_add(self):
+		'tests the addition of files and items in bulk'
+		with self._db.batch():
+			self._db.add_items([u'/item/1', u'/item/2', u'/item/1'])
+			self._db.add_poor_files([self._poor_file(index) for index in range(3)])
+			self._db.add_items_content([(u'/item/1', self._poor_file(0)[0]), (u'/item/2', self._poor_file(1)[0])])
+			self._db.add_extra_files([(self._poor_file(2)[0], u'/item/1')])
+		self.assertEqual(self._count('simple_items'), 2)
+		(_, content_file, _, extra_files) = self._db.get_item(u'/item/1')
+		self.assertEqual(content_file, self._poor_file(0)[0])
+		self.assertEqual(extra_files, [self._poor_file(2)[0]])
+
+	def test_bulk_duplicate(self):
+		'tests that a duplicated file undoes the whole bulk addition and reports its path'
+		with self._db.batch():
+			self._db.add_poor_file(*self._poor_file(1))
+			try:
+				self._db.add_poor_files([self._poor_file(index) for index in range(3)])
+				self.fail('duplicated file not reported')
+			except db_backend.ApoDbDupUniq, err:
+				self.assertEqual(err.value, self._poor_file(1)[0])
+		self.assertEqual(self._count('files'), 1)
+
+class TestDbQueries(DbTestCase):
+	_db_path = '/tmp/test_auphorg_queries.db'
+
+	def test_keywords(self):
+		'tests that the items are found by their keywords and hierarchical subjects'
+		tags = dict(TestDbBackend.test_tags)
+		tags['Keywords'] = u'Bea, Mari'
+		tags['Subject'] = u'Nochevieja2005'
+		tags['HierarchicalSubject'] = u'People|Comuna|Roser, Places|Espa\xf1a|Zaragoza, Placesque'
+		self._db.add_rich_file(*(self._poor_file(1) + (tags,)))
+		self._db.add_item(u'/this/is/a/path', False)
+		self._db.add_item_tags(u'/this/is/a/path', u'/this/is/a/path_1')
+		self.assertEqual(self._db.get_items_by_keyword(u'Mari'), [u'/this/is/a/path'])
+		self.assertEqual(self._db.get_items_by_keyword(u'Nochevieja2005'), [u'/this/is/a/path'])
+		self.assertEqual(self._db.get_items_by_keyword(u'Ma'), [])
+		self.assertEqual(self._db.get_items_by_subject(u'Places'), [u'/this/is/a/path'])
+		self.assertEqual(self._db.get_items_by_subject(u'People|Comuna|Roser'), [u'/this/is/a/path'])
+		self.assertEqual(self._db.get_items_by_subject(u'People|Com'), [])
+		tags['Keywords'] = u'Bea'
+		self._db.update_file(u'/this/is/a/path_1', 1.0, 1234, u'f1l3ch3cksum1', u'c0nt3ntch3cksum1', tags)
+		self.assertEqual(self._db.get_items_by_keyword(u'Mari'), [])
+		self.assertEqual(self._db.get_items_by_keyword(u'Bea'), [u'/this/is/a/path'])
+
+	def test_search(self):
+		'tests that the items are found by the words of their tags, the most relevant first'
+		for (index, model, keywords) in ((1, u'Canon DIGITAL IXUS 50', u'Zaragoza, Bea'), \
+				(2, u'Nikon D70', u'Zaragoza, Zaragoza Centro'), (3, u'Canon EOS', u'Tarragona')):
+			tags = dict(TestDbBackend.test_tags)
+			tags['Model'] = model
+			tags['Keywords'] = keywords
+			self._db.add_rich_file(*(self._poor_file(index) + (tags,)))
+			self._db.add_item(u'/this/is/item_%d' % index, False)
+			self._db.add_item_tags(u'/this/is/item_%d' % index, u'/this/is/a/path_%d' % index)
+		self.assertEqual(sorted(self._db.search(u'canon')), [u'/this/is/item_1', u'/this/is/item_3'])
+		self.assertEqual(self._db.search(u'canon zaragoza'), [u'/this/is/item_1'])
+		self.assertEqual(self._db.search(u'zaragoza')[0], u'/this/is/item_2')
+		tags['Keywords'] = u'Zaragoza'
+		self._db.update_file(u'/this/is/a/path_3', 1.0, 1234, u'f1l3ch3cksum3', u'c0nt3ntch3cksum3', tags)
+		self.assertEqual(self._db.search(u'tarragona'), [])
+		self.assertEqual(len(self._db.search(u'zaragoza')), 3)
+		self.assertEqual(sorted(self._db.search(u'bea OR nikon', fts_syntax=True)), \
+			[u'/this/is/item_1', u'/this/is/item_2'])
+		self.assertRaises(db_backend.ApoDbBadQuery, self._db.search, u'zaragoza OR', fts_syntax=True)
+
+	def test_search_punctuation(self):
+		'tests that the words of the queries are searched as they are, even with punctuation'
+		for (index, model, keywords) in ((1, u'Canon EOS-5D', u'S.L., IMG_0001.JPG'), \
+				(2, u'Canon EOS 5D', u'Say "cheese"')):
+			tags = dict(TestDbBackend.test_tags)
+			tags['Model'] = model
+			tags['Keywords'] = keywords
+			self._db.add_rich_file(*(self._poor_file(index) + (tags,)))
+			self._db.add_item(u'/this/is/item_%d' % index, False)
+			self._db.add_item_tags(u'/this/is/item_%d' % index, u'/this/is/a/path_%d' % index)
+		self.assertEqual(sorted(self._db.search(u'EOS-5D')), [u'/this/is/item_1', u'/this/is/item_2'])
+		self.assertEqual(self._db.search(u'S.L.'), [u'/this/is/item_1'])
+		self.assertEqual(self._db.search(u'IMG_0001.JPG'), [u'/this/is/item_1'])
+		self.assertEqual(self._db.search(u'"cheese"'), [u'/this/is/item_2'])
+		self.assertEqual(self._db.search(u'cheese AND'), [])
+		self.assertEqual(self._db.search(u'  '), [])
+
+	def test_capture_time(self):
+		'tests that the items are found by their capture time, ordered by it'
+		for (index, date_time) in ((1, u'2006:01:01 04:06:15'), (2, u'2005:12:31 23:59:59'), \
+				(3, u'2006:01:01 04:06:15+01:00'), (4, u'0000:00:00 00:00:00')):
+			tags = dict(TestDbBackend.test_tags)
+			tags['DateTimeOriginal'] = date_time
+			self._db.add_rich_file(*(self._poor_file(index) + (tags,)))
+			self._db.add_item(u'/this/is/item_%d' % index, False)
+			self._db.add_item_tags(u'/this/is/item_%d' % index, u'/this/is/a/path_%d' % index)
+		new_year = 1136073600
+		self.assertEqual(self._db.get_items_by_capture_time(new_year, new_year + 86400), \
+			[(u'/this/is/item_3', new_year + 3600 * 3 + 6 * 60 + 15, 60), \
+			(u'/this/is/item_1', new_year + 3600 * 4 + 6 * 60 + 15, None)])
+		self.assertEqual(len(self._db.get_items_by_capture_time(0, new_year)), 1)
+
+	def test_get_items(self):
+		'tests that the items are obtained in bulk with their tags and only their own extra files'
+		tags = TestDbBackend.test_tags
+		self._db.add_poor_files([self._poor_file(index) for index in range(4)])
+		self._db.add_rich_file(*(self._poor_file(4) + (tags,)))
+		self._db.add_items([u'/item/a', u'/item/b', u'/other/c'])
+		self._db.add_items_content([(u'/item/a', u'/this/is/a/path_0'), (u'/other/c', u'/this/is/a/path_3')])
+		self._db.add_items_tags([(u'/item/b', u'/this/is/a/path_4')])
+		self._db.add_extra_files([(u'/this/is/a/path_1', u'/item/a'), (u'/this/is/a/path_2', u'/item/b')])
+		items = list(self._db.get_items([u'/item/b', u'/missing', u'/item/a']))
+		self.assertEqual(sorted([(item.name, item.tags, item.content_file, item.tags_file, item.extra_files) \
+				for item in items]), [ \
+			(u'/item/a', None, u'/this/is/a/path_0', None, [u'/this/is/a/path_1']), \
+			(u'/item/b', records.TagsRecord(tags), u'/this/is/a/path_4', u'/this/is/a/path_4', \
+				[u'/this/is/a/path_2'])])
+		self.assertEqual([item.name for item in self._db.get_items(u'/item/')], [u'/item/a', u'/item/b'])
+		self.assertEqual([item.name for item in self._db.get_items(iter([u'/other/c']))], [u'/other/c'])
+		self.assertEqual(len(list(self._db.get_items())), 3)
+		self.assertEqual(self._db.get_item(u'/item/b')[3], [u'/this/is/a/path_2'])
+		self.assertEqual(self._db.get_item(u'/missing'), None)
+		self.assertEqual([record.path for record in self._db.get_files(u'/this/is/a')], \
+			[u'/this/is/a/path_%d' % index for index in range(5)])
+
+	def test_records(self):
+		'tests that the records have no dictionary and share the values of the common tags'
+		tags = TestDbBackend.test_tags
+		record_1 = records.TagsRecord(tags)
+		record_2 = records.TagsRecord(dict(tags, Model=u''.join(tags['Model'])))
+		self.assertFalse(hasattr(record_1, '__dict__'))
+		self.assertTrue(record_1.Model is record_2.Model)
+		self.assertEqual(record_1.as_dict(), tags)
+		item = camera_item.CameraItem(u'/item/a')
+		item.Model = u''.join(tags['Model'])
+		self.assertTrue(item.Model is record_1.Model)
+		self.assertRaises(AttributeError, setattr, item, 'color', u'red')
+
+	def test_store_item(self):
+		'tests that an item is stored with all its files at once, and extended without repeating them'
+		fields = ['path', 'timestamp', 'file_size', 'file_checksum', 'content_checksum']
+		item_files = [dict(zip(fields, self._poor_file(index)), tags=None) for index in range(4)]
+		item_files[0]['tags'] = TestDbBackend.test_tags
+		stored = self._db.store_item(u'/item/1', item_files[1], item_files[0], [item_files[2]])
+		self.assertEqual(len(stored), 3)
+		(tags, content_file, tags_file, extra_files) = self._db.get_item(u'/item/1')
+		self.assertEqual((tags, content_file, tags_file, extra_files), \
+			(TestDbBackend.test_tags, item_files[1]['path'], item_files[0]['path'], [item_files[2]['path']]))
+		self.assertEqual(self._db.get_items_by_keyword(u'keyws'), [u'/item/1'])
+		# the files already stored are skipped, and a new content file becomes an extra file
+		self.assertEqual(self._db.store_item(u'/item/1', item_files[3], item_files[0]), [item_files[3]['path']])
+		self.assertEqual(self._db.get_item(u'/item/1')[1:], \
+			(item_files[1]['path'], item_files[0]['path'], [item_files[2]['path'], item_files[3]['path']]))
+		self.assertEqual(self._count('files'), 4)
+
 class TestFilesHandler(unittest.TestCase):
 	_jpeg_file_path = "./test.jpg"
 	_tif_file_path = "./test.tif"
@@ -274,10 +570,11 @@ class TestFilesHandler(unittest.TestCase):
 	_audio_file_path = "./test.wav"
 
 	def _checksum(self, path):
-		cmd = files_handler.CHECKSUM_TOOL + ' -b "' + path + '"'
-		output = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
-		lines = output.read().splitlines()
-		return lines[0].split(' ')[0]
+		fd = open(path, 'rb')
+		try:
+			return hashlib.sha512(fd.read(files_handler.READ_FILE_KBS * checksum_engine.KB)).hexdigest()
+		finally:
+			fd.close()
 
 	def setUp(self):
 		# instanciate a FileHandler object
@@ -303,10 +600,14 @@ class TestFilesHandler(unittest.TestCase):
 		(file_checksum, content_checksum)= cur.fetchone()
 		FILE_CHECKSUM = self._checksum(path)
 		self.assertTrue(file_checksum == FILE_CHECKSUM)
+		# the content checksum is calculated from the image decoded at a reduced scale
+		self.assertTrue(content_checksum == self._fileshandler._image_checksum(path))
+		# the legacy algorithm, decoding the whole image, keeps its checksum
 		CONTENT_CHECKSUM = '562fbb377e28a0577356a35ad1b17dbdbdccbdfb74df810c2' + \
 			'e156cecd27613e209675c404a1eac05c0e2dbabedc92abf77f3267f1d14c7d2c' + \
 			'246cf1bd49f7724'
-		self.assertTrue(content_checksum == CONTENT_CHECKSUM)
+		self.assertTrue(self._fileshandler._image_checksum(path, files_handler.LEGACY_CHECKSUM_VERSION) == \
+			CONTENT_CHECKSUM)
 		# test the expected tag values
 		cur.execute("SELECT tags.* FROM tags, files " + \
 					"WHERE files.tags = tags.tags_id AND files.path = ?;", \
@@ -423,6 +724,752 @@ class TestFilesHandler(unittest.TestCase):
 			'79a5c45b8250758'
 		self.assertTrue(content_checksum == CONTENT_CHECKSUM)
 
+class TestChecksumEngine(unittest.TestCase):
+	_file_path = './test.wav'
+
+	def _read(self, path, skip_kbs=0, count_kbs=-1):
+		fd = open(path, 'rb')
+		try:
+			fd.seek(skip_kbs * checksum_engine.KB)
+			if count_kbs < 0:
+				return fd.read()
+			return fd.read(count_kbs * checksum_engine.KB)
+		finally:
+			fd.close()
+
+	def test_full_checksum(self):
+		'tests that the checksum of the whole file is the same whatever the size of the chunks read'
+		if checksum_engine.blake2b != None:
+			cksm = checksum_engine.blake2b()
+		else:
+			cksm = hashlib.sha512()
+		cksm.update(self._read(self._file_path))
+		CHECKSUM = '%s:%s' % (checksum_engine.FULL_CHECKSUM_ALGORITHM, cksm.hexdigest())
+		for chunk_kbs in (1, 3, 64):
+			engine = checksum_engine.ChecksumEngine(chunk_kbs)
+			self.assertEqual(engine.full_checksum(self._file_path), CHECKSUM)
+
+	def test_file_contents(self):
+		'tests that the windows of the contents mapped in memory are the ones read from the file'
+		contents = files_handler.FileContents(self._file_path)
+		try:
+			self.assertEqual(contents.stat.st_size, os.path.getsize(self._file_path))
+			for (skip_kbs, count_kbs) in ((0, 64), (3, 7), (contents.stat.st_size / 1024 + 1, 64)):
+				self.assertEqual(contents.window(skip_kbs, count_kbs), \
+					self._read(self._file_path, skip_kbs, count_kbs))
+			self.assertEqual(contents.reader().read(4), 'RIFF')
+		finally:
+			contents.close()
+		self.assertRaises(IOError, files_handler.FileContents, '.')
+
+class TestDedup(unittest.TestCase):
+	_db_path = '/tmp/test_auphorg_dedup.db'
+	_tree_path = '/tmp/test_auphorg_dedup'
+
+	def _write_file(self, name, contents):
+		path = os.path.join(self._tree_path, name)
+		with open(path, 'wb') as fd:
+			fd.write(contents)
+		return unicode(path)
+
+	def setUp(self):
+		if os.path.exists(self._db_path):
+			os.remove(self._db_path)
+		os.mkdir(self._tree_path)
+		self._fileshandler = files_handler.FilesHandler(multiprocessing.Lock(), self._db_path)
+		# the files share their first 64KB, but only two of them are duplicates
+		start = os.urandom(files_handler.READ_FILE_KBS * 1024)
+		files = [self._write_file('a.avi', start + 'end'), self._write_file('b.avi', start + 'END'), \
+			self._write_file('c.avi', start + 'end'), self._write_file('d.avi', start + 'longer end')]
+		db = self._fileshandler._db
+		db.add_poor_files([(path, u'0', os.path.getsize(path), \
+			self._fileshandler._file_checksum(files_handler.FileContents(path)), u'') for path in files])
+
+	def tearDown(self):
+		self._fileshandler = None
+		os.remove(self._db_path)
+		shutil.rmtree(self._tree_path)
+
+	def test_verified_duplicates(self):
+		'tests that only the files with the same content are reported as duplicates'
+		duplicates = list(self._fileshandler.verified_duplicates())
+		self.assertEqual([sorted(paths) for paths in duplicates], \
+			[[os.path.join(self._tree_path, 'a.avi'), os.path.join(self._tree_path, 'c.avi')]])
+
+	def test_duplicates_query(self):
+		'tests that the DB groups the files by the checksum of their start, ignoring the empty checksums'
+		duplicates = list(self._fileshandler._db.get_duplicates('file_checksum'))
+		self.assertEqual(len(duplicates), 1)
+		self.assertEqual(len(duplicates[0][1]), 4)
+		self.assertEqual(list(self._fileshandler._db.get_duplicates('content_checksum')), [])
+		self.assertRaises(ValueError, list, self._fileshandler._db.get_duplicates('path'))
+
+	def test_full_checksums_stored(self):
+		'tests that the whole files are only hashed if they have candidates to duplicates'
+		list(self._fileshandler.verified_duplicates())
+		db = sqlite3.connect(self._db_path)
+		full_checksums = dict(db.execute('SELECT path, full_checksum FROM files;').fetchall())
+		db.close()
+		self.assertEqual(full_checksums[os.path.join(self._tree_path, 'd.avi')], None)
+		self.assertEqual(full_checksums[os.path.join(self._tree_path, 'a.avi')], \
+			full_checksums[os.path.join(self._tree_path, 'c.avi')])
+		self.assertNotEqual(full_checksums[os.path.join(self._tree_path, 'a.avi')], \
+			full_checksums[os.path.join(self._tree_path, 'b.avi')])
+
+class TestPerceptualHash(unittest.TestCase):
+	_tree_path = '/tmp/test_auphorg_bktree'
+
+	def setUp(self):
+		os.mkdir(self._tree_path)
+
+	def tearDown(self):
+		shutil.rmtree(self._tree_path)
+
+	def _image(self, shift = 0):
+		img = Image.new('L', (160, 120))
+		img.putdata([(x * 2 + y + shift) % 256 for y in range(120) for x in range(160)])
+		return img
+
+	def test_similar_images(self):
+		'tests that an image saved with a different quality keeps almost the same hash'
+		path = os.path.join(self._tree_path, 'image.jpg')
+		self._image().save(path, quality=95)
+		hash_1 = perceptual_hash.dhash(Image.open(path))
+		self._image().save(path, quality=30)
+		hash_2 = perceptual_hash.dhash(Image.open(path))
+		self.assertTrue(perceptual_hash.hamming(int(hash_1, 16), int(hash_2, 16)) <= \
+			perceptual_hash.NEAR_DUP_DISTANCE)
+		self.assertEqual(len(hash_1), perceptual_hash.DHASH_SIZE * perceptual_hash.DHASH_SIZE / 4)
+
+	def test_tree_search(self):
+		'tests that the tree finds the same hashes as comparing the given one with all of them'
+		hashes = [('%016x' % ((index * 0x9e3779b97f4a7c15) % (1 << 64)), 'file_%d' % index) for index in range(500)]
+		tree = perceptual_hash.BKTree()
+		for (image_hash, path) in hashes:
+			tree.add(image_hash, path)
+		for (image_hash, _) in hashes[::50]:
+			found = sorted([(perceptual_hash.hamming(int(image_hash, 16), int(other_hash, 16)), path) \
+				for (other_hash, path) in hashes])
+			found = [(distance, path) for (distance, path) in found if distance <= 24]
+			self.assertEqual(tree.find(image_hash, 24), found)
+
+	def test_tree_stored(self):
+		'tests that the tree is only rebuilt if the DB changed'
+		db_path = os.path.join(self._tree_path, 'db')
+		tree_path = db_path + perceptual_hash.TREE_SUFFIX
+		open(db_path, 'w').close()
+		tree = perceptual_hash.load_tree(tree_path, db_path, [('file_1', '00000000000000ff')])
+		self.assertEqual(len(tree), 1)
+		tree = perceptual_hash.load_tree(tree_path, db_path, [])
+		self.assertEqual(tree.find('00000000000000fe'), [(1, 'file_1')])
+		with open(db_path, 'w') as db_file:
+			db_file.write('changed')
+		tree = perceptual_hash.load_tree(tree_path, db_path, [])
+		self.assertEqual(len(tree), 0)
+
+class TestScanProfile(unittest.TestCase):
+
+	def test_percentiles(self):
+		'tests that the percentiles of merged profiles are within a bucket of the exact ones'
+		(profile_1, profile_2) = (scan_profile.ScanProfile(), scan_profile.ScanProfile())
+		for index in range(1, 101):
+			(profile_1, profile_2)[index % 2].add('stage', index / 1000.0)
+		profile_1.merge(profile_2)
+		stats = profile_1.stages['stage']
+		self.assertEqual(stats.count, 100)
+		self.assertAlmostEqual(stats.total_s, 5.05)
+		for percent in scan_profile.PERCENTILES:
+			self.assertTrue(percent / 1000.0 <= stats.percentile(percent) <= \
+				percent / 1000.0 * 2 ** (1.0 / scan_profile.BUCKETS_PER_DOUBLING))
+
+	def test_stages(self):
+		'tests that the bytes read are counted in the innermost stage being measured'
+		scan_profile.reset()
+		with scan_profile.stage('outer'):
+			scan_profile.count_bytes(10)
+			with scan_profile.stage('inner'):
+				scan_profile.count_bytes(5)
+		scan_profile.count_bytes(1)
+		stages = scan_profile.reset().as_dict()
+		self.assertEqual(sorted(stages.keys()), ['inner', 'outer'])
+		self.assertEqual((stages['outer']['bytes_read'], stages['inner']['bytes_read']), (10, 5))
+		self.assertTrue(stages['outer']['total_s'] >= stages['inner']['total_s'])
+
+	def test_contents_reader(self):
+		'tests that the bytes read from the contents mapped in memory are counted'
+		contents = files_handler.FileContents('./test.wav')
+		try:
+			scan_profile.reset()
+			with scan_profile.stage('read'):
+				reader = contents.reader()
+				self.assertEqual(reader.read(4), 'RIFF')
+				reader.seek(8)
+				self.assertEqual(reader.read(4), 'WAVE')
+				self.assertEqual(reader.tell(), 12)
+				self.assertEqual(len(reader.read()), contents.stat.st_size - 12)
+			stages = scan_profile.reset().as_dict()
+			self.assertEqual(stages['read']['bytes_read'], contents.stat.st_size - 4)
+		finally:
+			contents.close()
+
+class TestMetadataExtractor(unittest.TestCase):
+	_exiftool_cmd = [sys.executable, './exiftool_stub.py']
+	_tags = ['Model', 'Software']
+
+	def setUp(self):
+		# instanciate an extractor driving the exiftool stub
+		self._extractor = metadata_extractor.ExifToolExtractor(self._tags, self._exiftool_cmd, 3)
+
+	def tearDown(self):
+		self._extractor.close()
+
+	def _exiftool_pid(self, path):
+		# the stub answers every tag with its name followed by its PID
+		return self._extractor.get_tags(path)['Model'].split(' ')[1]
+
+	def test_get_tags(self):
+		'tests that the requested tags are returned'
+		tags = self._extractor.get_tags(u'./test.jpg')
+		self.assertEqual(sorted(tags.keys()), sorted(self._tags))
+		self.assertEqual(tags['Software'].split(' ')[0], u'Software')
+
+	def test_process_reused(self):
+		'tests that the same exiftool process handles consecutive requests'
+		pids = [self._exiftool_pid('./test_%d.jpg' % i) for i in range(3)]
+		self.assertEqual(len(set(pids)), 1)
+
+	def test_process_restarted(self):
+		'tests that the exiftool process is restarted after the maximum number of requests'
+		pids = [self._exiftool_pid('./test_%d.jpg' % i) for i in range(4)]
+		self.assertEqual(len(set(pids[:3])), 1)
+		self.assertNotEqual(pids[2], pids[3])
+
+	def test_process_crashed(self):
+		'tests that a crashed exiftool process is replaced by a new one'
+		pid = self._exiftool_pid('./test.jpg')
+		self.assertRaises(metadata_extractor.ApoExifToolDied, self._extractor.get_tags, './crash.jpg')
+		self.assertNotEqual(self._exiftool_pid('./test.jpg'), pid)
+
+	def test_get_tags_batch(self):
+		'tests that the tags of a batch of files are obtained with a single request'
+		paths = [u'./test_%d.jpg' % i for i in range(5)]
+		files_tags = self._extractor.get_tags_batch(paths)
+		self.assertEqual(sorted(files_tags.keys()), paths)
+		self.assertEqual(len(set([tags['Model'] for tags in files_tags.values()])), 1)
+		self.assertEqual(sorted(files_tags[paths[0]].keys()), sorted(self._tags))
+
+	def test_get_tags_batch_crashed(self):
+		'tests that the files of a batch that crashes exiftool are handled individually'
+		paths = [u'./test_1.jpg', u'./crash.jpg', u'./test_2.jpg']
+		files_tags = self._extractor.get_tags_batch(paths)
+		self.assertEqual(sorted(files_tags.keys()), [u'./test_1.jpg', u'./test_2.jpg'])
+
+class TestExifParser(unittest.TestCase):
+	_dir_path = '/tmp/test_auphorg_exif'
+	_exiftool_cmd = [sys.executable, './exiftool_stub.py']
+	_xmp = '<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>' + \
+		'<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">' + \
+		'<rdf:Description rdf:about="" xmlns:dc="http://purl.org/dc/elements/1.1/" ' + \
+		'xmlns:lr="http://ns.adobe.com/lightroom/1.0/" xmlns:digiKam="http://www.digikam.org/ns/1.0/" ' + \
+		'xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmlns:tiff="http://ns.adobe.com/tiff/1.0/" ' + \
+		'xmp:CreateDate="2005-12-31T23:59:59+01:00" %s>' + \
+		'<dc:subject><rdf:Bag><rdf:li>uno</rdf:li><rdf:li>\xc3\xb1u</rdf:li></rdf:Bag></dc:subject>' + \
+		'<lr:hierarchicalSubject><rdf:Bag><rdf:li>People|Roser</rdf:li></rdf:Bag></lr:hierarchicalSubject>' + \
+		'<digiKam:TagsList><rdf:Seq><rdf:li>People/Roser</rdf:li></rdf:Seq></digiKam:TagsList>' + \
+		'</rdf:Description></rdf:RDF></x:xmpmeta><?xpacket end="w"?>'
+
+	def setUp(self):
+		os.mkdir(self._dir_path)
+
+	def tearDown(self):
+		shutil.rmtree(self._dir_path)
+
+	def _ifd(self, entries, offset):
+		# little-endian IFD at the offset with ASCII and LONG entries, followed by the data of the long strings
+		data_offset = offset + 2 + len(entries) * 12 + 4
+		(ifd, data) = (struct.pack('<H', len(entries)), '')
+		for (tag, value) in sorted(entries.items()):
+			if isinstance(value, int):
+				ifd += struct.pack('<HHII', tag, 4, 1, value)
+				continue
+			value += '\x00'
+			if len(value) <= 4:
+				ifd += struct.pack('<HHI', tag, 2, len(value)) + value.ljust(4, '\x00')
+			else:
+				ifd += struct.pack('<HHII', tag, 2, len(value), data_offset + len(data))
+				data += value
+		return ifd + struct.pack('<I', 0) + data
+
+	def _exif(self, model):
+		ifd0 = {0x010f: model, 0x0131: 'soft ', 0x8769: 0}
+		ifd0[0x8769] = 8 + len(self._ifd(ifd0, 8))
+		exif_ifd = self._ifd({0x9003: '2005:12:31 23:59:59'}, ifd0[0x8769])
+		return exif_parser.EXIF_HEADER + 'II*\x00' + struct.pack('<I', 8) + self._ifd(ifd0, 8) + exif_ifd
+
+	def _iptc(self, keywords):
+		datasets = ''.join(['\x1c\x02\x19' + struct.pack('>H', len(keyword)) + keyword for keyword in keywords])
+		return exif_parser.PHOTOSHOP_HEADER + '8BIM' + struct.pack('>HHI', exif_parser.IRB_IPTC, 0, \
+			len(datasets)) + datasets
+
+	def _jpeg(self, name, segments):
+		# JPEG file with the given APP segments after its start
+		path = os.path.join(self._dir_path, name)
+		Image.new('RGB', (64, 48), (10, 20, 30)).save(path)
+		with open(path, 'rb') as jpeg_file:
+			data = jpeg_file.read()
+		header = ''.join(['\xff' + chr(marker) + struct.pack('>H', len(payload) + 2) + payload \
+			for (marker, payload) in segments])
+		with open(path, 'wb') as jpeg_file:
+			jpeg_file.write(data[:2] + header + data[2:])
+		return path
+
+	def _tagged_jpeg(self, name, xmp_model = ''):
+		return self._jpeg(name, [(exif_parser.JPEG_APP1, self._exif('C\xc3\xa1mara')), \
+			(exif_parser.JPEG_APP1, exif_parser.XMP_HEADER + self._xmp % xmp_model), \
+			(exif_parser.JPEG_APP13, self._iptc(['A\xf1o', 'Nochevieja2005']))])
+
+	def test_native_tags(self):
+		'tests that the tags are read from the EXIF, XMP and IPTC segments, decoded as the exiftool output'
+		with open(self._tagged_jpeg('tagged.jpg'), 'rb') as jpeg_file:
+			tags = exif_parser.read_tags(jpeg_file)
+		self.assertEqual(tags, {'Model': u'C\xc3\xa1mara', 'Software': u'soft', \
+			'DateTimeOriginal': u'2005:12:31 23:59:59', 'CreateDate': u'2005:12:31 23:59:59+01:00', \
+			'ImageWidth': u'64', 'ImageHeight': u'48', 'Subject': u'uno, \xc3\xb1u', \
+			'HierarchicalSubject': u'People|Roser', 'TagsList': u'People/Roser', \
+			'Keywords': u'A\xc3\xb1o, Nochevieja2005'})
+
+	def test_fallback(self):
+		'tests that exiftool gets the tags of the files that cannot be read as it would do'
+		fallback = metadata_extractor.ExifToolExtractor(['Model', 'Software'], self._exiftool_cmd)
+		extractor = metadata_extractor.NativeExtractor(['Model', 'Software'], fallback)
+		try:
+			self.assertEqual(extractor.get_tags(self._tagged_jpeg('tagged.jpg')), \
+				{'Model': u'C\xc3\xa1mara', 'Software': u'soft'})
+			# the model of the XMP packet doesn't match the one of the EXIF segment
+			conflict_path = self._tagged_jpeg('conflict.jpg', 'tiff:Model="Other"')
+			self.assertEqual(extractor.get_tags(conflict_path)['Model'].split(' ')[0], u'Model')
+			files_tags = extractor.get_tags_batch([conflict_path, u'./test.wav'])
+			self.assertEqual(sorted(files_tags.keys()), sorted([conflict_path, u'./test.wav']))
+		finally:
+			extractor.close()
+
+	def test_batch_contents(self):
+		'tests that the tags of a batch are read from the contents already opened, which the analysis reuses'
+		path = unicode(self._tagged_jpeg('tagged.jpg'))
+		fallback = metadata_extractor.ExifToolExtractor(['Model', 'Software'], self._exiftool_cmd)
+		extractor = metadata_extractor.NativeExtractor(['Model', 'Software'], fallback)
+		fileshandler = files_handler.FilesHandler(multiprocessing.Lock(), extractor = extractor, connect_db = False)
+		contents = files_handler.FileContents(path)
+		try:
+			# the file is removed, so that it can only be read from its contents
+			os.remove(path)
+			files_tags = fileshandler.get_tags_batch([path], {path: contents})
+			self.assertEqual(files_tags, {path: {'Model': u'C\xc3\xa1mara', 'Software': u'soft'}})
+			record = fileshandler.analyze_file(path, files_tags[path], contents)
+			self.assertEqual(record['tags'], files_tags[path])
+			self.assertEqual(record['file_size'], contents.stat.st_size)
+			self.assertEqual(contents.reader().read(2), exif_parser.JPEG_SOI)
+		finally:
+			contents.close()
+			extractor.close()
+
+	def test_raw_preview(self):
+		'tests that the RAW files are fingerprinted from their embedded JPEG preview, as the JPEG files'
+		jpeg_path = self._jpeg('P1000001.jpg', [])
+		with open(jpeg_path, 'rb') as jpeg_file:
+			preview = jpeg_file.read()
+		# Panasonic RAW file with the preview in its IFD0, and a smaller one in its IFD1
+		ifd1 = 8 + 2 + 12 + 4 + len(preview)
+		raw = 'IIU\x00' + struct.pack('<I', 8) + struct.pack('<HHHII', 1, exif_parser.RAW_JPEG_TAG, 7, \
+			len(preview), 26) + struct.pack('<I', ifd1) + preview + \
+			struct.pack('<HHHIIHHII', 2, exif_parser.JPEG_OFFSET_TAG, 4, 1, ifd1 + 30, \
+			exif_parser.JPEG_LENGTH_TAG, 4, 1, 4) + struct.pack('<I', 0) + exif_parser.JPEG_SOI + '\xff\xd9'
+		self.assertEqual(exif_parser.raw_preview(raw), preview)
+		self.assertRaises(exif_parser.ApoExifError, exif_parser.raw_preview, raw[:ifd1])
+		self.assertRaises(exif_parser.ApoExifError, exif_parser.raw_preview, raw[:ifd1 + 8])
+		# the malformed IFD1, without offset of its preview or with it out of the file, is reported as such
+		for malformed_entry in (struct.pack('<HHII', exif_parser.JPEG_OFFSET_TAG, 4, 0, 0), \
+				struct.pack('<HHII', exif_parser.JPEG_OFFSET_TAG, 4, 1, len(raw))):
+			malformed_raw = raw[:ifd1 + 2] + malformed_entry + raw[ifd1 + 14:]
+			self.assertRaises(exif_parser.ApoExifError, exif_parser.raw_preview, malformed_raw)
+		raw_path = os.path.join(self._dir_path, 'P1000001.RW2')
+		with open(raw_path, 'wb') as raw_file:
+			raw_file.write(raw)
+		fileshandler = files_handler.FilesHandler(multiprocessing.Lock(), connect_db = False)
+		raw_record = fileshandler.analyze_file(raw_path)
+		jpeg_record = fileshandler.analyze_file(jpeg_path)
+		self.assertEqual(raw_record['item_type'], 'RAW')
+		# the RAW files whose preview cannot be read are still analyzed
+		malformed_path = os.path.join(self._dir_path, 'P1000002.RW2')
+		with open(malformed_path, 'wb') as raw_file:
+			raw_file.write(malformed_raw)
+		self.assertEqual(fileshandler.analyze_file(malformed_path)['item_type'], 'RAW')
+		for record in (raw_record, jpeg_record):
+			self.assertIsNotNone(record['content_checksum'])
+			self.assertIsNotNone(record['perceptual_hash'])
+		self.assertEqual(raw_record['content_checksum'], jpeg_record['content_checksum'])
+		self.assertEqual(raw_record['perceptual_hash'], jpeg_record['perceptual_hash'])
+
+	def _scanned_db(self):
+		# DB with the tags of the tagged file read as when scanning it, and the name of its item
+		path = unicode(self._tagged_jpeg('tagged.jpg'))
+		fileshandler = files_handler.FilesHandler(multiprocessing.Lock(), os.path.join(self._dir_path, 'tags.db'))
+		fileshandler.add_file(path)
+		return (fileshandler._db, os.path.splitext(path)[0])
+
+	def test_scanned_keywords(self):
+		'tests that the items are found by the non ASCII keywords and subjects read from their files'
+		(db, item_name) = self._scanned_db()
+		self.assertEqual(db.get_items_by_keyword(u'A\xf1o'), [item_name])
+		self.assertEqual(db.get_items_by_keyword(u'\xf1u'), [item_name])
+		self.assertEqual(db.get_items_by_keyword(u'Ano'), [])
+		self.assertEqual(db.get_items_by_subject(u'People'), [item_name])
+
+	def test_scanned_search(self):
+		'tests that the items are found by the non ASCII words of the tags read from their files'
+		(db, item_name) = self._scanned_db()
+		self.assertEqual(db.search(u'A\xf1o'), [item_name])
+		self.assertEqual(db.search(u'\xf1u AND C\xe1mara', fts_syntax=True), [item_name])
+		self.assertEqual(db.search(u'A\xf1os'), [])
+
+	@unittest.skipUnless(os.path.exists(metadata_extractor.EXIF_TOOL), 'exiftool not installed')
+	def test_exiftool_parity(self):
+		'tests that the tags read in-process are the ones given by exiftool'
+		paths = [self._tagged_jpeg('tagged.jpg'), self._jpeg('plain.jpg', []), \
+			self._jpeg('exif.jpg', [(exif_parser.JPEG_APP1, self._exif('Model X'))])]
+		exiftool = metadata_extractor.ExifToolExtractor(files_handler.TAGS_TO_GET)
+		try:
+			for path in paths:
+				with open(path, 'rb') as jpeg_file:
+					self.assertEqual(exif_parser.read_tags(jpeg_file), exiftool.get_tags(path))
+		finally:
+			exiftool.close()
+
+class TestVideoFingerprint(unittest.TestCase):
+	_frames = ['frame %d ' % index * (index + 1) for index in range(3)]
+	_sound = 'sound'
+
+	def _riff(self, chunk_id, data):
+		return chunk_id + struct.pack('<I', len(data)) + data + '\x00' * (len(data) % 2)
+
+	def _avi(self):
+		# the audio is the first stream, with a dropped frame and a "rec " list among the chunks of the video
+		header = self._riff('LIST', 'hdrl' + self._riff('avih', '\x00' * 56) + \
+			self._riff('LIST', 'strl' + self._riff('strh', 'auds' + '\x00' * 52)) + \
+			self._riff('LIST', 'strl' + self._riff('strh', 'vids' + '\x00' * 52)))
+		movi = self._riff('LIST', 'movi' + self._riff('00wb', self._sound) + self._riff('01dc', self._frames[0]) + \
+			self._riff('01dc', '') + self._riff('LIST', 'rec ' + self._riff('01dc', self._frames[1]) + \
+			self._riff('00wb', self._sound)) + self._riff('01dc', self._frames[2]))
+		return self._riff('RIFF', 'AVI ' + header + movi)
+
+	def _atom(self, atom_type, data):
+		return struct.pack('>I', len(data) + 8) + atom_type + data
+
+	def _trak(self, handler, sizes, offsets, runs):
+		stbl = self._atom('stsz', struct.pack('>III', 0, 0, len(sizes)) + ''.join([struct.pack('>I', size) \
+			for size in sizes])) + \
+			self._atom('stco', struct.pack('>II', 0, len(offsets)) + ''.join([struct.pack('>I', offset) \
+			for offset in offsets])) + \
+			self._atom('stsc', struct.pack('>II', 0, len(runs)) + ''.join([struct.pack('>III', first, count, 1) \
+			for (first, count) in runs]))
+		return self._atom('trak', self._atom('mdia', self._atom('hdlr', struct.pack('>II', 0, 0) + handler) + \
+			self._atom('minf', self._atom('stbl', stbl))))
+
+	def _quicktime(self):
+		# the first chunk of the video has 2 frames and the second one 1, after the sound
+		ftyp = self._atom('ftyp', 'qt  \x00\x00\x00\x00')
+		mdat = self._atom('mdat', self._frames[0] + self._frames[1] + self._sound + self._frames[2])
+		start = len(ftyp) + 8
+		video_offsets = [start, start + len(self._frames[0] + self._frames[1] + self._sound)]
+		sound_offset = start + len(self._frames[0] + self._frames[1])
+		moov = self._atom('moov', self._trak('soun', [len(self._sound)], [sound_offset], [(1, 1)]) + \
+			self._trak('vide', [len(frame) for frame in self._frames], video_offsets, [(1, 2), (2, 1)]))
+		return ftyp + mdat + moov
+
+	def _asf(self):
+		# packets of fixed size with several payloads, the video being the stream 2
+		packet_size = 64
+		file_properties = video_fingerprint.ASF_FILE_PROPERTIES + struct.pack('<Q', 104) + '\x00' * 68 + \
+			struct.pack('<III', packet_size, packet_size, 0)
+		stream_properties = video_fingerprint.ASF_STREAM_PROPERTIES + struct.pack('<Q', 78) + \
+			video_fingerprint.ASF_VIDEO_MEDIA + '\x00' * 32 + struct.pack('<H', 2) + '\x00' * 4
+		header = video_fingerprint.ASF_HEADER + struct.pack('<QIBB', 30 + len(file_properties) + \
+			len(stream_properties), 2, 1, 2) + file_properties + stream_properties
+		packets = ''
+		for payloads in [[(1, self._sound), (2, self._frames[0])], [(2, self._frames[1]), (2, self._frames[2])]]:
+			# padding length of a byte, and payloads with media object number, offset and replicated data length
+			# of a byte, and payload length of 2 bytes
+			packet = struct.pack('<BBB', 0x09, 0x55, 0) + struct.pack('<IH', 0, 0) + \
+				struct.pack('<B', 0x80 + len(payloads))
+			for (stream, payload) in payloads:
+				packet += struct.pack('<BBBBH', stream, 0, 0, 0, len(payload)) + payload
+			packet_padding = packet_size - len(packet)
+			packets += packet[:2] + struct.pack('<B', packet_padding) + packet[3:] + '\x00' * packet_padding
+		data = video_fingerprint.ASF_DATA + struct.pack('<Q', 50 + len(packets)) + '\x00' * 16 + \
+			struct.pack('<QH', 2, 0) + packets
+		return header + data
+
+	def _fingerprint(self, data):
+		return video_fingerprint.fingerprint(lambda offset, size: data[offset:offset + size], len(data))
+
+	def test_containers(self):
+		'tests that the fingerprint of the videos is the checksum of their frames, whatever their container'
+		frames_checksum = hashlib.sha512(''.join(self._frames)).hexdigest()
+		for data in (self._avi(), self._quicktime(), self._asf()):
+			self.assertEqual(self._fingerprint(data), frames_checksum)
+		# only the first frames are hashed
+		first_frames = video_fingerprint.VIDEO_SAMPLES
+		try:
+			video_fingerprint.VIDEO_SAMPLES = 2
+			self.assertEqual(self._fingerprint(self._quicktime()), \
+				hashlib.sha512(''.join(self._frames[:2])).hexdigest())
+		finally:
+			video_fingerprint.VIDEO_SAMPLES = first_frames
+
+	def test_invalid_containers(self):
+		'tests that the videos whose container cannot be parsed fail'
+		for data in ('', 'not a video', self._avi()[:100], self._quicktime()[:40]):
+			self.assertRaises(video_fingerprint.ApoVideoError, self._fingerprint, data)
+
+class TestAudioFingerprint(unittest.TestCase):
+	_dir_path = '/tmp/test_auphorg_audio'
+	# levels of the sound every half second, as fractions of the full scale
+	_levels = [0.1, 0.5, 0.2, 0.9, 0.3, 0.05, 0.7, 0.4, 0.8, 0.15, 0.6, 0.35]
+
+	def setUp(self):
+		os.mkdir(self._dir_path)
+
+	def tearDown(self):
+		shutil.rmtree(self._dir_path)
+
+	def _wav(self, name, rate, width, channels, silence_s = 0, levels = None):
+		# tone whose level changes every half second, after the given silence
+		if levels == None:
+			levels = self._levels
+		samples = [0] * (rate * silence_s)
+		for level in levels:
+			samples += [int(level * 32767 * math.sin(2 * math.pi * 440 * index / rate)) for index in range(rate / 2)]
+		if width == 3:
+			frames = ''.join([struct.pack('<i', sample << 8)[:3] * channels for sample in samples])
+		else:
+			frames = ''.join([struct.pack('<h', sample) * channels for sample in samples])
+		path = os.path.join(self._dir_path, name)
+		wav = wave.open(path, 'wb')
+		wav.setparams((channels, width, rate, len(samples), 'NONE', 'not compressed'))
+		wav.writeframes(frames)
+		wav.close()
+		return (path, frames)
+
+	def _fingerprint(self, path):
+		with open(path, 'rb') as wav_file:
+			return audio_fingerprint.fingerprint(wav_file)
+
+	def test_whole_stream(self):
+		'tests that the checksum of the audio is the one of all its frames'
+		(path, frames) = self._wav('tone.wav', 8000, 2, 1)
+		self.assertEqual(self._fingerprint(path)[0], hashlib.sha512(frames).hexdigest())
+		# the frames after the first ones are hashed too
+		(other_path, _) = self._wav('other.wav', 8000, 2, 1, levels = self._levels[:-1] + [0.25])
+		self.assertNotEqual(self._fingerprint(other_path)[0], self._fingerprint(path)[0])
+
+	def test_signature(self):
+		'tests that the signature of the audio is the same for other formats and leading silences'
+		(checksum, signature) = self._fingerprint(self._wav('tone.wav', 8000, 2, 1)[0])
+		(other_checksum, other_signature) = self._fingerprint(self._wav('other.wav', 16000, 3, 2, 1)[0])
+		self.assertNotEqual(other_checksum, checksum)
+		self.assertEqual(other_signature, signature)
+		self.assertEqual(len(signature), audio_fingerprint.SIGNATURE_BITS / 4)
+		self.assertEqual(self._fingerprint(self._wav('silence.wav', 8000, 2, 1, 1, [])[0])[1], None)
+
+class TestScanPipeline(unittest.TestCase):
+	_tree_path = '/tmp/test_auphorg_scan'
+	_db_path = '/tmp/test_auphorg_scan.db'
+
+	def setUp(self):
+		if os.path.exists(self._db_path):
+			os.remove(self._db_path)
+		os.makedirs(os.path.join(self._tree_path, 'a'))
+		tree_scanner.lock = multiprocessing.Lock()
+		tree_scanner.processed = multiprocessing.Value('i', 0)
+
+	def tearDown(self):
+		shutil.rmtree(self._tree_path)
+		for path in (self._db_path, self._db_path + perceptual_hash.TREE_SUFFIX):
+			if os.path.exists(path):
+				os.remove(path)
+		tree_scanner.records_queue = None
+
+	def _image(self, name, color = (10, 20, 30)):
+		path = os.path.join(self._tree_path, 'a', name)
+		Image.new('RGB', (64, 48), color).save(path, 'JPEG')
+		return path
+
+	def _scan(self, **options):
+		# returns the scanner, with the number of files processed by the scan in "n_processed"
+		tree_scanner.processed.value = 0
+		scanner = tree_scanner.TreeScanner(**options)
+		scanner.init_pool(False, self._db_path)
+		try:
+			scanner.scan_tree(self._tree_path)
+		finally:
+			pool = tree_scanner.TreeScanner._pool
+			tree_scanner.TreeScanner._pool = None
+			pool.close()
+			pool.join()
+		scanner.n_processed = tree_scanner.processed.value
+		return scanner
+
+	def _file_ids(self):
+		db = sqlite3.connect(self._db_path)
+		try:
+			return dict(db.execute('SELECT path, file_id FROM files;').fetchall())
+		finally:
+			db.close()
+
+	def _files(self):
+		db = sqlite3.connect(self._db_path)
+		try:
+			return db.execute('SELECT path, timestamp, file_size, content_checksum FROM files ORDER BY path;').fetchall()
+		finally:
+			db.close()
+
+	def test_incremental(self):
+		'tests that the scans skip the files already in the DB, updating the changed ones if incremental'
+		(path_1, path_2) = (self._image('IMG_1.jpg'), self._image('IMG_2.jpg'))
+		mtime = 1476802345.123456789
+		os.utime(path_2, (mtime, mtime))
+		self.assertEqual(self._scan().n_processed, 2)
+		file_ids = self._file_ids()
+		self.assertEqual(self._scan().n_processed, 0)
+		self.assertEqual(self._scan(incremental=True).n_processed, 0)
+		# the first file changes its size and the second one its timestamp
+		Image.new('RGB', (128, 96), (200, 20, 30)).save(path_1, 'JPEG')
+		os.utime(path_2, (mtime + 1, mtime + 1))
+		self.assertEqual(self._scan().n_processed, 0)
+		self.assertEqual(self._scan(incremental=True).n_processed, 2)
+		self.assertEqual(self._file_ids(), file_ids)
+		files = dict([(path, (timestamp, file_size)) for (path, timestamp, file_size, _) in self._files()])
+		self.assertEqual(files[unicode(path_1)][1], os.path.getsize(path_1))
+		self.assertEqual(files[unicode(path_2)][0], os.stat(path_2).st_mtime)
+		self.assertEqual(self._scan(incremental=True).n_processed, 0)
+		# the timestamps rounded by the older DBs match their files
+		db = sqlite3.connect(self._db_path)
+		db.execute('UPDATE files SET timestamp = ? WHERE path = ?;', \
+			[float('%.15g' % os.stat(path_2).st_mtime), unicode(path_2)])
+		db.commit()
+		db.close()
+		self.assertNotEqual(self._files()[1][1], os.stat(path_2).st_mtime)
+		self.assertEqual(self._scan(incremental=True).n_processed, 0)
+
+	def test_tree_walked(self):
+		'tests that the walk finds all the files of the tree, with and without scandir, not following links'
+		os.makedirs(os.path.join(self._tree_path, 'b'))
+		expected = [os.path.join(self._tree_path, path) for path in \
+			('a/IMG_1.jpg', 'a/IMG_2.avi', 'a/IMG_2.jpg', 'a/IMG_3.wav', 'b/IMG_1.jpg')]
+		for path in expected:
+			open(path, 'wb').close()
+		os.symlink('../b', os.path.join(self._tree_path, 'a', 'link'))
+		os.symlink('IMG_1.jpg', os.path.join(self._tree_path, 'b', 'IMG_4.jpg'))
+		self.assertEqual(sorted([entry.path for entry in tree_scanner.walk_files(self._tree_path)]), expected)
+		scandir = tree_scanner.scandir
+		tree_scanner.scandir = None
+		try:
+			self.assertEqual(sorted([entry.path for entry in tree_scanner.walk_files(self._tree_path)]), expected)
+		finally:
+			tree_scanner.scandir = scandir
+
+	def test_dir_items(self):
+		'tests that the files of an item are a unit in the order of the directory, without the unknown and ignored'
+		dir_path = os.path.join(self._tree_path, 'a')
+		names = ['IMG_1.JPG', 'notes.txt', 'IMG_2.JPG', 'IMG_1.RW2', 'Thumbs.db', 'IMG_1.THM', 'IMG_2.strm']
+		for name in names:
+			open(os.path.join(dir_path, name), 'wb').close()
+		scanner = tree_scanner.TreeScanner()
+		scanner._files_state = {}
+		scanner._n_changed = 0
+		entries = [tree_scanner.ListedEntry(dir_path, name) for name in names]
+		self.assertEqual(scanner._dir_items(entries), [[os.path.join(dir_path, name) for name in \
+			('IMG_1.JPG', 'IMG_1.RW2', 'IMG_1.THM')], [os.path.join(dir_path, 'IMG_2.JPG')]])
+		# only the known files reach the pool
+		self.assertEqual(self._scan().n_processed, 4)
+
+	def test_vanished_file(self):
+		'tests that the files removed while scanning incrementally are skipped'
+		class StatEntry(tree_scanner.ListedEntry):
+			# entry that doesn't cache its stat, as the ones of scandir on Linux
+			def stat(self, follow_symlinks = True):
+				return os.lstat(self.path)
+		path = self._image('IMG_1.jpg')
+		self._scan()
+		entries = [StatEntry(os.path.dirname(path), 'IMG_1.jpg')]
+		os.remove(path)
+		scanner = tree_scanner.TreeScanner(incremental=True)
+		scanner._files_state = dict([(file_path, (timestamp, file_size, None)) \
+			for (file_path, timestamp, file_size, _) in self._files()])
+		scanner._n_changed = 0
+		self.assertEqual(scanner._dir_items(entries), [])
+
+	def test_invalid_path(self):
+		'tests that the files whose path is not UTF-8 are skipped, and the scan ends'
+		path = self._image('IMG_1.jpg')
+		self._image('Espa\xf1a.jpg')
+		self._scan()
+		self.assertEqual([file_path for (file_path, _, _, _) in self._files()], [unicode(path)])
+
+	def test_single_writer(self):
+		'tests that the DB writer adds all the files analyzed by the workers, and exits with its profile'
+		paths = [self._image(name, color) for (name, color) in \
+			(('IMG_1.jpg', (10, 20, 30)), ('IMG_2.jpg', (200, 20, 30)), ('IMG_3.jpg', (10, 200, 30)))]
+		scanner = self._scan()
+		self.assertEqual(scanner.n_processed, 3)
+		self.assertEqual([name for name in [process.name for process in multiprocessing.active_children()] \
+			if name == 'DbWriter'], [])
+		files = self._files()
+		self.assertEqual([file_path for (file_path, _, _, _) in files], [unicode(path) for path in paths])
+		self.assertTrue(all([content_checksum != None for (_, _, _, content_checksum) in files]))
+		# the profile of the scan has the files analyzed by the workers and the items stored by the writer
+		self.assertEqual(scanner.profile.stages['analyze'].count, 3)
+		self.assertEqual(scanner.profile.stages['db.store_item'].count, 3)
+		# the workers adding the files to the DB themselves store the same ones
+		os.remove(self._db_path)
+		self.assertEqual(self._scan(single_writer=False).n_processed, 3)
+		self.assertEqual(self._files(), files)
+
+	def test_writer_died(self):
+		'tests that the scan stops if the DB writer dies, instead of its workers waiting for it forever'
+		def dead_writer(records, db_path, update, profiles):
+			os._exit(1)
+		# the records of the files fill the queue of the DB writer, so that the workers would wait for it
+		for index in range(tree_scanner.PENDING_RECORDS_PER_PROCESS * multiprocessing.cpu_count() + 1):
+			self._image('IMG_%d.jpg' % index)
+		db_writer = tree_scanner.db_writer
+		tree_scanner.db_writer = dead_writer
+		try:
+			self.assertRaises(tree_scanner.ApoScanError, self._scan)
+		finally:
+			tree_scanner.db_writer = db_writer
+		self.assertEqual([process.name for process in multiprocessing.active_children()], [])
+
+	def test_worker_handler(self):
+		'tests that a worker reuses the files handler created when it starts for all its units of work'
+		paths = [self._image('IMG_1.jpg'), self._image('IMG_2.jpg')]
+		tree_scanner.records_queue = multiprocessing.Queue()
+		tree_scanner.TreeScanner.db_path = self._db_path
+		tree_scanner.init_worker()
+		try:
+			fsh = tree_scanner.worker_fsh
+			# the files are only analyzed, the DB writer adds them
+			self.assertEqual(fsh._db, None)
+			for path in paths:
+				(n_records_lists, profile) = tree_scanner.files_processor([path])
+				self.assertTrue(tree_scanner.worker_fsh is fsh)
+				self.assertEqual(n_records_lists, 1)
+				self.assertEqual(profile.stages['analyze'].count, 1)
+				records = tree_scanner.records_queue.get(True, 10)
+				self.assertEqual([record['path'] for record in records], [unicode(path)])
+		finally:
+			tree_scanner.worker_fsh = None
+
 class TestTreeScanner(unittest.TestCase):
 	def setUp(self):
 		if os.path.exists('./testTree'):
@@ -449,7 +1496,18 @@ if __name__ == '__main__':
 	# get the arguments
 	argsParser = optparse.OptionParser()
 	argsParser.add_option('-d', '--db-backend', action='store_true', dest='test_db_backend', default=False)
+	argsParser.add_option('-B', '--db-batch', action='store_true', dest='test_db_batch', default=False)
+	argsParser.add_option('-q', '--db-queries', action='store_true', dest='test_db_queries', default=False)
 	argsParser.add_option('-f', '--files-handler', action='store_true', dest='test_files_handler', default=False)
+	argsParser.add_option('-c', '--checksum-engine', action='store_true', dest='test_checksum_engine', default=False)
+	argsParser.add_option('-u', '--dedup', action='store_true', dest='test_dedup', default=False)
+	argsParser.add_option('-p', '--perceptual-hash', action='store_true', dest='test_perceptual_hash', default=False)
+	argsParser.add_option('-s', '--scan-profile', action='store_true', dest='test_scan_profile', default=False)
+	argsParser.add_option('-m', '--metadata-extractor', action='store_true', dest='test_metadata_extractor', default=False)
+	argsParser.add_option('-e', '--exif-parser', action='store_true', dest='test_exif_parser', default=False)
+	argsParser.add_option('-V', '--video-fingerprint', action='store_true', dest='test_video_fingerprint', default=False)
+	argsParser.add_option('-A', '--audio-fingerprint', action='store_true', dest='test_audio_fingerprint', default=False)
+	argsParser.add_option('-P', '--scan-pipeline', action='store_true', dest='test_scan_pipeline', default=False)
 	argsParser.add_option('-t', '--tree-scanner', action='store_true', dest='test_tree_scanner', default=False)
 	argsParser.add_option('-a', '--all', action='store_true', dest='all_tests', default=False)
 	(options, args) = argsParser.parse_args()
@@ -466,16 +1524,71 @@ if __name__ == '__main__':
 	# start the tests
 	if options.all_tests:
 		options.test_db_backend = True
+		options.test_db_batch = True
+		options.test_db_queries = True
 		options.test_files_handler = True
+		options.test_checksum_engine = True
+		options.test_dedup = True
+		options.test_perceptual_hash = True
+		options.test_scan_profile = True
+		options.test_metadata_extractor = True
+		options.test_exif_parser = True
+		options.test_video_fingerprint = True
+		options.test_audio_fingerprint = True
+		options.test_scan_pipeline = True
 		options.test_tree_scanner = True
 	if options.test_db_backend:
 		print "Run DB backend tests"
 		testDbBackend_suite = unittest.TestLoader().loadTestsFromTestCase(TestDbBackend)
 		unittest.TextTestRunner(verbosity=VERBOSITY).run(testDbBackend_suite)
+	if options.test_db_batch:
+		print "Run DB batch tests"
+		testDbBatch_suite = unittest.TestLoader().loadTestsFromTestCase(TestDbBatch)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testDbBatch_suite)
+	if options.test_db_queries:
+		print "Run DB queries tests"
+		testDbQueries_suite = unittest.TestLoader().loadTestsFromTestCase(TestDbQueries)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testDbQueries_suite)
 	if options.test_files_handler:
 		print "Run file handling tests"
 		testFilesHandler_suite = unittest.TestLoader().loadTestsFromTestCase(TestFilesHandler)
 		unittest.TextTestRunner(verbosity=VERBOSITY).run(testFilesHandler_suite)
+	if options.test_checksum_engine:
+		print "Run checksum engine tests"
+		testChecksumEngine_suite = unittest.TestLoader().loadTestsFromTestCase(TestChecksumEngine)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testChecksumEngine_suite)
+	if options.test_dedup:
+		print "Run duplicates verification tests"
+		testDedup_suite = unittest.TestLoader().loadTestsFromTestCase(TestDedup)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testDedup_suite)
+	if options.test_perceptual_hash:
+		print "Run perceptual hashing tests"
+		testPerceptualHash_suite = unittest.TestLoader().loadTestsFromTestCase(TestPerceptualHash)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testPerceptualHash_suite)
+	if options.test_scan_profile:
+		print "Run scan profiling tests"
+		testScanProfile_suite = unittest.TestLoader().loadTestsFromTestCase(TestScanProfile)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testScanProfile_suite)
+	if options.test_metadata_extractor:
+		print "Run metadata extraction tests"
+		testMetadataExtractor_suite = unittest.TestLoader().loadTestsFromTestCase(TestMetadataExtractor)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testMetadataExtractor_suite)
+	if options.test_exif_parser:
+		print "Run EXIF parsing tests"
+		testExifParser_suite = unittest.TestLoader().loadTestsFromTestCase(TestExifParser)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testExifParser_suite)
+	if options.test_video_fingerprint:
+		print "Run video fingerprinting tests"
+		testVideoFingerprint_suite = unittest.TestLoader().loadTestsFromTestCase(TestVideoFingerprint)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testVideoFingerprint_suite)
+	if options.test_audio_fingerprint:
+		print "Run audio fingerprinting tests"
+		testAudioFingerprint_suite = unittest.TestLoader().loadTestsFromTestCase(TestAudioFingerprint)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testAudioFingerprint_suite)
+	if options.test_scan_pipeline:
+		print "Run scanning pipeline tests"
+		testScanPipeline_suite = unittest.TestLoader().loadTestsFromTestCase(TestScanPipeline)
+		unittest.TextTestRunner(verbosity=VERBOSITY).run(testScanPipeline_suite)
 	if options.test_tree_scanner:
 		print "Run directory tree scanning tests"
 		testTreeScanner_suite = unittest.TestLoader().loadTestsFromTestCase(TestTreeScanner)
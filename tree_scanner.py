@@ -3,22 +3,94 @@
 
 import sys
 import os.path
+import stat
+import itertools
 import files_handler
+import scan_profile
+import db_backend
 import logging
 import multiprocessing
+import threading
+import time
+import Queue
 import optparse
 import traceback
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
 
 lock = None
 processed = None
+records_queue = None
+# handler of the files of the current worker process, created by "init_worker"
+worker_fsh = None
 
 logger_file = logging.getLogger('AuPhOrg')
 logger_output = logging.getLogger('StdOutput')
 
-# processes a single file
-def file_processor(filepath):
-	'process the given file'
-	filepath = unicode(filepath, 'utf-8')
+# number of JPEG files whose tags are obtained with a single exiftool call
+METADATA_BATCH_SIZE = 500
+# maximum number of units of work per process waiting to be processed, and of their records waiting for the DB
+# writer, so that the workers wait for it when it is slower than them
+PENDING_UNITS_PER_PROCESS = 4
+PENDING_RECORDS_PER_PROCESS = 4
+# maximum number of records and seconds of a transaction of the DB writer
+WRITER_COMMIT_RECORDS = 200
+WRITER_COMMIT_S = 5
+# seconds without new records after which the DB writer commits the pending ones, and the parent checks that
+# it is still alive
+WRITER_IDLE_S = 1
+# seconds between the updates of the status of the scan
+STATUS_UPDATE_S = 120
+# kinds of checksums that can be used to list the duplicated files
+DUP_CHECKSUM_KINDS = ['content', 'file', 'full', 'audio']
+
+class ApoScanError(Exception):
+	'error the scan of the tree cannot go on'
+	def __init__(self, reason):
+		Exception.__init__(self)
+		self.reason = reason
+
+	def __str__(self):
+		return 'the scan of the tree stopped: %s' % self.reason
+
+# logs the exception that is being handled
+def log_exception(err_msg):
+	'logs the given message together with the stack of the exception being handled'
+	(exception_type, exception_value, exception_traceback) = sys.exc_info()
+	logger_file.error('%s: (%s) %s' % (err_msg, str(exception_type), str(exception_value)))
+	logger_file.error('vvvvvvvvvvvv start of exception stack vvvvvvvvvvvvvvv')
+	for stack_entry in traceback.extract_tb(exception_traceback):
+		logger_file.error(stack_entry)
+	logger_file.error('^^^^^^^^^^^^^ end of exception stack ^^^^^^^^^^^^^^^^')
+
+# creates the handler of the files
+def create_files_handler(description):
+	'creates a FilesHandler, returning None if it fails'
+	# if there's a DB writer, the files are only analyzed and it adds them to the DB
+	connect_db = (records_queue == None)
+	try:
+		return files_handler.FilesHandler(lock, TreeScanner.db_path, connect_db=connect_db)
+	except Exception, err:
+		log_exception('Error when creating FileHandler to process %s' % description)
+		return None
+
+# initializes a worker process of the pool
+def init_worker():
+	'creates the handler of the files processed by the worker, reused for all of them'
+	global worker_fsh
+	# the measures of the parent, inherited when forking, aren't part of the profile of the worker
+	scan_profile.reset()
+	worker_fsh = create_files_handler('the files of process %d' % os.getpid())
+
+# adds a single file with the given handler
+def add_file(fsh, filepath, tags = None, contents = None):
+	'adds the given file to the DB, or returns its record if the DB writer adds it'
+	# if given, "contents" is the FileContents of the file, already opened
 	logger_file.debug('acquiring lock')
 	lock.acquire()
 	logger_file.debug('lock acquired')
@@ -28,47 +100,173 @@ def file_processor(filepath):
 	lock.release()
 	logger_file.debug('lock released')
 	logger_output.debug('adding file %s' % filepath)
-	logger_file.debug('acquiring lock')
-	lock.acquire()
-	logger_file.debug('lock acquired')
 	try:
-		fsh = files_handler.FilesHandler(lock, TreeScanner.db_path)
+		if records_queue != None:
+			# the file is only analyzed, the DB writer adds it
+			return fsh.analyze_file(filepath, tags=tags, contents=contents)
+		file_added = fsh.add_file(filepath, tags=tags, update=TreeScanner.incremental, contents=contents)
 	except Exception, err:
-		(exception_type, exception_value, exception_traceback) = sys.exc_info()
-		logger_file.error('Error when creating FileHandler to process file %s: (%s) %s' % \
-			(filepath, str(exception_type), str(exception_value)))
-		logger_file.error('vvvvvvvvvvvv start of exception stack vvvvvvvvvvvvvvv')
-		for stack_entry in traceback.extract_tb(exception_traceback):
-			logger_file.error(stack_entry)
-		logger_file.error('^^^^^^^^^^^^^ end of exception stack ^^^^^^^^^^^^^^^^')
-		lock.release()
-		logger_file.debug('lock released')
+		log_exception('Error when processing file %s' % filepath)
 		return
-	lock.release()
-	logger_file.debug('lock released')
+	if file_added:
+		logger_file.info('done adding file n. %d: %s' % (file_index, filepath))
+
+# writes the analyzed files to the DB
+def db_writer(records, db_path, update, profiles):
+	'adds the lists of records of the analyzed files to the DB, being the only process writing to it'
+	# if "update", the records of files already in the DB update them, and its profile is sent to "profiles"
+	scan_profile.reset()
+	fsh = files_handler.FilesHandler(multiprocessing.Lock(), db_path)
+	# once the workers are done, the parent sends the number of lists of records they sent, since the last ones
+	# may reach the queue after it
+	(n_expected, n_received) = (None, 0)
 	try:
-		file_added = fsh.add_file(filepath)
+		with fsh.batch(WRITER_COMMIT_RECORDS, WRITER_COMMIT_S):
+			while (n_expected == None) or (n_received < n_expected):
+				try:
+					record = records.get(True, WRITER_IDLE_S)
+				except Queue.Empty:
+					fsh.commit()
+					continue
+				if isinstance(record, int):
+					n_expected = record
+					continue
+				n_received += 1
+				# the files of a unit of work are added as a single DB record, each item in a single step
+				with fsh.record(len(record)):
+					items_records = itertools.groupby(record, lambda file_record: file_record['item_name'])
+					for (item_name, item_records) in items_records:
+						try:
+							for path in fsh.store_item(item_name, list(item_records), update=update):
+								logger_file.info('done adding file %s' % path)
+						except Exception, err:
+							log_exception('Error when adding the files of the item %s to the DB' % item_name)
 	except Exception, err:
-		(exception_type, exception_value, exception_traceback) = sys.exc_info()
-		logger_file.error('Error when processing file %s: (%s) %s' % \
-			(filepath, str(exception_type), str(exception_value)))
-		logger_file.error('vvvvvvvvvvvv start of exception stack vvvvvvvvvvvvvvv')
-		for stack_entry in traceback.extract_tb(exception_traceback):
-			logger_file.error(stack_entry)
-		logger_file.error('^^^^^^^^^^^^^ end of exception stack ^^^^^^^^^^^^^^^^')
+		# the parent stops the scan when the writer dies, as the workers would wait for it forever
+		log_exception('Error in the DB writer, the records not committed yet are lost')
+		logger_output.error('the DB writer failed: %s' % str(err))
+		raise
+	profiles.put(scan_profile.reset())
+	logger_file.debug('DB writer done')
+
+# processes a unit of work
+def files_processor(filepaths):
+	'process the given files, getting the tags of their JPEG files with a single exiftool call'
+	# the number of lists of records sent to the DB writer and the profile of the worker since its previous unit
+	# of work are returned to the parent
+	filepaths = [unicode(filepath, 'utf-8') for filepath in filepaths]
+	fsh = worker_fsh
+	if fsh == None:
+		logger_file.error('no FileHandler to process %d files' % len(filepaths))
 		return
-	if file_added:
-		logger_file.info('done adding file n. %d: %s' % (file_index, filepath))
+	jpeg_paths = []
+	for filepath in filepaths:
+		if os.path.splitext(filepath)[1].lower() in files_handler.JPEG_EXTS:
+			jpeg_paths.append(filepath)
+	files_tags = {}
+	records = []
+	files_contents = {}
+	try:
+		if len(jpeg_paths) > 1:
+			# the JPEG files are opened once, for reading their tags and for the rest of their analysis
+			for filepath in jpeg_paths:
+				try:
+					files_contents[filepath] = files_handler.FileContents(filepath)
+				except Exception, err:
+					# the error is reported when the file is analyzed
+					continue
+			try:
+				files_tags = fsh.get_tags_batch(jpeg_paths, files_contents)
+			except Exception, err:
+				log_exception('Error when getting the tags of a batch of %d files' % len(jpeg_paths))
+		for filepath in filepaths:
+			# files missing in the batch output get their tags individually
+			record = add_file(fsh, filepath, files_tags.get(filepath), files_contents.get(filepath))
+			if record != None:
+				records.append(record)
+	finally:
+		for contents in files_contents.values():
+			contents.close()
+	n_records_lists = 0
+	if len(records) > 0:
+		records_queue.put(records)
+		n_records_lists = 1
+	return (n_records_lists, scan_profile.reset())
+
+# entries of directories when scandir isn't available
+class ListedEntry:
+	'entry of a directory got with listdir and lstat, with the part of the interface of scandir used here'
+	def __init__(self, dir_path, name):
+		self.name = name
+		self.path = os.path.join(dir_path, name)
+		self._stat = os.lstat(self.path)
+
+	def is_dir(self, follow_symlinks = True):
+		return stat.S_ISDIR(self._stat.st_mode)
+
+	def is_file(self, follow_symlinks = True):
+		return stat.S_ISREG(self._stat.st_mode)
+
+	def stat(self, follow_symlinks = True):
+		return self._stat
+
+# lists a directory
+def list_dir(dir_path):
+	'returns the entries of the given directory, using scandir if available'
+	if scandir != None:
+		return scandir(dir_path)
+	entries = []
+	for name in os.listdir(dir_path):
+		try:
+			entries.append(ListedEntry(dir_path, name))
+		except OSError, err:
+			# the files removed since the directory was listed are skipped
+			logger_file.warning('file %s cannot be handled, because it cannot be stat: %s' % \
+				(os.path.join(dir_path, name), str(err)))
+	return entries
+
+# walks a tree
+def walk_dirs(photostree_root):
+	'yields the path and the entries of the regular files of every directory of the tree, not following links'
+	dirs_to_scan = [photostree_root]
+	while len(dirs_to_scan) > 0:
+		dir_path = dirs_to_scan.pop()
+		try:
+			entries = list_dir(dir_path)
+		except OSError, err:
+			logger_file.error('Error when listing directory %s: %s' % (dir_path, str(err)))
+			continue
+		file_entries = []
+		for entry in entries:
+			# the type of the entries comes with them, so no stat is required
+			if entry.is_dir(follow_symlinks=False):
+				dirs_to_scan.append(entry.path)
+			elif entry.is_file(follow_symlinks=False):
+				file_entries.append(entry)
+		yield (dir_path, file_entries)
+
+def walk_files(photostree_root):
+	'yields the entries of the regular files of the tree, without following symbolic links'
+	for (_, file_entries) in walk_dirs(photostree_root):
+		for entry in file_entries:
+			yield entry
 
 # scans the given tree and tries to add the found files to the DB
 class TreeScanner():
 	'scans a tree'
 	_pool = None
 	db_path = ""
+	incremental = False
 
-	def __init__(self):
-		'initializes the tree scanner'
-		self._files_to_add = []
+	def __init__(self, batch_metadata = False, single_writer = True, incremental = False, profile_path = None):
+		'initializes the tree scanner, optionally getting the tags of the JPEG files in batches'
+		self._batch_metadata = batch_metadata
+		# if single writer, the workers only analyze the files and a dedicated process adds them to the DB
+		self._single_writer = single_writer
+		# if incremental, the files of the DB that changed since they were added are updated
+		self._incremental = incremental
+		# if given, the profile of the scan is also written as JSON to this path
+		self._profile_path = profile_path
 
 	def __del__(self):
 		'informs about the end of the processing'
@@ -76,42 +274,208 @@ class TreeScanner():
 
 	def init_pool(self, background, database_path = ""):
 		'initializes the pool of processes that will process the individual files'
+		global records_queue
 		TreeScanner.db_path = database_path
+		TreeScanner.incremental = self._incremental
 		self.n_cpus = multiprocessing.cpu_count()
 		if background and (self.n_cpus > 1):
 			self.n_cpus = self.n_cpus - 1
+		# the queue must exist before the workers are started, so that they inherit it
+		records_queue = None
+		if self._single_writer:
+			records_queue = multiprocessing.Queue(PENDING_RECORDS_PER_PROCESS * self.n_cpus)
 		if TreeScanner._pool != None:
 			raise RuntimeError
+		# the schema is created, if missing, before the workers connect to the DB
+		db_backend.DbConnector(lock, database_path)
 		logger_file.info('starting a pool of %d processes' % self.n_cpus)
-		TreeScanner._pool = multiprocessing.Pool(self.n_cpus)
+		TreeScanner._pool = multiprocessing.Pool(self.n_cpus, init_worker)
 		logger_file.debug('pool of processes started')
 
 	def scan_tree(self, photostree_root):
-		'walks the tree assigning the files to be processes to the pool of processes'
+		'walks the tree assigning the files to be processes to the pool of processes while found'
 		logger_file.info('analyzing tree %s' % photostree_root)
 		logger_output.info('analyzing tree %s' % photostree_root)
-		os.path.walk(photostree_root, self._process_dir, None)
-		n_files_to_add = len(self._files_to_add)
-		logger_file.info('tree analyzed: %s files to process' % n_files_to_add)
-		logger_output.info('tree analyzed: %s files to process' % n_files_to_add)
+		db = db_backend.DbConnector(lock, TreeScanner.db_path)
+		self._files_state = db.get_files_state(photostree_root)
+		db = None
+		self._n_files_to_add = 0
+		self._n_changed = 0
+		self._n_records_lists = 0
+		# the profiles of all the processes are merged into the one of the scan
+		self.profile = scan_profile.ScanProfile()
+		if self._single_writer:
+			writer_profiles = multiprocessing.Queue()
+			writer = multiprocessing.Process(target=db_writer, name='DbWriter', \
+				args=(records_queue, TreeScanner.db_path, self._incremental, writer_profiles))
+			writer.start()
 		logger_file.debug('processing tree')
-		result = TreeScanner._pool.map_async(file_processor, self._files_to_add)
-		status_update_s = 120
-		result.wait(status_update_s)
-		while not result.ready():
-			percent = 100 * processed.value / n_files_to_add
-			logger_output.info('%d out of %d ready (%d%%)' % \
-				(processed.value, n_files_to_add, percent))
-			result.wait(status_update_s)
+		# the walk stops while too many units of work are waiting for the pool
+		self._pending_units = threading.Semaphore(PENDING_UNITS_PER_PROCESS * self.n_cpus)
+		results = TreeScanner._pool.imap_unordered(files_processor, self._work_units(photostree_root))
+		status_update_s = time.time() + STATUS_UPDATE_S
+		try:
+			while True:
+				if self._single_writer and not writer.is_alive():
+					self._stop_pool()
+					raise ApoScanError('the DB writer died with exit code %s' % writer.exitcode)
+				try:
+					result = results.next(WRITER_IDLE_S)
+				except multiprocessing.TimeoutError:
+					if time.time() >= status_update_s:
+						logger_output.info('%d out of %d files found so far ready' % \
+							(processed.value, self._n_files_to_add))
+						status_update_s = time.time() + STATUS_UPDATE_S
+					continue
+				except StopIteration:
+					break
+				if result != None:
+					(n_records_lists, worker_profile) = result
+					self._n_records_lists += n_records_lists
+					self.profile.merge(worker_profile)
+				self._pending_units.release()
+		finally:
+			# the DB writer adds the records already analyzed and exits, even if the walk or a worker failed
+			if self._single_writer:
+				logger_file.debug('waiting for the DB writer to add the remaining files')
+				while writer.is_alive():
+					try:
+						records_queue.put(self._n_records_lists, True, WRITER_IDLE_S)
+						break
+					except Queue.Full:
+						continue
+				writer.join()
+		logger_file.info('tree analyzed: %d new and %d changed files processed' % \
+			(self._n_files_to_add - self._n_changed, self._n_changed))
+		logger_output.info('tree analyzed: %d new and %d changed files processed' % \
+			(self._n_files_to_add - self._n_changed, self._n_changed))
+		if self._single_writer:
+			try:
+				self.profile.merge(writer_profiles.get(True, WRITER_IDLE_S))
+			except Queue.Empty:
+				logger_file.warning('the profile of the DB writer is missing')
+		self.profile.merge(scan_profile.reset())
+		self._report_profile()
 		logger_file.debug('the pool of processes already processed the tree!')
 		logger_output.info('done processing the tree!')
 
-	def _process_dir(self, arg, dir_path, filenames):
-		'processes the files found in the given directory'
-		for filename in filenames:
-			filepath = os.path.join(dir_path, filename)
-			if not (os.path.isdir(filepath) or os.path.islink(filepath)):
-				self._files_to_add.append(filepath)
+	def _report_profile(self):
+		'reports the time spent in every stage of the scan by all the processes'
+		for line in self.profile.report():
+			logger_file.info(line)
+			logger_output.info(line)
+		if self._profile_path != None:
+			self.profile.write_json(self._profile_path)
+			logger_output.info('profile of the scan written to %s' % self._profile_path)
+
+	def _stop_pool(self):
+		'terminates the workers of the pool, and the walk that feeds it'
+		logger_file.error('stopping the scan, the files analyzed but not added to the DB are lost')
+		logger_output.error('stopping the scan, the files analyzed but not added to the DB are lost')
+		# the walk may be waiting for a free unit of work in the task handler of the pool, which must exit
+		self._pending_units.release()
+		TreeScanner._pool.terminate()
+
+	def _work_units(self, photostree_root):
+		'yields the lists of files to be processed together, the files of each item or batches of items'
+		batch = []
+		for (dir_path, file_entries) in walk_dirs(photostree_root):
+			for item_files in self._dir_items(file_entries):
+				self._n_files_to_add += len(item_files)
+				if not self._batch_metadata:
+					self._pending_units.acquire()
+					yield item_files
+					continue
+				# the items are kept whole in the batches
+				batch.extend(item_files)
+				if len(batch) >= METADATA_BATCH_SIZE:
+					self._pending_units.acquire()
+					yield batch
+					batch = []
+		if len(batch) > 0:
+			self._pending_units.acquire()
+			yield batch
+
+	def _dir_items(self, file_entries):
+		'returns the lists of the files to add of the directory that belong to the same item'
+		items = {}
+		items_names = []
+		for entry in file_entries:
+			(item_name, extension) = os.path.splitext(entry.name)
+			extension = extension.lower()
+			# the ignored and unknown files aren't sent to the pool
+			if not extension in files_handler.FILE_TYPES:
+				logger_file.warning('file %s cannot be handled, because its extension (%s) is not supported' % \
+					(entry.path, extension[1:]))
+				continue
+			if files_handler.FILE_TYPES[extension] == None:
+				logger_file.debug('Ignore file %s' % entry.path)
+				continue
+			# the paths are stored in the DB as unicode, so the ones that aren't UTF-8 cannot be added
+			try:
+				unicode(entry.path, 'utf-8')
+			except UnicodeDecodeError:
+				logger_file.error('file %s cannot be handled, because its path is not valid UTF-8' % \
+					repr(entry.path))
+				logger_output.error('file %s cannot be handled, because its path is not valid UTF-8' % \
+					repr(entry.path))
+				continue
+			if not self._file_to_add(entry):
+				continue
+			if not item_name in items:
+				items[item_name] = []
+				items_names.append(item_name)
+			items[item_name].append(entry.path)
+		return [items[item_name] for item_name in items_names]
+
+	def _file_to_add(self, entry):
+		'returns False if the file is already in the DB, unless it is outdated in incremental scans'
+		file_state = self._files_state.get(unicode(entry.path, 'utf-8'))
+		if file_state == None:
+			return True
+		if self._incremental:
+			# the files removed since they were listed are skipped
+			try:
+				file_stat = entry.stat(follow_symlinks=False)
+			except OSError, err:
+				logger_file.warning('file %s cannot be handled, because it cannot be stat: %s' % \
+					(entry.path, str(err)))
+				return False
+			if files_handler.file_outdated(entry.path, file_stat, *file_state):
+				self._n_changed += 1
+				return True
+		logger_file.debug('file already exists, not adding it: %s' % entry.path)
+		return False
+
+# lists the duplicated files of the DB
+def show_duplicates(db_path, checksum_kind):
+	'writes to the standard output the groups of files of the DB with the same checksum of the given kind'
+	# the "full" checksums only hash the whole files that have candidates to duplicates
+	if checksum_kind == 'full':
+		groups = files_handler.FilesHandler(lock, db_path).verified_duplicates()
+	elif checksum_kind == 'audio':
+		# the wave files whose audio sounds the same, even if their format or silences differ
+		db = db_backend.DbConnector(lock, db_path)
+		groups = (paths for (_, paths) in db.get_duplicates('audio_signature'))
+	else:
+		db = db_backend.DbConnector(lock, db_path)
+		groups = (paths for (_, paths) in db.get_duplicates(checksum_kind + '_checksum'))
+	n_groups = 0
+	for paths in groups:
+		n_groups += 1
+		for path in paths:
+			print path.encode('utf-8')
+		print
+	logger_output.info('%d groups of duplicated files found' % n_groups)
+
+# lists the files of the DB that look like a given one
+def show_near_duplicates(db_path, path):
+	'writes to the standard output the files of the DB whose image looks like the one of the given file'
+	fsh = files_handler.FilesHandler(lock, db_path)
+	near_duplicates = fsh.near_duplicates(unicode(path, 'utf-8'))
+	for (distance, near_path) in near_duplicates:
+		print '%d\t%s' % (distance, near_path.encode('utf-8'))
+	logger_output.info('%d files look like %s' % (len(near_duplicates), path))
 
 # configure a logger
 def config_logger(log_handler, log_format, logger_name, logging_level = logging.INFO):
@@ -133,12 +497,25 @@ def parse_args():
 		help='set the verbosity level to VERBOSITY_LEVEL')
 	parser.add_option('-d', '--db', dest='db_path', metavar='DATABASE_PATH', \
 		help='use the database that can be found in DATABASE_PATH or create it new there')
+	parser.add_option('-m', '--batch-metadata', dest='batch_metadata', action='store_true', default=False, \
+		help="get the tags of the JPEG files in batches of %d files per exiftool call" % METADATA_BATCH_SIZE)
+	parser.add_option('-i', '--incremental', dest='incremental', action='store_true', default=False, \
+		help="update the files of the DB whose timestamp or size changed since they were added")
+	parser.add_option('-p', '--parallel-writes', dest='parallel_writes', action='store_true', default=False, \
+		help="every process adds its files to the DB, instead of a single process adding all of them")
+	parser.add_option('-u', '--duplicates', dest='duplicates', metavar='CHECKSUM', type='choice', \
+		choices=DUP_CHECKSUM_KINDS, help="list the files of the DB with the same CHECKSUM (%s)" % \
+		', '.join(DUP_CHECKSUM_KINDS))
+	parser.add_option('-n', '--near-duplicates', dest='near_duplicates', metavar='FILE', \
+		help="list the files of the DB whose image looks like the one of FILE, with the bits their hashes differ")
+	parser.add_option('-j', '--profile-json', dest='profile_json', metavar='JSON_FILE', \
+		help="write the time spent in every stage of the scan to JSON_FILE, besides reporting it")
 	parser.add_option('-b', '--background', dest='background', action='store_true', default=False, \
 		help="if more than one CPU available, leave one CPU unused for other tasks")
 	(options, _) = parser.parse_args()
-	if options.tree_root == None:
-		logger_file.error("The root directory of the tree to be scanned is required! (option '-r')")
-		logger_output.error("The root directory of the tree to be scanned is required! (option '-r')")
+	if (options.tree_root == None) and (options.duplicates == None) and (options.near_duplicates == None):
+		logger_file.error("The root directory of the tree to be scanned is required! (option '-r'), unless only listing duplicates (options '-u' and '-n')")
+		logger_output.error("The root directory of the tree to be scanned is required! (option '-r'), unless only listing duplicates (options '-u' and '-n')")
 		sys.exit()
 	if options.verbosity == '0':
 		verbosity = logging.CRITICAL
@@ -157,9 +534,12 @@ def parse_args():
 		logger_file.error("no DB specified in the command line (option '-d')")
 		logger_output.error("no DB specified in the command line (option '-d')")
 		sys.exit()
-	logger_output.info("tree to scan => %s" % options.tree_root)
+	if options.tree_root != None:
+		logger_output.info("tree to scan => %s" % options.tree_root)
 	logger_output.info("path of the DB => %s" % options.db_path)
-	return (options.tree_root, options.db_path, options.background)
+	return (options.tree_root, options.db_path, options.background, options.batch_metadata, \
+		not options.parallel_writes, options.incremental, options.duplicates, options.near_duplicates, \
+		options.profile_json)
 
 #command line execution
 if __name__ == '__main__':
@@ -179,7 +559,8 @@ if __name__ == '__main__':
 	logger_output = config_logger(log_output, log_format, 'StdOutput')
 	logger_output.info('logging file => ' + log_filename)
 	# parse the arguments
-	(tree_root, db_path, background) = parse_args()
+	(tree_root, db_path, background, batch_metadata, single_writer, incremental, duplicates, near_duplicates, \
+		profile_json) = parse_args()
 	# initialize the variables required for keeping track of the number of processed files
 	lock = multiprocessing.Lock()
 	if lock.acquire(False) == False:
@@ -187,6 +568,11 @@ if __name__ == '__main__':
 	lock.release()
 	processed = multiprocessing.Value('i', 0)
 	# start processing the tree
-	tree_scanner = TreeScanner()
-	tree_scanner.init_pool(background, db_path)
-	tree_scanner.scan_tree(tree_root)
+	if tree_root != None:
+		tree_scanner = TreeScanner(batch_metadata, single_writer, incremental, profile_json)
+		tree_scanner.init_pool(background, db_path)
+		tree_scanner.scan_tree(tree_root)
+	if duplicates != None:
+		show_duplicates(db_path, duplicates)
+	if near_duplicates != None:
+		show_near_duplicates(db_path, near_duplicates)
@@ -0,0 +1,286 @@
+'calculates the fingerprints of videos from the payload of their first frames, parsing their container in-process'
+
+import struct
+import hashlib
+import uuid
+
+# number of samples of the video stream whose payload is hashed
+VIDEO_SAMPLES = 16
+# AVI files are RIFF files whose frames are the "##dc" (compressed) and "##db" (uncompressed) chunks of the stream
+AVI_FRAME_SUFFIXES = ('dc', 'db')
+# atoms that can start a QuickTime file, and the ones that contain the tables of the samples of a track
+QUICKTIME_ATOMS = ('ftyp', 'moov', 'mdat', 'free', 'skip', 'wide', 'pnot')
+QUICKTIME_CONTAINERS = ('moov', 'trak', 'mdia', 'minf', 'stbl')
+# ASF objects, their GUIDs being stored as little-endian UUIDs
+ASF_HEADER = uuid.UUID('75b22630-668e-11cf-a6d9-00aa0062ce6c').bytes_le
+ASF_DATA = uuid.UUID('75b22636-668e-11cf-a6d9-00aa0062ce6c').bytes_le
+ASF_FILE_PROPERTIES = uuid.UUID('8cabdca1-a947-11cf-8ee4-00c00c205365').bytes_le
+ASF_STREAM_PROPERTIES = uuid.UUID('b7dc0791-a9b7-11cf-8ee6-00c00c205365').bytes_le
+ASF_VIDEO_MEDIA = uuid.UUID('bc19efc0-5b4d-11cf-a8fd-00805f5c442b').bytes_le
+# sizes of the fields of the ASF packets, by the 2 bits of their length type
+ASF_FIELD_SIZES = (0, 1, 2, 4)
+ASF_FIELD_FORMATS = {1: '<B', 2: '<H', 4: '<I'}
+
+# exceptions
+class ApoVideoError(Exception):
+    'error the container of the video cannot be parsed'
+    def __init__(self, reason):
+        Exception.__init__(self)
+        self.reason = reason
+
+    def __str__(self):
+        return 'video container cannot be parsed: %s' % self.reason
+
+def _unpack(read, offset, fmt):
+    'returns the values of the given format read at the offset, failing if the file is shorter'
+    data = read(offset, struct.calcsize(fmt))
+    if len(data) < struct.calcsize(fmt):
+        raise ApoVideoError('truncated file')
+    return struct.unpack(fmt, data)
+
+#
+# AVI
+#
+
+def _riff_chunks(read, start, end):
+    'yields the ID, the offset of the data and the size of the RIFF chunks between the offsets'
+    offset = start
+    while offset + 8 <= end:
+        (chunk_id, size) = _unpack(read, offset, '<4sI')
+        yield (chunk_id, offset + 8, min(size, end - offset - 8))
+        offset += 8 + size + size % 2
+
+def _avi_video_stream(read, start, end):
+    'returns the number of the first video stream of the "hdrl" list, as in the IDs of its chunks'
+    n_streams = 0
+    for (chunk_id, offset, size) in _riff_chunks(read, start, end):
+        if (chunk_id != 'LIST') or (read(offset, 4) != 'strl'):
+            continue
+        for (header_id, header_offset, _) in _riff_chunks(read, offset + 4, offset + size):
+            if (header_id == 'strh') and (read(header_offset, 4) == 'vids'):
+                return '%02d' % n_streams
+        n_streams += 1
+    return None
+
+def _avi_movi_chunks(read, start, end):
+    'yields the chunks of the "movi" list, including the ones of its "rec " lists'
+    for (chunk_id, offset, size) in _riff_chunks(read, start, end):
+        if chunk_id == 'LIST':
+            for chunk in _avi_movi_chunks(read, offset + 4, offset + size):
+                yield chunk
+        else:
+            yield (chunk_id, offset, size)
+
+def _avi_samples(read, file_size):
+    'returns the payloads of the first frames of the video stream of an AVI file'
+    (riff_size,) = _unpack(read, 4, '<I')
+    video_stream = None
+    for (chunk_id, offset, size) in _riff_chunks(read, 12, min(file_size, 8 + riff_size)):
+        if chunk_id != 'LIST':
+            continue
+        list_type = read(offset, 4)
+        if list_type == 'hdrl':
+            video_stream = _avi_video_stream(read, offset + 4, offset + size)
+        elif list_type == 'movi':
+            samples = []
+            for (frame_id, frame_offset, frame_size) in _avi_movi_chunks(read, offset + 4, offset + size):
+                # the empty frames are dropped ones, repeating the previous frame
+                if (not frame_id[2:] in AVI_FRAME_SUFFIXES) or (frame_size == 0):
+                    continue
+                if (video_stream != None) and (frame_id[:2] != video_stream):
+                    continue
+                samples.append(read(frame_offset, frame_size))
+                if len(samples) == VIDEO_SAMPLES:
+                    break
+            return samples
+    raise ApoVideoError('"movi" list missing')
+
+#
+# QuickTime
+#
+
+def _quicktime_atoms(read, start, end):
+    'yields the type, the offset of the data and the size of the QuickTime atoms between the offsets'
+    offset = start
+    while offset + 8 <= end:
+        (size, atom_type) = _unpack(read, offset, '>I4s')
+        header_size = 8
+        if size == 1:
+            (size,) = _unpack(read, offset + 8, '>Q')
+            header_size = 16
+        elif size == 0:
+            size = end - offset
+        if size < header_size:
+            raise ApoVideoError('atom %s of invalid size' % repr(atom_type))
+        yield (atom_type, offset + header_size, min(size, end - offset) - header_size)
+        offset += size
+
+def _quicktime_tables(read, start, end, tables):
+    'adds to "tables" the offsets and sizes of the tables of the samples of the first video track found'
+    for (atom_type, offset, size) in _quicktime_atoms(read, start, end):
+        if atom_type == 'trak':
+            track_tables = {}
+            _quicktime_tables(read, offset, offset + size, track_tables)
+            # the tracks of the video come first, but any track is better than none
+            if (track_tables.get('hdlr') == 'vide') and (tables.get('hdlr') != 'vide'):
+                tables.clear()
+            if len(tables) == 0:
+                tables.update(track_tables)
+        elif atom_type in QUICKTIME_CONTAINERS:
+            _quicktime_tables(read, offset, offset + size, tables)
+        elif atom_type == 'hdlr':
+            tables['hdlr'] = read(offset + 8, 4)
+        elif atom_type in ('stsz', 'stco', 'co64', 'stsc'):
+            tables[atom_type] = (offset, size)
+
+def _quicktime_samples(read, file_size):
+    'returns the payloads of the first samples of the video track of a QuickTime file'
+    tables = {}
+    _quicktime_tables(read, 0, file_size, tables)
+    if not ('stsz' in tables and 'stsc' in tables and ('stco' in tables or 'co64' in tables)):
+        raise ApoVideoError('tables of the samples missing')
+    # sizes of the first samples, all of them the same if given in the header of the table
+    (offset, _) = tables['stsz']
+    (sample_size, n_samples) = _unpack(read, offset + 4, '>II')
+    n_samples = min(n_samples, VIDEO_SAMPLES)
+    if sample_size == 0:
+        sizes = _unpack(read, offset + 12, '>%dI' % n_samples)
+    else:
+        sizes = [sample_size] * n_samples
+    # offsets of the chunks with the samples
+    if 'stco' in tables:
+        (offset, _) = tables['stco']
+        chunk_format = '>I'
+    else:
+        (offset, _) = tables['co64']
+        chunk_format = '>Q'
+    (n_chunks,) = _unpack(read, offset + 4, '>I')
+    chunks_offset = offset + 8
+    # runs of chunks with the same number of samples, as (first chunk, samples per chunk)
+    (offset, _) = tables['stsc']
+    (n_runs,) = _unpack(read, offset + 4, '>I')
+    runs = [_unpack(read, offset + 8 + index * 12, '>II') for index in range(n_runs)]
+    samples = []
+    (chunk, run) = (1, 0)
+    while (len(samples) < n_samples) and (chunk <= n_chunks):
+        while (run + 1 < n_runs) and (runs[run + 1][0] <= chunk):
+            run += 1
+        (sample_offset,) = _unpack(read, chunks_offset + (chunk - 1) * struct.calcsize(chunk_format), chunk_format)
+        for _ in range(runs[run][1] if n_runs > 0 else 0):
+            if len(samples) == n_samples:
+                break
+            samples.append(read(sample_offset, sizes[len(samples)]))
+            sample_offset += sizes[len(samples) - 1]
+        chunk += 1
+    return samples
+
+#
+# ASF
+#
+
+def _asf_objects(read, start, end):
+    'yields the GUID, the offset and the size of the ASF objects between the offsets'
+    offset = start
+    while offset + 24 <= end:
+        guid = read(offset, 16)
+        (size,) = _unpack(read, offset + 16, '<Q')
+        if size < 24:
+            raise ApoVideoError('object of invalid size')
+        yield (guid, offset, min(size, end - offset))
+        offset += size
+
+def _asf_field(read, offset, length_type):
+    'returns the value of a field of the packet of the given length type, and the offset after it'
+    field_size = ASF_FIELD_SIZES[length_type & 0x03]
+    if field_size == 0:
+        return (0, offset)
+    return (_unpack(read, offset, ASF_FIELD_FORMATS[field_size])[0], offset + field_size)
+
+def _asf_payloads(read, offset, packet_size):
+    'returns the (stream number, data) of the payloads of the ASF packet at the offset'
+    packet_start = offset
+    (flags,) = _unpack(read, offset, '<B')
+    if flags & 0x80:
+        # error correction data
+        offset += 1 + (flags & 0x0f)
+        (flags,) = _unpack(read, offset, '<B')
+    (property_flags,) = _unpack(read, offset + 1, '<B')
+    offset += 2
+    (length, offset) = _asf_field(read, offset, flags >> 5)
+    (_, offset) = _asf_field(read, offset, flags >> 1)
+    (padding, offset) = _asf_field(read, offset, flags >> 3)
+    # send time and duration
+    offset += 6
+    # the packets have a fixed size, unless their length is given and shorter
+    if length == 0:
+        length = packet_size
+    data_end = packet_start + min(length, packet_size) - padding
+    n_payloads = 1
+    payload_length_type = None
+    if flags & 0x01:
+        (payload_flags,) = _unpack(read, offset, '<B')
+        offset += 1
+        n_payloads = payload_flags & 0x3f
+        payload_length_type = payload_flags >> 6
+    payloads = []
+    for _ in range(n_payloads):
+        (stream,) = _unpack(read, offset, '<B')
+        offset += 1
+        (_, offset) = _asf_field(read, offset, property_flags >> 4)
+        (_, offset) = _asf_field(read, offset, property_flags >> 2)
+        (replicated_length, offset) = _asf_field(read, offset, property_flags)
+        offset += replicated_length
+        if payload_length_type == None:
+            payload_length = data_end - offset
+        else:
+            (payload_length, offset) = _asf_field(read, offset, payload_length_type)
+        if (payload_length < 0) or (offset + payload_length > data_end):
+            raise ApoVideoError('payload out of its packet')
+        payloads.append((stream & 0x7f, read(offset, payload_length)))
+        offset += payload_length
+    return payloads
+
+def _asf_samples(read, file_size):
+    'returns the payloads of the first packets of the video stream of an ASF file'
+    (header_size,) = _unpack(read, 16, '<Q')
+    (packet_size, video_stream) = (None, None)
+    for (guid, offset, size) in _asf_objects(read, 30, min(header_size, file_size)):
+        if guid == ASF_FILE_PROPERTIES:
+            (packet_size,) = _unpack(read, offset + 92, '<I')
+        elif (guid == ASF_STREAM_PROPERTIES) and (video_stream == None):
+            if read(offset + 24, 16) == ASF_VIDEO_MEDIA:
+                (flags,) = _unpack(read, offset + 72, '<H')
+                video_stream = flags & 0x7f
+    if not packet_size:
+        raise ApoVideoError('size of the packets missing')
+    if read(header_size, 16) != ASF_DATA:
+        raise ApoVideoError('data object missing')
+    (data_size,) = _unpack(read, header_size + 16, '<Q')
+    samples = []
+    offset = header_size + 50
+    data_end = min(file_size, header_size + data_size)
+    while (offset + packet_size <= data_end) and (len(samples) < VIDEO_SAMPLES):
+        for (stream, payload) in _asf_payloads(read, offset, packet_size):
+            if ((video_stream == None) or (stream == video_stream)) and (len(samples) < VIDEO_SAMPLES):
+                samples.append(payload)
+        offset += packet_size
+    return samples
+
+def fingerprint(read, file_size):
+    'returns the hexadecimal SHA512 checksum of the payload of the first samples of the video stream'
+    # "read" returns the given number of bytes of the file at the given offset, so that only they are read
+    header = read(0, 16)
+    if (header[0:4] == 'RIFF') and (header[8:12] == 'AVI '):
+        samples = _avi_samples(read, file_size)
+    elif header == ASF_HEADER:
+        samples = _asf_samples(read, file_size)
+    elif header[4:8] in QUICKTIME_ATOMS:
+        samples = _quicktime_samples(read, file_size)
+    else:
+        raise ApoVideoError('unknown container')
+    if len(samples) == 0:
+        raise ApoVideoError('no samples of the video found')
+    cksm = hashlib.sha512()
+    for sample in samples:
+        cksm.update(sample)
+    return cksm.hexdigest()